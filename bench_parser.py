@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import base64
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from hook import GuacInstructionParser
+
+# 用法: python bench_parser.py [guacd 原始數據抓包文件] [輪數]
+# 抓包文件為 guacd -> 客戶端方向的原始 TCP 載荷，未提供時使用模擬的 RDP 流量
+CHUNK_SIZE = 16384
+
+
+def encode(opcode, *args):
+    elements = [f"{len(str(opcode))}.{opcode}"]
+    for arg in args:
+        arg = str(arg)
+        elements.append(f"{len(arg)}.{arg}")
+    return ','.join(elements) + ';'
+
+
+def synthetic_rdp_traffic(frames=200):
+    """生成近似 RDP 會話的指令流：大塊 img/blob 串流、png、copy 和 sync"""
+    image = base64.b64encode(os.urandom(48 * 1024)).decode()
+    full_frame = base64.b64encode(os.urandom(768 * 1024)).decode()
+    parts = [encode('size', 0, 1024, 768)]
+    for frame in range(frames):
+        stream = str(frame % 64)
+        parts.append(encode('img', stream, 14, 0, 'image/png', 0, 0))
+        for i in range(0, len(image), 8192):
+            parts.append(encode('blob', stream, image[i:i + 8192]))
+        parts.append(encode('end', stream))
+        parts.append(encode('png', 14, 0, 64, 64, image[:4096]))
+        for tile in range(40):
+            parts.append(encode('copy', -1, 0, 0, 64, 64, 14, 0, tile * 16, 128))
+            parts.append(encode('cfill', 14, 0, 0, 0, 0, 255, tile * 16, 0, 16, 16))
+        if frame % 20 == 0:
+            # 整屏刷新時的單條大 png 指令
+            parts.append(encode('png', 14, 0, 0, 0, full_frame))
+        # 包含 ';' 與非 ASCII 字元的長度前綴值
+        parts.append(encode('name', '工作站;桌面'))
+        parts.append(encode('sync', int(time.time() * 1000) + frame))
+    return ''.join(parts).encode('utf-8')
+
+
+def chunks(data):
+    for i in range(0, len(data), CHUNK_SIZE):
+        yield data[i:i + CHUNK_SIZE]
+
+
+def parse_instruction(data):
+    """舊版 GuacamoleAutomator._parse_instruction：逐元素切片重建字符串，僅供對比"""
+    if not data or not data.endswith(';'):
+        return ("", ())
+
+    parts = []
+    buffer_str = data[:-1]
+    while buffer_str:
+        dot_pos = buffer_str.find('.')
+        if dot_pos == -1:
+            break
+        try:
+            length = int(buffer_str[:dot_pos])
+        except ValueError:
+            break
+        start = dot_pos + 1
+        end = start + length
+        if end > len(buffer_str):
+            break
+
+        parts.append(buffer_str[start:end])
+        buffer_str = buffer_str[end:]
+
+        if buffer_str.startswith(','):
+            buffer_str = buffer_str[1:]
+        elif buffer_str:
+            break
+
+    return (parts[0], tuple(parts[1:])) if parts else ("", ())
+
+
+def legacy_parse(data):
+    """舊的接收路徑：解碼為 str、以第一個 ';' 切分再逐元素重建字符串"""
+    instruction_buffer = ""
+    count = 0
+    for chunk in chunks(data):
+        instruction_buffer += chunk.decode('utf-8', errors='replace')
+        while ';' in instruction_buffer:
+            instr_end_idx = instruction_buffer.find(';') + 1
+            full_instruction = instruction_buffer[:instr_end_idx]
+            instruction_buffer = instruction_buffer[instr_end_idx:]
+            opcode, _ = parse_instruction(full_instruction)
+            if opcode:
+                count += 1
+    return count
+
+
+def incremental_parse(data):
+    parser = GuacInstructionParser()
+    count = 0
+    for chunk in chunks(data):
+        parser.feed(chunk)
+        for _ in parser.instructions():
+            count += 1
+    return count
+
+
+def run(name, func, data, rounds):
+    best = None
+    count = 0
+    for _ in range(rounds):
+        started = time.perf_counter()
+        count = func(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    throughput = len(data) / best / (1024 * 1024)
+    print(f"{name:<12} {count:>8} 條指令  {best * 1000:>9.1f} ms  {throughput:>8.1f} MB/s")
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            traffic = f.read()
+    else:
+        traffic = synthetic_rdp_traffic()
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print(f"數據量: {len(traffic) / (1024 * 1024):.1f} MB, 分塊大小: {CHUNK_SIZE}")
+    legacy_count = run('legacy', legacy_parse, traffic, rounds)
+    incremental_count = run('incremental', incremental_parse, traffic, rounds)
+    if legacy_count != incremental_count:
+        print(f"注意: 舊解析器在含 ';' 的值上切分錯誤 ({legacy_count} != {incremental_count})")
@@ -1,4 +1,5 @@
 import os
+import re
 import json
 import shutil
 import socket
@@ -10,13 +11,37 @@ import base64
 import requests
 import time
 import uuid
+import functools
+import hashlib
+import bisect
+import heapq
+import csv
+import io
 import threading
 import select
+import struct
+import multiprocessing
+import sqlite3
+import stat
+import tempfile
+from abc import ABC, abstractmethod
 from base64 import b64encode
+from collections import deque, OrderedDict, Counter
+from datetime import timedelta
 from urllib.parse import urljoin
 from aiohttp import web
 from aiohttp_jinja2 import template
 
+try:
+    import aiomysql  # 可選：直接訪問 Guacamole MySQL 數據庫
+except ImportError:
+    aiomysql = None
+
+try:
+    import resource  # 工作進程負載統計，僅類 Unix 系統可用
+except ImportError:
+    resource = None
+
 import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
@@ -29,12 +54,1452 @@ guacamole_container = None
 mysql_container = None
 plugin_root = None
 session_manager = None
+token_cache = None
+rest_client = None
+connection_cache = None
+connection_index = None
+database = None
+analytics = None
+script_compiler = None
+script_jobs = None
 
 # Guacamole 配置
 GUAC_URL = "http://localhost:8080/guacamole/"
 GUACD_HOST = "localhost"
 GUACD_PORT = 4822
 DATA_SOURCE = "mysql"
+GUAC_USERNAME = "guacadmin"
+GUAC_PASSWORD = "guacadmin"
+
+# Guacamole REST 客戶端連接池
+GUAC_HTTP_SETTINGS = {
+    'total_timeout': 15,      # 單次請求總超時(秒)
+    'connect_timeout': 5,
+    'pool_size': 20,          # 連接池大小
+    'keepalive_timeout': 30,
+    'max_concurrency': 16,    # 同時進行的請求上限
+}
+
+# Guacamole API 令牌緩存
+GUAC_TOKEN_CACHE = {
+    'ttl': 30 * 60,         # 令牌有效期(秒)，需小於 Guacamole 的 api-session-timeout
+    'refresh_margin': 60,   # 到期前多少秒開始刷新
+}
+
+# 直接訪問 Guacamole MySQL 數據庫(需安裝 aiomysql)，未啟用或連接失敗時使用 REST API
+GUAC_DATABASE = {
+    'enabled': False,
+    'host': '127.0.0.1',
+    'port': 3306,
+    'user': 'guacamole_user',
+    'password': 'guacamole_pass',
+    'db': 'guacamole_db',
+    'minsize': 1,
+    'maxsize': 10,
+    'batch_size': 100,   # 批量創建時每個事務寫入的連接數
+}
+
+# 連接使用統計(需啟用數據庫後端)
+GUAC_ANALYTICS = {
+    'max_session_hours': 24,      # 查詢重疊會話時向前回溯的時長，更長的已結束會話不計入並發峰值
+    'retention_hours': 24 * 31,   # 內存中保留的小時匯總數，亦為可查詢的最大窗口
+    'busiest_hours': 10,
+}
+
+# 連接詳情(協議與參數)緩存
+GUAC_CONNECTION_CACHE = {
+    'ttl': 300,           # 緩存有效期(秒)
+    'max_entries': 512,   # 超出時淘汰最久未使用的連接
+}
+# 連接列表快照
+GUAC_CONNECTION_LIST = {
+    'refresh_interval': 30,   # 快照超過此時間(秒)後在後台刷新
+}
+# 會話空閒過期
+SESSION_EXPIRY = {
+    'idle_timeout': 300,         # 默認空閒超時(秒)，可按會話單獨設置
+    'expiring_soon_window': 60,  # 統計「即將過期」會話的時間窗口(秒)
+    'touch_granularity': 1.0,    # 截止時間變化小於此值時不重新入堆
+}
+# 會話准入控制
+SESSION_ADMISSION = {
+    'max_sessions': 50,       # 全局同時打開的 guacd 會話上限
+    'max_per_host': 4,        # 每個目標主機的會話上限
+    'max_queue': 100,         # 等待隊列上限，超出時立即拒絕(429)
+    'queue_timeout': 30,      # 排隊等待上限(秒)
+    'connect_timeout': 20,    # 獲准後建立連接的超時(秒)
+}
+# 熱門連接的預熱會話池
+WARM_POOL = {
+    'size': 2,               # 預熱會話總數上限，同時計入會話准入的全局名額
+    'connections': [],       # 始終預熱的連接ID
+    'hot_threshold': 3,      # 時間窗口內使用次數達到此值的連接視為熱門
+    'hot_window': 600,       # 統計使用次數的時間窗口(秒)
+    'max_idle': 900,         # 預熱會話未被取用的最長保留時間(秒)
+    'refill_delay': 1.0,     # 取用後延遲多久開始補充(秒)
+}
+def default_runtime_dir(name):
+    """每用戶的運行時目錄：優先放在 $XDG_RUNTIME_DIR 下，否則為臨時目錄下帶用戶ID後綴的目錄"""
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, name)
+    if hasattr(os, 'getuid'):
+        name = f'{name}-{os.getuid()}'
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def ensure_private_dir(path):
+    """以 0700 創建 IPC 目錄；已存在的目錄不屬於當前用戶或組/其他用戶可寫時拒絕使用，避免 socket 被搶佔"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if not hasattr(os, 'getuid'):
+        return path
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{path} 不是目錄")
+    if info.st_uid != os.getuid():
+        raise PermissionError(f"{path} 不屬於當前用戶 (uid {info.st_uid})")
+    if info.st_mode & 0o022:
+        raise PermissionError(f"{path} 可被組或其他用戶寫入 (權限 {oct(stat.S_IMODE(info.st_mode))})")
+    return path
+
+
+# 可選的會話工作進程池：每個進程持有一部分會話，主進程只做路由
+SESSION_WORKERS = {
+    'enabled': False,
+    'count': 2,
+    'socket_dir': default_runtime_dir('guacaldera-workers'),  # 必須只有當前用戶可寫
+    'start_timeout': 20,     # 等待工作進程監聽 Unix socket 的時間(秒)
+    'request_timeout': 60,   # 單個 IPC 請求的超時(秒)，腳本執行不受此限制
+    'stats_interval': 5,     # 輪詢工作進程負載並清理過期路由的間隔(秒)
+    'sink_queue': 64,        # 每個查看者未被主進程確認的幀數上限，超出時由工作進程的出站隊列丟棄圖像
+}
+# 多個 Caldera 實例共享的會話註冊表，避免同一連接在不同進程中重複登錄
+SESSION_REGISTRY = {
+    'backend': 'local',      # local: 僅本進程；sqlite: 同一主機上的多個實例共享
+    'path': os.path.join(default_runtime_dir('guacaldera-instances'), 'sessions.db'),  # 所在目錄必須只有當前用戶可寫
+    'socket_dir': default_runtime_dir('guacaldera-instances'),
+    'heartbeat': 5,          # 實例心跳間隔(秒)
+    'stale_after': 20,       # 心跳超過此時間的實例視為失聯，其會話可被接管(秒)
+}
+# 腳本中可用的按鍵名稱 (X11 keysym)，單個字符直接按其 Unicode 編碼
+KEYSYMS = {
+    'return': 0xFF0D, 'enter': 0xFF0D,
+    'tab': 0xFF09,
+    'escape': 0xFF1B, 'esc': 0xFF1B,
+    'space': 0x0020,
+    'backspace': 0xFF08,
+    'delete': 0xFFFF, 'del': 0xFFFF,
+    'insert': 0xFF63,
+    'home': 0xFF50, 'end': 0xFF57,
+    'pageup': 0xFF55, 'pagedown': 0xFF56,
+    'left': 0xFF51, 'up': 0xFF52, 'right': 0xFF53, 'down': 0xFF54,
+    'shift': 0xFFE1, 'ctrl': 0xFFE3, 'alt': 0xFFE9, 'win': 0xFFEB,
+    'printscreen': 0xFF61,
+    **{f'f{index}': 0xFFBE + index - 1 for index in range(1, 13)},
+}
+
+# 預定義腳本，腳本中以 "script <名稱>" 引用
+SCRIPT_LIBRARY = {
+    'open_cmd': "key win r\nwait 0.5\ntype cmd\nwait 0.2\nkey return",
+    'screenshot': "key win shift s",
+    'browser': "key win r\nwait 0.5\ntype chrome\nwait 0.2\nkey return",
+    'notepad': "key win r\nwait 0.5\ntype notepad\nwait 0.2\nkey return",
+    'explorer': "key win e",
+}
+SCRIPT_LIBRARY['open_notepad'] = SCRIPT_LIBRARY['notepad']
+SCRIPT_LIBRARY['take_screenshot'] = SCRIPT_LIBRARY['screenshot']
+
+SCRIPT_CACHE = {
+    'max_entries': 256,
+}
+
+MOUSE_BUTTONS = {1: 1, 2: 2, 3: 4}  # 腳本中的按鈕編號 -> guacd 按鈕掩碼
+
+BULK_CREATE_CONCURRENCY = 8  # 批量創建連接時同時提交的請求數
+# 異步腳本任務
+SCRIPT_JOBS = {
+    'workers': 8,            # 同時執行任務的工作協程數
+    'per_connection': 1,     # 每個連接同時運行的任務數上限
+    'max_queue': 500,        # 排隊任務數上限，超出時提交返回 429
+    'retention': 3600,       # 已結束任務的保留時間(秒)
+    'max_jobs': 2000,        # 保留的任務總數上限
+}
+# 在多個連接上批量執行同一腳本
+BATCH_SCRIPT = {
+    'concurrency': 16,       # 默認同時執行的連接數
+    'max_concurrency': 64,   # 請求可指定的並發上限
+    'max_hosts': 1000,       # 單次批量的連接數上限
+}
+GUACD_ASYNC_TRANSPORT = True  # 使用事件循環上的 asyncio 傳輸，不再為每個會話啟動線程
+
+# 發往 guacd 的指令節流策略
+GUACD_SEND_PACING = {
+    'flush_interval': 0,         # 合併寫入的刷新間隔(秒)，0 表示每個事件循環 tick 刷新一次
+    'max_batch_bytes': 64 * 1024,  # 緩衝超過此大小時立即刷新
+    'key_interval': 0.05,        # 文本輸入時每次按下/釋放之間的間隔(秒)
+    'mouse_move_interval': 1 / 60,  # 合併鼠標移動的幀間隔(秒)
+}
+
+# guacd sync 指令的確認策略
+# viewer: 等待所有需要渲染的瀏覽器查看者渲染完成後再確認；無查看者(無頭模式)時立即確認
+# immediate: 收到後立即確認
+GUACD_SYNC_ACK = {
+    'policy': 'viewer',
+    'timeout': 1.0,  # 查看者未在此時間內確認時仍向 guacd 確認，避免畫面停滯
+}
+
+# 每個查看者出站隊列的上限，超出時丟棄最舊的圖像更新
+VIEWER_QUEUE_LIMITS = {
+    'max_messages': 2000,
+    'max_bytes': 8 * 1024 * 1024,
+}
+
+# 多個查看者共享一個會話
+VIEWER_SHARING = {
+    'max_controllers': 1,      # 可發送輸入的查看者數，由服務端分配，其餘查看者只讀
+    'snapshot_timeout': 5.0,   # 後加入的查看者經 guacd 加入連接取得當前畫面的超時(秒)
+}
+
+# 握手時發送給 guacd 的客戶端能力
+HANDSHAKE_SETTINGS = {
+    'version': 'VERSION_1_5_0',
+    'size': ('1024', '768', '96'),
+    'audio': (),
+    'video': (),
+    'image': ('image/png', 'image/jpeg'),
+    'timezone': 'Asia/Shanghai',
+}
+
+
+class LatencyStats:
+    """記錄最近的延遲樣本並計算統計值"""
+
+    def __init__(self, max_samples=256):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def record(self, ms):
+        self.samples.append(ms)
+        self.count += 1
+        self.total_ms += ms
+
+    def snapshot(self):
+        if not self.samples:
+            return {'count': self.count}
+        ordered = sorted(self.samples)
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total_ms / self.count, 2),
+            'p50_ms': round(ordered[len(ordered) // 2], 2),
+            'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+            'max_ms': round(ordered[-1], 2),
+        }
+
+
+class GuacamoleAPIError(Exception):
+    """Guacamole REST API 返回非預期狀態碼"""
+
+    def __init__(self, status, message):
+        super().__init__(f"{message}，狀態碼: {status}")
+        self.status = status
+
+
+class GuacamoleRestClient:
+    """插件共用的 Guacamole REST 客戶端：長連接池、超時、並發上限與按端點的延遲統計"""
+
+    ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+    def __init__(self, base_url=GUAC_URL, settings=None):
+        self.base_url = base_url
+        self.settings = {**GUAC_HTTP_SETTINGS, **(settings or {})}
+        self.session = None
+        self.semaphore = asyncio.Semaphore(self.settings['max_concurrency'])
+        self.latency = {}  # 'METHOD path' -> LatencyStats
+        self.errors = {}
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.settings['pool_size'],
+                                             keepalive_timeout=self.settings['keepalive_timeout'])
+            timeout = aiohttp.ClientTimeout(total=self.settings['total_timeout'],
+                                            connect=self.settings['connect_timeout'])
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    def _endpoint(self, method, path):
+        # 連接ID等數字路徑段歸為同一端點統計
+        return f"{method} {self.ID_SEGMENT.sub('/{id}', path.split('?')[0])}"
+
+    async def request(self, method, path, **kwargs):
+        """發送請求並返回 (狀態碼, JSON 或文本內容)"""
+        endpoint = self._endpoint(method, path)
+        async with self.semaphore:
+            started = time.perf_counter()
+            try:
+                async with self._session().request(method, urljoin(self.base_url, path), **kwargs) as response:
+                    if response.content_type == 'application/json':
+                        body = await response.json()
+                    else:
+                        body = await response.text()
+                    status = response.status
+            except Exception:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                raise
+            finally:
+                self.latency.setdefault(endpoint, LatencyStats()).record((time.perf_counter() - started) * 1000)
+        return status, body
+
+    def stats(self):
+        return {endpoint: {**latency.snapshot(), 'errors': self.errors.get(endpoint, 0)}
+                for endpoint, latency in self.latency.items()}
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+def get_rest_client():
+    """返回插件共用的 REST 客戶端，未啟用插件時按需創建"""
+    global rest_client
+    if rest_client is None:
+        rest_client = GuacamoleRestClient()
+    return rest_client
+
+
+class GuacamoleTokenCache:
+    """按 Guacamole 用戶緩存 API 令牌，到期前刷新，並發過期時只登錄一次"""
+
+    def __init__(self, credentials=None, ttl=None, refresh_margin=None):
+        self.credentials = credentials or {GUAC_USERNAME: GUAC_PASSWORD}
+        self.ttl = ttl if ttl is not None else GUAC_TOKEN_CACHE['ttl']
+        self.refresh_margin = refresh_margin if refresh_margin is not None else GUAC_TOKEN_CACHE['refresh_margin']
+        self.entries = {}  # username -> (token, refresh_at, expires_at)
+        self.locks = {}
+        self.stats = {'hits': 0, 'logins': 0, 'failures': 0, 'invalidations': 0}
+
+    def peek(self, username=GUAC_USERNAME):
+        """返回仍在有效期內的緩存令牌，不觸發登錄"""
+        entry = self.entries.get(username)
+        if entry and time.monotonic() < entry[2]:
+            return entry[0]
+        return None
+
+    async def get_token(self, username=GUAC_USERNAME):
+        entry = self.entries.get(username)
+        now = time.monotonic()
+        lock = self.locks.setdefault(username, asyncio.Lock())
+        if entry and (now < entry[1] or (now < entry[2] and lock.locked())):
+            # 未到刷新時間，或其他調用者正在刷新時沿用尚未過期的令牌
+            self.stats['hits'] += 1
+            return entry[0]
+
+        async with lock:
+            entry = self.entries.get(username)
+            if entry and time.monotonic() < entry[1]:
+                self.stats['hits'] += 1
+                return entry[0]
+            token = await self._login(username)
+            now = time.monotonic()
+            self.entries[username] = (token, now + self.ttl - self.refresh_margin, now + self.ttl)
+            return token
+
+    def invalidate(self, username=GUAC_USERNAME, token=None):
+        """令牌被拒絕時移除緩存；指定 token 時只在其仍為當前令牌時移除"""
+        entry = self.entries.get(username)
+        if entry and (token is None or entry[0] == token):
+            del self.entries[username]
+            self.stats['invalidations'] += 1
+
+    async def _login(self, username):
+        password = self.credentials.get(username)
+        try:
+            status, data = await get_rest_client().request(
+                'POST', 'api/tokens', data={'username': username, 'password': password})
+        except Exception:
+            self.stats['failures'] += 1
+            raise
+        if status != 200:
+            self.stats['failures'] += 1
+            raise GuacamoleAPIError(status, "無法獲取 Guacamole API 令牌")
+        self.stats['logins'] += 1
+        logging.info(f"Guacamole 用戶 {username} 登錄成功，令牌已緩存")
+        return data['authToken']
+
+
+class GuacamoleDatabase:
+    """基於 aiomysql 連接池直接讀寫 Guacamole JDBC 表，列表與批量創建均為單條/多行語句"""
+
+    # 連接表列與 REST API 連接屬性的對應關係
+    ATTRIBUTE_COLUMNS = {
+        'max-connections': 'max_connections',
+        'max-connections-per-user': 'max_connections_per_user',
+        'guacd-hostname': 'proxy_hostname',
+        'guacd-port': 'proxy_port',
+        'weight': 'connection_weight',
+    }
+    CREATOR_PERMISSIONS = ('READ', 'UPDATE', 'DELETE', 'ADMINISTER')
+
+    def __init__(self, settings=None):
+        self.settings = {**GUAC_DATABASE, **(settings or {})}
+        self.pool = None
+
+    async def connect(self):
+        if aiomysql is None:
+            raise RuntimeError('未安裝 aiomysql，無法直接訪問數據庫')
+        self.pool = await aiomysql.create_pool(
+            host=self.settings['host'], port=self.settings['port'],
+            user=self.settings['user'], password=self.settings['password'],
+            db=self.settings['db'], minsize=self.settings['minsize'],
+            maxsize=self.settings['maxsize'], charset='utf8', autocommit=False)
+        logging.info(f"已連接 Guacamole 數據庫 {self.settings['host']}:{self.settings['port']}")
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+    async def fetch_all(self, sql, args=None):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(sql, args)
+                return await cur.fetchall()
+
+    async def list_connections(self):
+        """單條查詢返回與 REST API 相同結構的連接字典"""
+        rows = await self.fetch_all(
+            "SELECT c.connection_id, c.connection_name, c.parent_id, c.protocol,"
+            " c.max_connections, c.max_connections_per_user, c.proxy_hostname, c.proxy_port,"
+            " c.connection_weight, COUNT(h.history_id) AS active_connections"
+            " FROM guacamole_connection c"
+            " LEFT JOIN guacamole_connection_history h"
+            "   ON h.connection_id = c.connection_id AND h.end_date IS NULL"
+            " GROUP BY c.connection_id")
+        connections = {}
+        for row in rows:
+            identifier = str(row['connection_id'])
+            connections[identifier] = {
+                'identifier': identifier,
+                'name': row['connection_name'],
+                'parentIdentifier': str(row['parent_id']) if row['parent_id'] is not None else 'ROOT',
+                'protocol': row['protocol'],
+                'activeConnections': row['active_connections'],
+                'attributes': {attr: (str(row[column]) if row[column] is not None else None)
+                               for attr, column in self.ATTRIBUTE_COLUMNS.items()},
+            }
+        return connections
+
+    async def get_connection_details(self, connection_id):
+        rows = await self.fetch_all(
+            "SELECT c.protocol, p.parameter_name, p.parameter_value"
+            " FROM guacamole_connection c"
+            " LEFT JOIN guacamole_connection_parameter p ON p.connection_id = c.connection_id"
+            " WHERE c.connection_id = %s", (int(connection_id),))
+        if not rows:
+            raise LookupError(f"連接 {connection_id} 不存在")
+        return {
+            'protocol': rows[0]['protocol'],
+            'parameters': {row['parameter_name']: row['parameter_value']
+                           for row in rows if row['parameter_name'] is not None}
+        }
+
+    async def create_connections(self, payloads, owner=GUAC_USERNAME):
+        """在一個事務中寫入連接、參數與創建者權限，返回與 payloads 對應的連接ID"""
+        connection_rows = []
+        for payload in payloads:
+            attributes = payload.get('attributes') or {}
+            parent = payload.get('parentIdentifier')
+            connection_rows.append((
+                payload['name'],
+                None if parent in (None, 'ROOT') else int(parent),
+                payload['protocol'],
+                *(attributes.get(attr) or None for attr in self.ATTRIBUTE_COLUMNS),
+            ))
+        duplicates = [name for (name, parent), count in Counter(row[:2] for row in connection_rows).items()
+                      if count > 1]
+        if duplicates:
+            raise ValueError(f"連接名稱重複: {', '.join(duplicates)}")
+        columns = ', '.join(self.ATTRIBUTE_COLUMNS.values())
+        placeholders = ', '.join(['%s'] * (3 + len(self.ATTRIBUTE_COLUMNS)))
+
+        async with self.pool.acquire() as conn:
+            try:
+                async with conn.cursor() as cur:
+                    # 唯一鍵 (名稱, 父連接組) 不約束 parent_id 為 NULL 的行，根目錄下的重名需自行檢查
+                    root_names = [row[0] for row in connection_rows if row[1] is None]
+                    if root_names:
+                        await cur.execute(
+                            "SELECT connection_name FROM guacamole_connection WHERE parent_id IS NULL"
+                            f" AND connection_name IN ({', '.join(['%s'] * len(root_names))})", root_names)
+                        existing = [row[0] for row in await cur.fetchall()]
+                        if existing:
+                            raise ValueError(f"連接名稱已存在: {', '.join(existing)}")
+
+                    # 逐行插入並以 lastrowid 取得新ID，不依賴名稱回查或自增值連續
+                    connection_ids = []
+                    for row in connection_rows:
+                        await cur.execute(
+                            f"INSERT INTO guacamole_connection (connection_name, parent_id, protocol, {columns})"
+                            f" VALUES ({placeholders})", row)
+                        connection_ids.append(cur.lastrowid)
+
+                    parameter_rows = [(connection_id, key, str(value))
+                                      for connection_id, payload in zip(connection_ids, payloads)
+                                      for key, value in (payload.get('parameters') or {}).items()]
+                    if parameter_rows:
+                        await cur.executemany(
+                            "INSERT INTO guacamole_connection_parameter (connection_id, parameter_name, parameter_value)"
+                            " VALUES (%s, %s, %s)", parameter_rows)
+
+                    await cur.execute(
+                        "SELECT entity_id FROM guacamole_entity WHERE name = %s AND type = 'USER'", (owner,))
+                    entity = await cur.fetchone()
+                    if entity:
+                        await cur.executemany(
+                            "INSERT INTO guacamole_connection_permission (entity_id, connection_id, permission)"
+                            " VALUES (%s, %s, %s)",
+                            [(entity[0], connection_id, permission)
+                             for connection_id in connection_ids
+                             for permission in self.CREATOR_PERMISSIONS])
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        return [str(connection_id) for connection_id in connection_ids]
+
+
+def percentile(ordered, fraction):
+    """最近秩百分位，ordered 需已排序"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class ConnectionAnalytics:
+    """按小時匯總 guacamole_connection_history，已結束的小時只計算一次，刷新時只查詢未定稿的小時"""
+
+    HOUR = timedelta(hours=1)
+
+    def __init__(self, db, settings=None):
+        self.db = db
+        self.settings = {**GUAC_ANALYTICS, **(settings or {})}
+        self.rollups = {}  # 小時起點 -> 匯總
+        self.lock = asyncio.Lock()
+        self.stats = {'queries': 0, 'rows': 0, 'hours_computed': 0}
+
+    async def summary(self, hours):
+        async with self.lock:
+            now = (await self.db.fetch_all("SELECT NOW() AS now"))[0]['now']
+            current = now.replace(minute=0, second=0, microsecond=0)
+            window = [current - self.HOUR * i for i in range(hours - 1, -1, -1)]
+            missing = [hour for hour in window if not self.rollups.get(hour, {}).get('final')]
+            if missing:
+                await self._compute(missing[0], missing[-1] + self.HOUR, now)
+            oldest = current - self.HOUR * self.settings['retention_hours']
+            for hour in [hour for hour in self.rollups if hour < oldest]:
+                del self.rollups[hour]
+            return self._combine(window, now)
+
+    async def _fetch(self, since, until):
+        """取回與 [since, until) 重疊的會話；以 start_date 範圍與 end_date IS NULL 走索引"""
+        lookback = since - timedelta(hours=self.settings['max_session_hours'])
+        rows = await self.db.fetch_all(
+            "SELECT connection_id, connection_name, start_date, end_date FROM guacamole_connection_history"
+            " WHERE start_date >= %s AND start_date < %s AND (end_date IS NULL OR end_date >= %s)"
+            " UNION ALL"
+            " SELECT connection_id, connection_name, start_date, end_date FROM guacamole_connection_history"
+            " WHERE end_date IS NULL AND start_date < %s",
+            (lookback, until, since, lookback))
+        self.stats['queries'] += 1
+        self.stats['rows'] += len(rows)
+        return rows
+
+    async def _compute(self, since, until, now):
+        rows = await self._fetch(since, until)
+        started, overlapping = {}, {}
+        for row in rows:
+            key = str(row['connection_id']) if row['connection_id'] is not None else row['connection_name']
+            start, end = row['start_date'], row['end_date'] or now
+            hour = max(start.replace(minute=0, second=0, microsecond=0), since)
+            while hour < until and hour < end:
+                overlapping.setdefault(hour, []).append((key, max(start, hour), min(end, hour + self.HOUR)))
+                hour += self.HOUR
+            if since <= start < until:
+                started.setdefault(start.replace(minute=0, second=0, microsecond=0), []).append((key, row))
+
+        hour = since
+        while hour < until:
+            sessions, durations, names, final = Counter(), {}, {}, hour + self.HOUR <= now
+            for key, row in started.get(hour, []):
+                sessions[key] += 1
+                names[key] = row['connection_name']
+                if row['end_date'] is None:
+                    final = False  # 會話未結束，時長尚未確定
+                else:
+                    durations.setdefault(key, []).append((row['end_date'] - row['start_date']).total_seconds())
+            peak, connection_peaks = self._peaks(overlapping.get(hour, []))
+            self.rollups[hour] = {'final': final, 'sessions': sessions, 'durations': durations,
+                                  'names': names, 'peak': peak, 'connection_peaks': connection_peaks}
+            self.stats['hours_computed'] += 1
+            hour += self.HOUR
+
+    @staticmethod
+    def _peaks(intervals):
+        """掃描線計算總並發峰值與各連接並發峰值，同一時刻先結束後開始"""
+        events = sorted([(start, 1, key) for key, start, _ in intervals] +
+                        [(end, -1, key) for key, _, end in intervals],
+                        key=lambda event: (event[0], event[1]))
+        active, peak, per_connection, connection_peaks = 0, 0, Counter(), {}
+        for _, delta, key in events:
+            active += delta
+            per_connection[key] += delta
+            peak = max(peak, active)
+            connection_peaks[key] = max(connection_peaks.get(key, 0), per_connection[key])
+        return peak, connection_peaks
+
+    def _combine(self, window, now):
+        sessions, durations, names, connection_peaks = Counter(), {}, {}, {}
+        hour_of_day = [0] * 24
+        hourly = []
+        peak = {'value': 0, 'hour': None}
+        for hour in window:
+            rollup = self.rollups.get(hour)
+            if rollup is None:
+                continue
+            count = sum(rollup['sessions'].values())
+            sessions.update(rollup['sessions'])
+            names.update(rollup['names'])
+            for key, values in rollup['durations'].items():
+                durations.setdefault(key, []).extend(values)
+            for key, value in rollup['connection_peaks'].items():
+                connection_peaks[key] = max(connection_peaks.get(key, 0), value)
+            hour_of_day[hour.hour] += count
+            hourly.append((count, hour))
+            if rollup['peak'] > peak['value']:
+                peak = {'value': rollup['peak'], 'hour': hour.strftime('%Y-%m-%d %H:00')}
+
+        connections = {}
+        for key in set(sessions) | set(connection_peaks):
+            ordered = sorted(durations.get(key, []))
+            connections[key] = {
+                'name': names.get(key),
+                'sessions': sessions.get(key, 0),
+                'total_duration_s': round(sum(ordered), 1),
+                'p50_duration_s': percentile(ordered, 0.5),
+                'p95_duration_s': percentile(ordered, 0.95),
+                'peak_concurrent': connection_peaks.get(key, 0),
+            }
+        all_durations = sorted(value for values in durations.values() for value in values)
+        busiest = sorted(hourly, key=lambda item: (-item[0], item[1]))[:self.settings['busiest_hours']]
+        return {
+            'window': {'since': window[0].strftime('%Y-%m-%d %H:00'), 'until': now.strftime('%Y-%m-%d %H:%M:%S')},
+            'total_sessions': sum(sessions.values()),
+            'connections': connections,
+            'peak_concurrent': peak,
+            'duration_percentiles_s': {f'p{int(f * 100)}': percentile(all_durations, f)
+                                       for f in (0.5, 0.9, 0.95, 0.99)},
+            'busiest_hours': [{'hour': hour.strftime('%Y-%m-%d %H:00'), 'sessions': count}
+                              for count, hour in busiest if count],
+            'sessions_by_hour_of_day': hour_of_day,
+        }
+
+
+async def create_database():
+    """按配置創建數據庫後端，未啟用或不可用時返回 None"""
+    if not GUAC_DATABASE['enabled']:
+        return None
+    try:
+        backend = GuacamoleDatabase()
+        await backend.connect()
+        return backend
+    except Exception as e:
+        logging.error(f"無法連接 Guacamole 數據庫，改用 REST API: {e}")
+        return None
+
+
+class ConnectionDetailsCache:
+    """按連接ID緩存協議與參數，帶 TTL 與 LRU 淘汰，並發未命中時只請求一次"""
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else GUAC_CONNECTION_CACHE['ttl']
+        self.max_entries = max_entries or GUAC_CONNECTION_CACHE['max_entries']
+        self.entries = OrderedDict()  # connection_id -> (details, expires_at)
+        self.loading = {}
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def _copy(details):
+        # 調用方可能修改參數字典，返回副本避免污染緩存
+        return {'protocol': details['protocol'], 'parameters': dict(details['parameters'])}
+
+    def get(self, connection_id):
+        connection_id = str(connection_id)
+        entry = self.entries.get(connection_id)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[1]:
+            del self.entries[connection_id]
+            return None
+        self.entries.move_to_end(connection_id)
+        return self._copy(entry[0])
+
+    def put(self, connection_id, details):
+        connection_id = str(connection_id)
+        self.entries[connection_id] = (self._copy(details), time.monotonic() + self.ttl)
+        self.entries.move_to_end(connection_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    async def get_or_load(self, connection_id, loader):
+        """命中時直接返回，否則調用 loader() 獲取並緩存；同一連接的並發請求共用一次加載"""
+        details = self.get(connection_id)
+        if details is not None:
+            self.counters['hits'] += 1
+            return details
+        connection_id = str(connection_id)
+        pending = self.loading.get(connection_id)
+        if pending is not None:
+            self.counters['hits'] += 1
+        else:
+            # 加載在獨立任務中進行，任一調用者被取消不影響其他等待者
+            self.counters['misses'] += 1
+            pending = asyncio.create_task(self._load(connection_id, loader))
+            self.loading[connection_id] = pending
+            pending.add_done_callback(functools.partial(settle_single_flight, self.loading, connection_id))
+        return self._copy(await asyncio.shield(pending))
+
+    async def _load(self, connection_id, loader):
+        details = await loader()
+        self.put(connection_id, details)
+        return details
+
+    def invalidate(self, connection_id=None):
+        """連接被創建或修改時移除緩存；不指定ID時清空全部"""
+        if connection_id is None:
+            self.counters['invalidations'] += len(self.entries)
+            self.entries.clear()
+        elif self.entries.pop(str(connection_id), None) is not None:
+            self.counters['invalidations'] += 1
+
+    def stats(self):
+        return {**self.counters, 'entries': len(self.entries)}
+
+
+def settle_single_flight(pending, key, task):
+    """單次加載任務結束時移除登記；無人等待時取回異常，避免未取回異常的警告"""
+    if pending.get(key) is task:
+        del pending[key]
+    if not task.cancelled():
+        task.exception()
+
+
+def get_connection_cache():
+    """返回插件共用的連接詳情緩存，未啟用插件時按需創建"""
+    global connection_cache
+    if connection_cache is None:
+        connection_cache = ConnectionDetailsCache()
+    return connection_cache
+
+
+class ConnectionIndex:
+    """連接列表的緩存快照，按協議、父連接組與名稱前綴建立索引，過期後在後台刷新"""
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = refresh_interval if refresh_interval is not None else GUAC_CONNECTION_LIST['refresh_interval']
+        self.connections = {}
+        self.ordered_ids = []     # 按名稱排序的連接ID，保證分頁穩定
+        self.name_keys = []       # (小寫名稱, 連接ID) 有序列表，用於前綴二分查找
+        self.by_protocol = {}
+        self.by_parent = {}
+        self.etag = None
+        self.fetched_at = None
+        self.stale = True
+        self.lock = asyncio.Lock()
+        self.refresh_task = None
+        self.stats = {'refreshes': 0, 'background_refreshes': 0, 'failures': 0}
+
+    async def snapshot(self):
+        """返回可用的快照：首次或被標記失效時同步刷新，僅過期時先返回舊快照並在後台刷新"""
+        if self.fetched_at is None or self.stale:
+            async with self.lock:
+                if self.fetched_at is None or self.stale:
+                    await self._refresh()
+        elif time.monotonic() - self.fetched_at > self.refresh_interval:
+            if self.refresh_task is None or self.refresh_task.done():
+                self.refresh_task = asyncio.create_task(self._background_refresh())
+        return self
+
+    async def _background_refresh(self):
+        async with self.lock:
+            if time.monotonic() - self.fetched_at <= self.refresh_interval:
+                return
+            try:
+                await self._refresh()
+                self.stats['background_refreshes'] += 1
+            except Exception as e:
+                logging.error(f"後台刷新連接列表失敗: {e}")
+
+    async def _refresh(self):
+        if database:
+            try:
+                connections = await database.list_connections()
+            except Exception:
+                self.stats['failures'] += 1
+                raise
+        else:
+            status, connections = await guacamole_request('GET', f'api/session/data/{DATA_SOURCE}/connections')
+            if status != 200:
+                self.stats['failures'] += 1
+                raise GuacamoleAPIError(status, "無法獲取連接列表")
+        self._build(connections or {})
+        self.stats['refreshes'] += 1
+
+    def _build(self, connections):
+        name_keys = sorted(((conn.get('name') or '').lower(), str(conn_id)) for conn_id, conn in connections.items())
+        by_protocol, by_parent = {}, {}
+        for conn_id, conn in connections.items():
+            by_protocol.setdefault(conn.get('protocol'), set()).add(str(conn_id))
+            by_parent.setdefault(conn.get('parentIdentifier'), set()).add(str(conn_id))
+        self.connections = {str(conn_id): conn for conn_id, conn in connections.items()}
+        self.name_keys = name_keys
+        self.ordered_ids = [conn_id for _, conn_id in name_keys]
+        self.by_protocol = by_protocol
+        self.by_parent = by_parent
+        self.etag = hashlib.sha1(json.dumps(connections, sort_keys=True).encode()).hexdigest()
+        self.fetched_at = time.monotonic()
+        self.stale = False
+
+    def invalidate(self):
+        """連接被創建或修改後，下一次讀取同步刷新"""
+        self.stale = True
+
+    def query(self, protocol=None, name_prefix=None, parent=None):
+        """返回符合條件的連接ID(按名稱排序)"""
+        if name_prefix:
+            key = name_prefix.lower()
+            lo = bisect.bisect_left(self.name_keys, (key,))
+            hi = bisect.bisect_left(self.name_keys, (key + '\uffff',))
+            ids = [conn_id for _, conn_id in self.name_keys[lo:hi]]
+        else:
+            ids = self.ordered_ids
+        for index, value in ((self.by_protocol, protocol), (self.by_parent, parent)):
+            if value is not None:
+                allowed = index.get(value, ())
+                ids = [conn_id for conn_id in ids if conn_id in allowed]
+        return ids
+
+
+def get_connection_index():
+    """返回插件共用的連接列表快照，未啟用插件時按需創建"""
+    global connection_index
+    if connection_index is None:
+        connection_index = ConnectionIndex()
+    return connection_index
+
+
+class GuacInstructionParser:
+    """增量式 Guacamole 指令解析器，直接在 bytearray 上依長度前綴解析"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._start = 0       # 當前指令在緩衝區中的起始位置
+        self._last_start = 0  # 上一條完整指令的起始位置
+        self._offset = 0      # 當前指令已解析到的位置
+        self._elements = []   # 當前指令已解析完成的元素
+
+    def feed(self, data):
+        """追加從 guacd 收到的原始數據"""
+        self.buffer.extend(data)
+
+    def __len__(self):
+        return len(self.buffer) - self._start
+
+    def instructions(self):
+        """逐條產生已完整接收的 (opcode, args)"""
+        while True:
+            instruction = self._next_instruction()
+            if instruction is None:
+                break
+            yield instruction
+        self._compact()
+
+    def _next_instruction(self):
+        buf = self.buffer
+        buf_len = len(buf)
+        find = buf.find
+        elements = self._elements
+        offset = self._offset
+        with memoryview(buf) as view:
+            while True:
+                dot_pos = find(b'.', offset)
+                if dot_pos == -1:
+                    if buf_len - offset > 20:
+                        raise ValueError(f"無效的長度前綴: {bytes(buf[offset:offset + 20])!r}")
+                    break
+                try:
+                    length = int(buf[offset:dot_pos])
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    raise ValueError(f"無效的長度前綴: {bytes(buf[offset:dot_pos])!r}")
+
+                # 長度以 Unicode 字元計算，非 ASCII 時需要向後擴展
+                start = dot_pos + 1
+                end = start + length
+                while end < buf_len:
+                    try:
+                        value = str(view[start:end], 'utf-8')
+                    except UnicodeDecodeError:
+                        end += 1
+                        continue
+                    if len(value) == length:
+                        break
+                    end += length - len(value)
+                else:
+                    break
+
+                terminator = buf[end]
+                elements.append(value)
+                offset = end + 1
+                if terminator == 0x2C:  # ','
+                    continue
+                if terminator != 0x3B:  # ';'
+                    raise ValueError(f"無效的指令分隔符: {chr(terminator)!r}")
+
+                self._elements = []
+                self._last_start = self._start
+                self._offset = self._start = offset
+                return elements[0], tuple(elements[1:])
+
+        # 指令尚未完整，保留已解析的元素等待更多數據
+        self._offset = offset
+        return None
+
+    def last_raw(self):
+        """返回上一條產生的指令的原始字節，僅在迭代 instructions() 期間有效"""
+        return bytes(self.buffer[self._last_start:self._start])
+
+    def _compact(self):
+        if self._start:
+            del self.buffer[:self._start]
+            self._offset -= self._start
+            self._start = 0
+            self._last_start = 0
+
+    def reset(self):
+        self.buffer.clear()
+        self._start = 0
+        self._last_start = 0
+        self._offset = 0
+        self._elements = []
+
+
+class GuacOutboundQueue:
+    """會話的出站緩衝，將同一 tick 內的多條指令合併為一次寫入"""
+
+    def __init__(self, write, pacing=None):
+        pacing = pacing or GUACD_SEND_PACING
+        self._write = write
+        self.flush_interval = pacing.get('flush_interval', 0)
+        self.max_batch_bytes = pacing.get('max_batch_bytes', 64 * 1024)
+        self.buffer = bytearray()
+        self._flush_handle = None
+        self.stats = {'instructions': 0, 'writes': 0, 'bytes': 0}
+
+    def put(self, data):
+        self.buffer.extend(data)
+        self.stats['instructions'] += 1
+        if len(self.buffer) >= self.max_batch_bytes:
+            self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self.flush_interval > 0:
+                self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+            else:
+                self._flush_handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            self.stats['writes'] += 1
+            self.stats['bytes'] += len(data)
+            self._write(data)
+
+    def clear(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.buffer.clear()
+
+
+def first_argument(args, payload):
+    """返回指令的第一個參數；轉發模式下 args 為 None，從原始字節 <len>.<opcode>,<len>.<arg> 中取出"""
+    if args:
+        return args[0]
+    try:
+        text = payload[:64].decode('utf-8', errors='ignore')
+        element = text.split(',', 2)[1]
+        return element.split('.', 1)[1].rstrip(';')
+    except IndexError:
+        return None
+
+
+class ViewerOutputQueue:
+    """查看者的有界出站隊列，溢出時丟棄過期的圖像更新，保留控制與 sync 指令"""
+
+    IMAGE_OPCODES = frozenset(('png', 'jpeg', 'webp', 'img', 'blob', 'end'))
+    STREAM_OPCODES = frozenset(('img', 'blob', 'end'))
+
+    def __init__(self, ws, mode='json', limits=None):
+        limits = limits or VIEWER_QUEUE_LIMITS
+        self.ws = ws
+        self.mode = mode
+        self.max_messages = limits.get('max_messages', 2000)
+        self.max_bytes = limits.get('max_bytes', 8 * 1024 * 1024)
+        self.queue = deque()  # (opcode, stream_index, payload)
+        self.queued_bytes = 0
+        self.dropped_streams = set()
+        self.counters = {'sent': 0, 'sent_bytes': 0, 'dropped': 0, 'dropped_bytes': 0}
+        self.closed = False
+        self.read_only = False
+        self._wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._sender())
+
+    def put(self, opcode, args, payload):
+        if self.closed:
+            return
+        stream = self._stream_index(opcode, args, payload)
+        if stream is not None and stream in self.dropped_streams:
+            # 該圖像流已被丟棄，後續數據一併丟棄
+            if opcode == 'end':
+                self.dropped_streams.discard(stream)
+            self._count_drop(payload)
+            return
+        self.queue.append((opcode, stream, payload))
+        self.queued_bytes += len(payload)
+        if len(self.queue) > self.max_messages or self.queued_bytes > self.max_bytes:
+            self._shed()
+        self._wakeup.set()
+
+    def _stream_index(self, opcode, args, payload):
+        if opcode not in self.STREAM_OPCODES:
+            return None
+        return first_argument(args, payload)
+
+    def _shed(self):
+        while len(self.queue) > self.max_messages or self.queued_bytes > self.max_bytes:
+            victim = None
+            for index, (opcode, stream, _) in enumerate(self.queue):
+                if opcode in self.IMAGE_OPCODES:
+                    victim = index
+                    break
+            if victim is None:
+                # 只剩控制指令時不再丟棄
+                return
+            opcode, stream, payload = self.queue[victim]
+            del self.queue[victim]
+            self.queued_bytes -= len(payload)
+            self._count_drop(payload)
+            if stream is not None:
+                self._drop_stream(stream, opcode)
+
+    def _drop_stream(self, stream, dropped_opcode):
+        kept = deque()
+        stream_ended = dropped_opcode == 'end'
+        for entry in self.queue:
+            if entry[1] == stream:
+                self.queued_bytes -= len(entry[2])
+                self._count_drop(entry[2])
+                stream_ended = stream_ended or entry[0] == 'end'
+            else:
+                kept.append(entry)
+        self.queue = kept
+        if not stream_ended:
+            self.dropped_streams.add(stream)
+
+    def _count_drop(self, payload):
+        self.counters['dropped'] += 1
+        self.counters['dropped_bytes'] += len(payload)
+
+    async def _sender(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                if self.ws.closed:
+                    self.close()
+                    break
+                if self.mode == 'relay':
+                    frames = [entry[2] for entry in self.queue]
+                    self.queue.clear()
+                    self.queued_bytes = 0
+                    frame = b''.join(frames)
+                    await self.ws.send_bytes(frame)
+                    self.counters['sent'] += len(frames)
+                    self.counters['sent_bytes'] += len(frame)
+                else:
+                    _, _, payload = self.queue.popleft()
+                    self.queued_bytes -= len(payload)
+                    await self.ws.send_str(payload)
+                    self.counters['sent'] += 1
+                    self.counters['sent_bytes'] += len(payload)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.warning(f"查看者出站隊列發送失敗: {type(e).__name__} - {str(e)}")
+            self.close()
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'depth': len(self.queue),
+            'queued_bytes': self.queued_bytes,
+            **self.counters,
+        }
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        if not self.task.done() and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class ViewerHub:
+    """會話的查看者扇出中心：每條 guacd 指令只解析與編碼一次，再放入各查看者自己的出站隊列"""
+
+    def __init__(self, automator):
+        self.automator = automator
+        self.loop = asyncio.get_running_loop()
+        self.viewers = automator.viewer_queues  # viewer_id -> ViewerOutputQueue
+        self.last_size = None  # 最近一次默認圖層的 size 指令，表示會話已有畫面
+        self.snapshots = {}  # viewer_id -> 取得畫面快照期間暫存的實時指令
+
+    def subscribe(self, viewer_id, ws, mode='json', read_only=False, sync_ack=False):
+        self.unsubscribe(viewer_id)
+        queue = ViewerOutputQueue(ws, mode)
+        # 控制權由服務端分配：客戶端只能主動選擇只讀，控制者名額已滿時其餘查看者只讀
+        controllers = sum(1 for viewer in self.viewers.values() if not viewer.read_only)
+        queue.read_only = bool(read_only) or controllers >= VIEWER_SHARING['max_controllers']
+        self.viewers[viewer_id] = queue
+        # 只讀查看者不參與 sync 確認，避免旁觀者拖慢 guacd 的發送節奏
+        sync_ack = sync_ack and not queue.read_only
+        if self.last_size:
+            # 會話已有畫面：取得當前完整畫面後再接上實時指令，期間的實時指令先暫存
+            self.snapshots[viewer_id] = []
+            asyncio.create_task(self._replay_snapshot(viewer_id, queue, sync_ack))
+        elif sync_ack:
+            self.automator.attach_sync_viewer(viewer_id)
+        self._update_posters()
+        return queue
+
+    async def _replay_snapshot(self, viewer_id, queue, sync_ack):
+        try:
+            instructions, cut = await asyncio.wait_for(self.automator.capture_display(),
+                                                       VIEWER_SHARING['snapshot_timeout'])
+        except Exception as e:
+            logging.warning(f"取得畫面快照失敗，查看者 {viewer_id} 只收到畫布尺寸: {type(e).__name__} - {e}")
+            instructions, cut = [('size', self.last_size)], None
+        held = self.snapshots.pop(viewer_id, None)
+        if held is None or self.viewers.get(viewer_id) is not queue:
+            return
+        for opcode, args in instructions:
+            self._put(queue, opcode, args)
+        if cut is not None:
+            # 快照截至 guacd 廣播的 sync，此前的實時指令已包含在快照中
+            for index, (opcode, args, payload) in enumerate(held):
+                if opcode == 'sync' and first_argument(args, payload) == cut:
+                    del held[:index + 1]
+                    break
+        for entry in held:
+            queue.put(*entry)
+        if sync_ack:
+            self.automator.attach_sync_viewer(viewer_id)
+
+    def unsubscribe(self, viewer_id):
+        self.automator.detach_sync_viewer(viewer_id)
+        self.snapshots.pop(viewer_id, None)
+        queue = self.viewers.pop(viewer_id, None)
+        if queue:
+            queue.close()
+            self._update_posters()
+
+    def is_read_only(self, viewer_id):
+        queue = self.viewers.get(viewer_id)
+        return bool(queue is None or queue.read_only)
+
+    def _update_posters(self):
+        modes = {queue.mode for queue in self.viewers.values()}
+        self.automator.instruction_poster_func = self._post_json if 'json' in modes else None
+        self.automator.relay_poster_func = self._post_relay if 'relay' in modes else None
+
+    def _put(self, queue, opcode, args):
+        if queue.mode == 'relay':
+            queue.put(opcode, None, self.automator._encode_instruction(opcode, *args).encode('utf-8'))
+        else:
+            queue.put(opcode, args, self._encode_json(opcode, args))
+
+    @staticmethod
+    def _encode_json(opcode, args):
+        return json.dumps({
+            'type': 'guac-instruction',
+            'opcode': opcode,
+            'args': list(args)
+        })
+
+    def _post_json(self, opcode, args):
+        self._dispatch('json', opcode, args, self._encode_json(opcode, args))
+
+    def _post_relay(self, opcode, raw):
+        self._dispatch('relay', opcode, None, raw)
+
+    def _dispatch(self, mode, opcode, args, payload):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._deliver(mode, opcode, args, payload)
+        else:
+            self.loop.call_soon_threadsafe(self._deliver, mode, opcode, args, payload)
+
+    def _deliver(self, mode, opcode, args, payload):
+        for viewer_id, queue in list(self.viewers.items()):
+            if queue.mode == mode:
+                held = self.snapshots.get(viewer_id)
+                if held is not None:
+                    held.append((opcode, args, payload))
+                else:
+                    queue.put(opcode, args, payload)
+
+    def close(self):
+        for viewer_id in list(self.viewers):
+            self.unsubscribe(viewer_id)
+
+
+class ScriptError(ValueError):
+    """腳本編譯失敗，帶出錯的行號"""
+
+    def __init__(self, line_number, message):
+        super().__init__(f"第 {line_number} 行: {message}")
+        self.line_number = line_number
+
+
+class CompiledLine:
+    """編譯後的一行腳本：ops 中 bytes 為預編碼的 guacd 指令，float 為等待秒數"""
+
+    __slots__ = ('number', 'text', 'ops', 'move', 'button_mask', 'release')
+
+    def __init__(self, number, text):
+        self.number = number
+        self.text = text
+        self.ops = []
+        self.move = None          # 單獨的鼠標移動，交互執行時走合併發送
+        self.button_mask = None   # 執行後的鼠標按鈕狀態，None 表示未改變
+        self.release = {}         # 中途取消時需要補發的釋放指令，避免按鍵或按鈕停留在按下狀態
+
+    def send(self, data):
+        # 相鄰指令合併為一個緩衝，執行時一次寫入
+        if self.ops and self.ops[-1].__class__ is bytes:
+            self.ops[-1] += data
+        else:
+            self.ops.append(data)
+
+    def wait(self, seconds):
+        if seconds <= 0:
+            return
+        if self.ops and self.ops[-1].__class__ is float:
+            self.ops[-1] += seconds
+        else:
+            self.ops.append(float(seconds))
+
+
+class CompiledScript:
+    __slots__ = ('digest', 'lines')
+
+    def __init__(self, digest, lines):
+        self.digest = digest
+        self.lines = lines
+
+
+class ScriptCompiler:
+    """唯一的腳本解析器：把腳本文本編譯為預解析按鍵、預編碼指令的操作序列，按內容哈希緩存"""
+
+    MAX_DEPTH = 4
+
+    def __init__(self, settings=None):
+        self.settings = {**SCRIPT_CACHE, **(settings or {})}
+        self.cache = OrderedDict()  # sha256 -> CompiledScript
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def compile(self, text, cache=True):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        script = self.cache.get(digest)
+        if script is not None:
+            self.cache.move_to_end(digest)
+            self.stats['hits'] += 1
+            return script
+        self.stats['misses'] += 1
+        lines = []
+        mask = 0
+        for number, raw in enumerate(text.split('\n'), 1):
+            stripped = raw.strip()
+            if not stripped or stripped.startswith('#'):
+                continue
+            line = CompiledLine(number, stripped)
+            mask = self._compile_line(line, stripped, mask, 0)
+            lines.append(line)
+        script = CompiledScript(digest, lines)
+        if cache:
+            self.cache[digest] = script
+            if len(self.cache) > self.settings['max_entries']:
+                self.cache.popitem(last=False)
+                self.stats['evictions'] += 1
+        return script
+
+    def _compile_line(self, line, text, mask, depth):
+        parts = text.split()
+        op = parts[0].lower()
+        args = parts[1:]
+        try:
+            if op == 'key':
+                self._compile_key(line, args)
+            elif op in ('keydown', 'keyup'):
+                if len(args) != 1:
+                    raise ValueError(f"{op} 需要一個按鍵名稱")
+                line.send(self.encode('key', self.keysym(args[0]), 1 if op == 'keydown' else 0))
+            elif op == 'type':
+                if len(parts) < 2:
+                    raise ValueError("type 需要文本")
+                self._compile_type(line, text.split(None, 1)[1])
+            elif op == 'wait':
+                if len(args) != 1:
+                    raise ValueError("wait 需要秒數")
+                seconds = float(args[0])
+                if seconds < 0:
+                    raise ValueError("等待時間不能為負數")
+                line.wait(seconds)
+            elif op == 'mouse':
+                mask = self._compile_mouse(line, args, mask)
+            elif op == 'script':
+                if len(args) != 1 or args[0].lower() not in SCRIPT_LIBRARY:
+                    raise ValueError(f"未知的預定義腳本: {' '.join(args)}")
+                if depth >= self.MAX_DEPTH:
+                    raise ValueError("預定義腳本嵌套過深")
+                for sub in SCRIPT_LIBRARY[args[0].lower()].split('\n'):
+                    sub = sub.strip()
+                    if sub and not sub.startswith('#'):
+                        mask = self._compile_line(line, sub, mask, depth + 1)
+                line.move = None
+            else:
+                raise ValueError(f"未知的命令類型: {op}")
+        except ScriptError:
+            raise
+        except ValueError as e:
+            raise ScriptError(line.number, str(e))
+        return mask
+
+    @staticmethod
+    def keysym(name):
+        lowered = name.lower()
+        if lowered in KEYSYMS:
+            return KEYSYMS[lowered]
+        if len(name) == 1:
+            return ScriptCompiler.char_keysym(name)
+        if lowered.startswith('0x'):
+            return int(lowered, 16)
+        if name.isdigit():
+            return int(name)
+        raise ValueError(f"未知的按鍵: {name}")
+
+    @staticmethod
+    def char_keysym(char):
+        # Latin-1 以外的字符使用 Unicode keysym (0x01000000 + 碼位)
+        codepoint = ord(char)
+        return codepoint if codepoint < 0x100 else 0x01000000 | codepoint
+
+    @staticmethod
+    def encode(opcode, *args):
+        elements = [f"{len(opcode)}.{opcode}"]
+        for arg in args:
+            arg = str(arg)
+            elements.append(f"{len(arg)}.{arg}")
+        return (','.join(elements) + ';').encode('utf-8')
+
+    def _compile_key(self, line, args):
+        # 舊的 GUI 寫法 key ctrl key alt key delete：重複的 key 只是分隔符
+        args = [name for name in args if name.lower() != 'key']
+        if not args:
+            raise ValueError("key 需要按鍵名稱")
+        # key <按鍵>...: 依次按下，再反序釋放（組合鍵）
+        interval = GUACD_SEND_PACING.get('key_interval', 0)
+        keysyms = [self.keysym(name) for name in args]
+        for keysym in keysyms:
+            line.send(self.encode('key', keysym, 1))
+            line.wait(interval)
+        for keysym in reversed(keysyms):
+            line.send(self.encode('key', keysym, 0))
+            line.release[keysym] = self.encode('key', keysym, 0)
+            line.wait(interval)
+
+    def _compile_type(self, line, text):
+        interval = GUACD_SEND_PACING.get('key_interval', 0)
+        for char in text:
+            keysym = self.char_keysym(char)
+            line.send(self.encode('key', keysym, 1))
+            line.wait(interval)
+            line.send(self.encode('key', keysym, 0))
+            line.release[keysym] = self.encode('key', keysym, 0)
+            line.wait(interval)
+
+    def _compile_mouse(self, line, args, mask):
+        if len(args) < 3:
+            raise ValueError("mouse 需要 x y 按鈕")
+        x, y, button = int(args[0]), int(args[1]), int(args[2])
+        action = args[3].lower() if len(args) > 3 else 'move'
+        button_mask = MOUSE_BUTTONS.get(button, 0)
+        if action == 'move':
+            if not line.ops:
+                line.move = (x, y)
+            line.send(self.encode('mouse', x, y, mask))
+            return mask
+        line.move = None
+        if action == 'click':
+            line.send(self.encode('mouse', x, y, button_mask))
+            line.wait(0.05)
+            line.send(self.encode('mouse', x, y, 0))
+            line.release['mouse'] = self.encode('mouse', x, y, 0)
+            mask = 0
+        elif action == 'down':
+            line.send(self.encode('mouse', x, y, button_mask))
+            mask = button_mask
+        elif action == 'up':
+            line.send(self.encode('mouse', x, y, 0))
+            mask = 0
+        else:
+            raise ValueError(f"未知的鼠標動作: {action}")
+        line.button_mask = mask
+        return mask
+
+    def info(self):
+        return {'entries': len(self.cache), **self.stats}
+
+
+def get_script_compiler():
+    global script_compiler
+    if script_compiler is None:
+        script_compiler = ScriptCompiler()
+    return script_compiler
+
 
 class GuacamoleAutomator:
     def __init__(self):
@@ -43,49 +1508,57 @@ class GuacamoleAutomator:
         self.connected = False
         self.heartbeat_active = False
         self.instruction_poster_func = None
+        self.relay_poster_func = None  # 原樣轉發 guacd 指令字節的查看者
+        self.viewer_queues = {}  # viewer_id -> ViewerOutputQueue
+        self.viewer_hub = None
+        self.guacd_connection_id = None  # guacd 在 ready 中返回的連接ID，查看者取得畫面快照時加入
         self.active_streams = {}
         self.recorded_commands = []
         self.is_recording = False
         self.connection_id = None
         self.last_activity = time.time()  # 添加最後活動時間追蹤
+        self.parser = GuacInstructionParser()
+        self.reader = None
+        self.writer = None
+        self.outbound = None
+        self.tasks = []
+        self.connect_timings = {}  # 會話建立各階段耗時(毫秒)
+        self.sync_viewers = set()  # 需要確認 sync 的查看者
+        self.pending_syncs = OrderedDict()  # timestamp -> (收到時間, 尚未確認的查看者)
+        self.frame_latency = LatencyStats()
 
     def generate_client_url(self, connection_id):
         connection_str = f"{connection_id}\0c\0{DATA_SOURCE}"
         client_hash = b64encode(connection_str.encode()).decode().strip('=')
         return urljoin(GUAC_URL, f"#/client/{client_hash}")
 
-    def authenticate(self, username, password):
-        auth_url = urljoin(GUAC_URL, "api/tokens")
-        response = requests.post(
-            auth_url,
-            data={'username': username, 'password': password},
-            headers={'Content-Type': 'application/x-www-form-urlencoded'}
-        )
-        response.raise_for_status()
-        self.token = response.json()['authToken']
+    async def authenticate(self, username, password):
+        status, data = await get_rest_client().request(
+            'POST', 'api/tokens', data={'username': username, 'password': password})
+        if status != 200:
+            raise GuacamoleAPIError(status, "認證失敗")
+        self.token = data['authToken']
         logging.info("認證成功")
 
-    def get_connections(self):
-        url = urljoin(GUAC_URL, f"api/session/data/{DATA_SOURCE}/connections")
-        response = requests.get(url, params={'token': self.token})
-        response.raise_for_status()
-        return response.json()
+    async def get_connections(self):
+        status, data = await get_rest_client().request(
+            'GET', f"api/session/data/{DATA_SOURCE}/connections", params={'token': self.token})
+        if status != 200:
+            raise GuacamoleAPIError(status, "無法獲取連接列表")
+        return data
 
-    def get_connection_details(self, connection_id):
+    async def get_connection_details(self, connection_id):
         try:
             self.connection_id = connection_id
-            info_url = urljoin(GUAC_URL, f"api/session/data/{DATA_SOURCE}/connections/{connection_id}")
-            info_resp = requests.get(info_url, params={'token': self.token})
-            info_resp.raise_for_status()
-            protocol = info_resp.json().get('protocol', 'rdp')
-            
-            param_url = urljoin(GUAC_URL, f"api/session/data/{DATA_SOURCE}/connections/{connection_id}/parameters")
-            param_resp = requests.get(param_url, params={'token': self.token})
-            param_resp.raise_for_status()
-            
+            return await get_connection_cache().get_or_load(
+                connection_id, lambda: self._fetch_connection_details(connection_id))
+        except GuacamoleAPIError as e:
+            if e.status == 403:
+                raise  # 令牌失效，交由調用方刷新令牌後重試
+            logging.error(f"獲取連接詳情失敗: {str(e)}")
             return {
-                'protocol': protocol,
-                'parameters': param_resp.json() or {}  # 確保返回空字典而不是None
+                'protocol': 'rdp',
+                'parameters': {}
             }
         except Exception as e:
             logging.error(f"獲取連接詳情失敗: {str(e)}")
@@ -95,11 +1568,34 @@ class GuacamoleAutomator:
                 'parameters': {}
             }
 
+    async def _fetch_connection_details(self, connection_id):
+        """並發請求連接信息與參數，失敗時拋出異常(不寫入緩存)"""
+        if database:
+            return await database.get_connection_details(connection_id)
+        client = get_rest_client()
+        base = f"api/session/data/{DATA_SOURCE}/connections/{connection_id}"
+        (info_status, info), (param_status, parameters) = await asyncio.gather(
+            client.request('GET', base, params={'token': self.token}),
+            client.request('GET', f"{base}/parameters", params={'token': self.token}))
+        for status in (info_status, param_status):
+            if status != 200:
+                raise GuacamoleAPIError(status, "獲取連接詳情失敗")
+        
+        return {
+            'protocol': info.get('protocol', 'rdp'),
+            'parameters': parameters or {}  # 確保返回空字典而不是None
+        }
+
     def connect_guacd(self, connection_details):
         try:
+            self.parser.reset()
+            self.connect_timings = {}
+            started = time.perf_counter()
             self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client.settimeout(15)
             self.client.connect((GUACD_HOST, GUACD_PORT))
+            self.connect_timings['tcp_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.connected = True
             logging.info(f"已連接到guacd {GUACD_HOST}:{GUACD_PORT}")
 
@@ -117,61 +1613,174 @@ class GuacamoleAutomator:
 
     def _handshake(self, details):
         self.client.setblocking(True)
-        self._send('select', details.get('protocol', 'rdp'))
+        started = time.perf_counter()
+        self.client.sendall(self._encode_instruction('select', details.get('protocol', 'rdp')).encode('utf-8'))
         opcode, server_params = self._receive_blocking_for_handshake()
         if opcode != 'args':
             raise ValueError(f"協議錯誤，預期'args'收到'{opcode}' 但收到參數 '{server_params}'")
+        args_received = time.perf_counter()
 
-        self._send_size()
-        self._send_audio()
-        self._send_video()
-        self._send_image()
-        self._send_timezone()
-
-        connect_args = ["VERSION_1_5_0"]
-        parameters = details.get('parameters', {})
-        
-        for param in server_params[1:]:
-            value = parameters.get(param, "")
-            connect_args.append(value if value else "")
-
-        encoded_args = []
-        for arg in connect_args:
-            if arg == "":
-                encoded_args.append("0.")
-            else:
-                encoded_args.append(f"{len(str(arg))}.{arg}")
-
-        connect_instr = f"{len('connect')}.connect,{','.join(encoded_args)};"
-        self.client.sendall(connect_instr.encode('utf-8'))
-        logging.debug(f"發送 → {connect_instr}")
-
+        self.client.sendall(self._encode_handshake(server_params, details))
         opcode, ready_params = self._receive_blocking_for_handshake()
         if opcode != 'ready':
             raise ValueError(f"握手失敗，收到'{opcode}' params '{ready_params}'")
+        self._record_handshake_timings(started, args_received)
+        self.guacd_connection_id = ready_params[0]
         logging.info(f"協議握手完成！客戶端ID: {ready_params[0]}")
 
-        if self.instruction_poster_func:
+        if self.instruction_poster_func or self.relay_poster_func:
             self._safe_post_instruction('size', (0, 1024, 768))
             self._safe_post_instruction('sync', (int(time.time() * 1000),))
 
-    def _send_size(self): self._send('size', '1024', '768', '96')
-    def _send_audio(self): self._send('audio')
-    def _send_video(self): self._send('video')
-    def _send_image(self): self._send('image', 'image/png', 'image/jpeg')
-    def _send_timezone(self): self._send('timezone', 'Asia/Shanghai')
+    def _encode_handshake(self, server_params, details) -> bytes:
+        """將 select 之後的全部客戶端握手指令一次編碼，以單次寫入發送"""
+        parameters = details.get('parameters', {})
+        connect_args = [HANDSHAKE_SETTINGS['version']]
+        for param in server_params[1:]:
+            connect_args.append(parameters.get(param, "") or "")
+
+        instructions = [
+            self._encode_instruction('size', *HANDSHAKE_SETTINGS['size']),
+            self._encode_instruction('audio', *HANDSHAKE_SETTINGS['audio']),
+            self._encode_instruction('video', *HANDSHAKE_SETTINGS['video']),
+            self._encode_instruction('image', *HANDSHAKE_SETTINGS['image']),
+            self._encode_instruction('timezone', HANDSHAKE_SETTINGS['timezone']),
+            self._encode_instruction('connect', *connect_args),
+        ]
+        return ''.join(instructions).encode('utf-8')
+
+    def _record_handshake_timings(self, started, args_received):
+        ready_received = time.perf_counter()
+        self.connect_timings.update({
+            'select_args_ms': round((args_received - started) * 1000, 2),
+            'connect_ready_ms': round((ready_received - args_received) * 1000, 2),
+            'handshake_ms': round((ready_received - started) * 1000, 2),
+        })
+
+    async def connect_guacd_async(self, connection_details):
+        """在當前事件循環上連接 guacd，握手、心跳與接收均以協程運行"""
+        try:
+            self.parser.reset()
+            self.connect_timings = {}
+            started = time.perf_counter()
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(GUACD_HOST, GUACD_PORT), timeout=15)
+            self.connect_timings['tcp_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            self.outbound = GuacOutboundQueue(self.writer.write)
+            sock = self.writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connected = True
+            logging.info(f"已連接到guacd {GUACD_HOST}:{GUACD_PORT} (asyncio)")
+
+            await asyncio.wait_for(self._handshake_async(connection_details), timeout=15)
+
+            self.heartbeat_active = True
+            self.tasks = [
+                asyncio.create_task(self._heartbeat_async()),
+                asyncio.create_task(self._receive_loop_async()),
+            ]
+            return True
+        except Exception as e:
+            self.connected = False
+            logging.error(f"連接失敗: {type(e).__name__} - {str(e)}")
+            self.close()
+            return False
+
+    async def _handshake_async(self, details):
+        started = time.perf_counter()
+        self.writer.write(self._encode_instruction('select', details.get('protocol', 'rdp')).encode('utf-8'))
+        opcode, server_params = await self._receive_instruction_async()
+        if opcode != 'args':
+            raise ValueError(f"協議錯誤，預期'args'收到'{opcode}' 但收到參數 '{server_params}'")
+        args_received = time.perf_counter()
+
+        self.writer.write(self._encode_handshake(server_params, details))
+        opcode, ready_params = await self._receive_instruction_async()
+        if opcode != 'ready':
+            raise ValueError(f"握手失敗，收到'{opcode}' params '{ready_params}'")
+        self._record_handshake_timings(started, args_received)
+        self.guacd_connection_id = ready_params[0]
+        logging.info(f"協議握手完成！客戶端ID: {ready_params[0]}")
+
+        if self.instruction_poster_func or self.relay_poster_func:
+            self._safe_post_instruction('size', (0, 1024, 768))
+            self._safe_post_instruction('sync', (int(time.time() * 1000),))
+
+    async def _receive_instruction_async(self) -> tuple:
+        await self.writer.drain()
+        while True:
+            for instruction in self.parser.instructions():
+                return instruction
+            chunk = await self.reader.read(4096)
+            if not chunk:
+                logging.warning("Socket 連接在握手階段斷開")
+                self.connected = False
+                return ("", ())
+            self.parser.feed(chunk)
+
+    async def capture_display(self):
+        """以只讀用戶加入本會話的 guacd 連接，返回 guacd 為新用戶複製的當前畫面指令(含其後第一個 sync)與該 sync 的時間戳"""
+        if not self.connected or not self.guacd_connection_id:
+            raise ConnectionError("會話未連接")
+        reader, writer = await asyncio.open_connection(GUACD_HOST, GUACD_PORT)
+        parser = GuacInstructionParser()
+        pending = deque()
+
+        async def receive():
+            while not pending:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    raise ConnectionError("guacd 在傳送畫面快照時斷開")
+                parser.feed(chunk)
+                pending.extend(parser.instructions())
+            return pending.popleft()
+
+        try:
+            writer.write(self._encode_instruction('select', self.guacd_connection_id).encode('utf-8'))
+            opcode, server_params = await receive()
+            if opcode != 'args':
+                raise ValueError(f"加入連接失敗，收到'{opcode}'")
+            writer.write(self._encode_handshake(server_params, {'parameters': {'read-only': 'true'}}))
+            opcode, _ = await receive()
+            if opcode != 'ready':
+                raise ValueError(f"加入連接失敗，收到'{opcode}'")
+            instructions = []
+            while True:
+                opcode, args = await receive()
+                if opcode in ('error', 'disconnect'):
+                    raise ConnectionError(f"guacd 拒絕加入連接: {args}")
+                if opcode != 'nop':
+                    instructions.append((opcode, args))
+                if opcode == 'sync':
+                    return instructions, args[0]
+        finally:
+            if not writer.is_closing():
+                writer.write(self._encode_instruction('disconnect').encode('utf-8'))
+                writer.close()
 
     def _send(self, opcode, *args_tuple):
+        self.send_raw(self._encode_instruction(opcode, *args_tuple).encode('utf-8'))
+
+    def send_raw(self, data):
+        """發送已編碼的一條或多條指令"""
         if not self.connected: raise ConnectionError("連接未就緒")
-        instr = self._encode_instruction(opcode, *args_tuple)
+        if self.writer:
+            # asyncio 傳輸：放入出站緩衝，由事件循環合併寫入
+            if self.writer.is_closing():
+                self.connected = False
+                raise ConnectionError("連接已中斷")
+            self.outbound.put(data)
+            logging.debug(f"發送 → {data[:200]}")
+            self.last_activity = time.time()
+            return
         try:
-            self.client.sendall(instr.encode('utf-8'))
-            logging.debug(f"發送 → {instr}")
+            self.client.sendall(data)
+            logging.debug(f"發送 → {data[:200]}")
             self.last_activity = time.time()  # 更新最後活動時間
         except Exception as e:
-            logging.error(f"發送指令 '{opcode}' 失敗: {e}")
+            logging.error(f"發送指令失敗: {e}")
             self.connected = False
-        time.sleep(0.01)
 
     def _encode_instruction(self, opcode: str, *args_tuple) -> str:
         elements = [f"{len(str(opcode))}.{opcode}"]
@@ -184,20 +1793,18 @@ class GuacamoleAutomator:
         return ','.join(elements) + ';'
 
     def _receive_blocking_for_handshake(self) -> tuple:
-        buffer = bytearray()
         self.client.setblocking(True)
         try:
             while True:
+                # 握手後多收到的數據保留在解析器中，交給接收循環處理
+                for instruction in self.parser.instructions():
+                    return instruction
                 chunk = self.client.recv(4096)
                 if not chunk:
                     logging.warning("Socket 連接在 _receive_blocking_for_handshake 中斷開")
                     self.connected = False
                     return ("", ())
-                buffer.extend(chunk)
-                if b';' in buffer:
-                    end_index = buffer.find(b';') + 1
-                    data_bytes = buffer[:end_index]
-                    return self._parse_instruction(data_bytes.decode('utf-8', errors='replace').strip())
+                self.parser.feed(chunk)
         except socket.timeout:
             logging.error("Socket 在 _receive_blocking_for_handshake 中超時 (握手階段不應發生)。")
             self.connected = False
@@ -207,35 +1814,6 @@ class GuacamoleAutomator:
             self.connected = False
             return ("", ())
 
-    def _parse_instruction(self, data: str) -> tuple:
-        if not data or not data.endswith(';'):
-            return ("", ())
-
-        parts = []
-        buffer_str = data[:-1]
-        while buffer_str:
-            dot_pos = buffer_str.find('.')
-            if dot_pos == -1:
-                break
-            try:
-                length = int(buffer_str[:dot_pos])
-            except ValueError:
-                break
-            start = dot_pos + 1
-            end = start + length
-            if end > len(buffer_str):
-                break
-
-            parts.append(buffer_str[start:end])
-            buffer_str = buffer_str[end:]
-
-            if buffer_str.startswith(','):
-                buffer_str = buffer_str[1:]
-            elif buffer_str:
-                break
-
-        return (parts[0], tuple(parts[1:])) if parts else ("", ())
-
     def _heartbeat(self):
         last_ping_time = 0
         ping_interval = 5  # 5秒發送一次ping
@@ -276,51 +1854,109 @@ class GuacamoleAutomator:
                 time.sleep(1)
                 continue
 
-    def _safe_post_instruction(self, opcode, args):
+    async def _heartbeat_async(self):
+        ping_interval = 5  # 5秒發送一次ping
+        ping_timeout = 20
+
+        while self.heartbeat_active and self.connected:
+            try:
+                self._send('ping', str(int(time.time() * 1000)))
+                await asyncio.sleep(ping_interval)
+
+                if time.time() - self.last_activity > ping_timeout:
+                    logging.warning(f"心跳超時: 最後活動時間 {self.last_activity}, 當前時間 {time.time()}")
+                    self._send('ping', str(int(time.time() * 1000)))
+                    await asyncio.sleep(2)
+                    if time.time() - self.last_activity > ping_timeout:
+                        self.connected = False
+                        self.close()
+                        break
+            except asyncio.CancelledError:
+                break
+            except ConnectionError:
+                logging.warning("心跳失敗: 發送時連接丟失。")
+                self.connected = False
+                self.close()
+                break
+            except Exception as e:
+                logging.error(f"心跳協程出錯: {str(e)}")
+                await asyncio.sleep(1)
+
+    def attach_sync_viewer(self, viewer_id):
+        """登記一個會回報渲染完成的查看者"""
+        self.sync_viewers.add(viewer_id)
+
+    def detach_sync_viewer(self, viewer_id):
+        self.sync_viewers.discard(viewer_id)
+        for timestamp, (_, waiting) in list(self.pending_syncs.items()):
+            waiting.discard(viewer_id)
+        self._flush_acked_syncs()
+
+    def viewer_sync(self, viewer_id, timestamp):
+        """查看者已渲染到 timestamp 對應的幀"""
+        try:
+            rendered = int(timestamp)
+        except (TypeError, ValueError):
+            return
+        for pending_ts, (_, waiting) in self.pending_syncs.items():
+            if int(pending_ts) > rendered:
+                break
+            waiting.discard(viewer_id)
+        self._flush_acked_syncs()
+
+    def _on_server_sync(self, timestamp):
+        received = time.perf_counter()
+        if GUACD_SYNC_ACK['policy'] == 'immediate' or not self.sync_viewers or not self.writer:
+            self._ack_sync(timestamp, received)
+            return
+        self.pending_syncs[timestamp] = (received, set(self.sync_viewers))
+        asyncio.get_running_loop().call_later(GUACD_SYNC_ACK['timeout'], self._expire_sync, timestamp)
+
+    def _expire_sync(self, timestamp):
+        if timestamp in self.pending_syncs:
+            logging.debug(f"查看者未及時確認 sync {timestamp}，直接確認")
+            self.pending_syncs[timestamp][1].clear()
+            self._flush_acked_syncs()
+
+    def _flush_acked_syncs(self):
+        # guacd 要求按順序確認
+        while self.pending_syncs:
+            timestamp, (received, waiting) = next(iter(self.pending_syncs.items()))
+            if waiting:
+                break
+            del self.pending_syncs[timestamp]
+            self._ack_sync(timestamp, received)
+
+    def _ack_sync(self, timestamp, received):
+        if not self.connected:
+            return
+        try:
+            self._send('sync', timestamp)
+            self.frame_latency.record((time.perf_counter() - received) * 1000)
+        except ConnectionError:
+            pass
+
+    def _safe_post_instruction(self, opcode, args, raw=None):
         """安全地發送指令到前端，避免異步問題"""
         try:
+            if opcode == 'size' and args and str(args[0]) == '0' and self.viewer_hub:
+                self.viewer_hub.last_size = tuple(args)
             if callable(self.instruction_poster_func):
                 self.instruction_poster_func(opcode, args)
+            if callable(self.relay_poster_func):
+                if raw is None:
+                    raw = self._encode_instruction(opcode, *args).encode('utf-8')
+                self.relay_poster_func(opcode, raw)
             self.last_activity = time.time()  # 更新最後活動時間
         except Exception as e:
             logging.error(f"發送指令到前端失敗: {type(e).__name__} - {str(e)}")
 
-    def send_key(self, keysym, pressed):
-        if not self.connected: raise ConnectionError("連接已中斷")
-    
-    # 如果是字符鍵，使用特殊處理
-        if isinstance(keysym, int) and 32 <= keysym <= 126:  # 可打印ASCII範圍
-        # 對於可打印字符，使用Guacamole的Unicode模式
-            self._send('key', str(keysym), '1' if pressed else '0')
-        elif isinstance(keysym, str) and keysym.startswith('0x'):
-        # 處理十六進制格式的keysym
-            keysym = int(keysym, 16)
-            self._send('key', str(keysym), '1' if pressed else '0')
-        else:
-        # 對於特殊鍵，直接發送keysym
-            self._send('key', str(keysym), '1' if pressed else '0')
-    
-        if self.is_recording:
-            self.recorded_commands.append(f"key {keysym} {'1' if pressed else '0'}")
-
-
     def send_mouse(self, x, y, button_mask):
         if not self.connected: raise ConnectionError("連接已中斷")
         self._send('mouse', str(x), str(y), str(button_mask))
         if self.is_recording:
             self.recorded_commands.append(f"mouse {x} {y} {button_mask}")
 
-    def type_text(self, text):
-        if not self.connected: raise ConnectionError("連接已中斷")
-        for char in text:
-            keysym = ord(char)
-            self.send_key(keysym, True)
-            time.sleep(0.05)
-            self.send_key(keysym, False)
-            time.sleep(0.05)
-        if self.is_recording:
-            self.recorded_commands.append(f"type {text}")
-
     def start_recording(self):
         self.is_recording = True
         self.recorded_commands = []
@@ -332,108 +1968,29 @@ class GuacamoleAutomator:
         logging.info(f"停止錄製，共記錄了 {len(self.recorded_commands)} 條命令")
         return self.recorded_commands
 
-    def execute_script(self, script_content):
-        if not self.connected: raise ConnectionError("連接已中斷")
-        commands = script_content.strip().split('\n')
-        for cmd in commands:
-            cmd = cmd.strip()
-            if not cmd or cmd.startswith('#'):
-                continue
-            parts = cmd.split()
-            if not parts:
-                continue
-            try:
-                if parts[0] == 'mouse':
-                    if len(parts) >= 4:
-                        x, y, button = int(parts[1]), int(parts[2]), int(parts[3])
-                        action = parts[4] if len(parts) > 4 else "move"
-                        if action == "click":
-                            self.send_mouse(x, y, button)
-                            time.sleep(0.1)
-                            self.send_mouse(x, y, 0)
-                        elif action == "down":
-                            self.send_mouse(x, y, button)
-                        elif action == "up":
-                            self.send_mouse(x, y, 0)
-                        else:
-                            self.send_mouse(x, y, 0)
-                elif parts[0] == 'key':
-                    i = 1
-                    keys_to_press = []
-                    while i < len(parts):
-                        if parts[i] == 'key' and i+1 < len(parts):
-                            i += 1
-                            key = parts[i]
-                            if key.isdigit():
-                                keys_to_press.append(int(key))
-                            else:
-                                special_keys = {
-                                    'enter': 0xFF0D, 'tab': 0xFF09, 'escape': 0xFF1B,
-                                    'space': 0x0020, 'backspace': 0xFF08, 'left': 0xFF51,
-                                    'up': 0xFF52, 'right': 0xFF53, 'down': 0xFF54,
-                                    'ctrl': 0xFFE3, 'alt': 0xFFE9, 'shift': 0xFFE1,
-                                    'win': 0xFFEB, 'a': 0x0061, 'b': 0x0062, 'c': 0x0063,
-                                    'return': 0xFF0D
-                                }
-                                keys_to_press.append(special_keys.get(key.lower(), ord(key[0])))
-                        else:
-                            key = parts[i]
-                            if key.isdigit():
-                                keys_to_press.append(int(key))
-                            else:
-                                special_keys = {
-                                    'enter': 0xFF0D, 'tab': 0xFF09, 'escape': 0xFF1B,
-                                    'space': 0x0020, 'backspace': 0xFF08, 'left': 0xFF51,
-                                    'up': 0xFF52, 'right': 0xFF53, 'down': 0xFF54,
-                                    'ctrl': 0xFFE3, 'alt': 0xFFE9, 'shift': 0xFFE1,
-                                    'win': 0xFFEB, 'a': 0x0061, 'b': 0x0062, 'c': 0x0063,
-                                    'return': 0xFF0D
-                                }
-                                keys_to_press.append(special_keys.get(key.lower(), ord(key[0])))
-                        i += 1
-                    for key in keys_to_press:
-                        self.send_key(key, True)
-                        time.sleep(0.05)
-                    for key in reversed(keys_to_press):
-                        self.send_key(key, False)
-                        time.sleep(0.05)
-                elif parts[0] == 'type':
-                    text = ' '.join(parts[1:])
-                    self.type_text(text)
-                elif parts[0] == 'wait':
-                    if len(parts) > 1:
-                        wait_time = float(parts[1])
-                        time.sleep(wait_time)
-                elif parts[0] == 'script':
-                    if len(parts) > 1:
-                        script_name = parts[1]
-                        if script_name == 'open_cmd':
-                            self.execute_script("""
-key win
-key r
-wait 0.5
-type cmd
-key enter
-""")
-                        elif script_name == 'open_notepad':
-                            self.execute_script("""
-key win
-key r
-wait 0.5
-type notepad
-key enter
-""")
-                        elif script_name == 'take_screenshot':
-                            self.execute_script("""
-key win
-key printscreen
-""")
-                time.sleep(0.1)
-            except Exception as e:
-                logging.error(f"執行腳本命令 '{cmd}' 時出錯: {e}")
-        return True
-
     def close(self):
+        self.heartbeat_active = False
+        current = asyncio.current_task() if self._in_event_loop() else None
+        for task in self.tasks:
+            if task is not current and not task.done():
+                task.cancel()
+        self.tasks = []
+        if self.writer:
+            logging.info("正在關閉 Guacamole 連接 (asyncio)")
+            if self.connected and not self.writer.is_closing():
+                try:
+                    self.outbound.flush()
+                    self.writer.write(self._encode_instruction('disconnect').encode('utf-8'))
+                    logging.info("發送 disconnect 指令給 guacd")
+                except Exception as e:
+                    logging.warning(f"發送 disconnect 指令失敗 (連接可能已關閉): {e}")
+            self.connected = False
+            self.outbound.clear()
+            self.pending_syncs.clear()
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+            logging.info("Socket 已成功關閉")
         if self.client:
             logging.info(f"正在關閉 Guacamole 連接 (socket fd: {self.client.fileno() if self.client else 'N/A'})")
             self.heartbeat_active = False
@@ -455,7 +2012,6 @@ key printscreen
 
     def message_receive_loop(self):
         logging.info("啟動 Guacamole 消息接收循環...")
-        instruction_buffer = ""
         if self.client:
             self.client.settimeout(0.5)  # 增加超時時間
         
@@ -484,64 +2040,18 @@ key printscreen
                 # 成功接收數據，重置錯誤計數
                 connection_errors = 0
                 
-                instruction_buffer += raw_data_chunk.decode('utf-8', errors='replace')
+                self.parser.feed(raw_data_chunk)
                 self.last_activity = time.time()  # 更新最後活動時間
 
-                while ';' in instruction_buffer:
-                    instr_end_idx = instruction_buffer.find(';') + 1
-                    full_instruction = instruction_buffer[:instr_end_idx]
-                    instruction_buffer = instruction_buffer[instr_end_idx:]
-
-                    opcode, params = self._parse_instruction(full_instruction)
-
-                    if opcode:
-                        if opcode == 'error':
-                            logging.error(f"收到 Guacd 錯誤: {params}")
-                            if self.instruction_poster_func:
-                                self._safe_post_instruction(opcode, params)
-                            if params and "UPSTREAM_ERROR" in params[0].upper() and "closed" in params[0].lower():
-                                logging.warning("上游 RDP/VNC 伺服器關閉了連接。")
-                                self.connected = False
-                                break
-                            continue
-
-                        if opcode == 'img' or opcode == 'file':
-                            if len(params) >= 1:
-                                stream_index = params[0]
-                                self.active_streams[stream_index] = {
-                                    'type': opcode,
-                                    'params': params,
-                                    'data': []
-                                }
-                        elif opcode == 'blob':
-                            if len(params) >= 1:
-                                stream_index = params[0]
-                                if stream_index in self.active_streams:
-                                    if len(params) >= 2:
-                                        self.active_streams[stream_index]['data'].append(params[1])
-                        elif opcode == 'end':
-                            if len(params) >= 1:
-                                stream_index = params[0]
-                                if stream_index in self.active_streams:
-                                    del self.active_streams[stream_index]
-                        elif opcode == 'pong':
-                            # 處理pong響應，更新最後活動時間
-                            self.last_activity = time.time()
-                            logging.debug("收到 pong 響應")
-
-                        if self.instruction_poster_func:
-                            self._safe_post_instruction(opcode, params)
-
-                        if opcode == 'disconnect':
-                            logging.info("收到 Guacd 的 disconnect 指令。")
-                            self.connected = False
-                            break
+                for opcode, params in self.parser.instructions():
+                    if not self._handle_instruction(opcode, params):
+                        break
             except socket.timeout:
                 # 超時不是錯誤，繼續循環
                 continue
-            except UnicodeDecodeError as e:
-                logging.error(f"解碼 Guacd 數據失敗: {e}. Buffer: {repr(instruction_buffer[:100])}")
-                instruction_buffer = ""
+            except ValueError as e:
+                logging.error(f"解析 Guacd 數據失敗: {e}. Buffer: {repr(bytes(self.parser.buffer[:100]))}")
+                self.parser.reset()
             except ConnectionResetError:
                 logging.warning("Guacd 連接被遠程重置。")
                 self.connected = False
@@ -561,6 +2071,106 @@ key printscreen
             self.client.settimeout(None)
         self.close()
 
+    async def _receive_loop_async(self):
+        logging.info("啟動 Guacamole 消息接收協程...")
+        try:
+            # 握手階段多收到的數據先處理
+            for opcode, params in self.parser.instructions():
+                if not self._handle_instruction(opcode, params):
+                    return
+
+            while self.connected:
+                raw_data_chunk = await self.reader.read(16384)
+                if not raw_data_chunk:
+                    logging.info("Guacd 連接已斷開 (read 返回空數據)。")
+                    self.connected = False
+                    break
+
+                self.parser.feed(raw_data_chunk)
+                self.last_activity = time.time()  # 更新最後活動時間
+
+                for opcode, params in self.parser.instructions():
+                    if not self._handle_instruction(opcode, params):
+                        break
+        except asyncio.CancelledError:
+            pass
+        except ValueError as e:
+            logging.error(f"解析 Guacd 數據失敗: {e}. Buffer: {repr(bytes(self.parser.buffer[:100]))}")
+            self.connected = False
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logging.warning(f"Guacd 連接中斷: {type(e).__name__}")
+            self.connected = False
+        except Exception as e:
+            if self.connected:
+                logging.error(f"消息接收協程發生未知錯誤: {type(e).__name__} - {str(e)}")
+            self.connected = False
+        finally:
+            logging.info("Guacamole 消息接收協程已停止。")
+            self.close()
+
+    def _current_raw(self):
+        # 只有轉發模式的查看者需要原始字節
+        return self.parser.last_raw() if self.relay_poster_func else None
+
+    @staticmethod
+    def _in_event_loop():
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    def _handle_instruction(self, opcode, params):
+        """處理一條來自 guacd 的指令，返回 False 表示應停止接收"""
+        if not opcode:
+            return True
+
+        if opcode == 'error':
+            logging.error(f"收到 Guacd 錯誤: {params}")
+            if self.instruction_poster_func or self.relay_poster_func:
+                self._safe_post_instruction(opcode, params, self._current_raw())
+            if params and "UPSTREAM_ERROR" in params[0].upper() and "closed" in params[0].lower():
+                logging.warning("上游 RDP/VNC 伺服器關閉了連接。")
+                self.connected = False
+                return False
+            return True
+
+        if opcode == 'img' or opcode == 'file':
+            if len(params) >= 1:
+                stream_index = params[0]
+                self.active_streams[stream_index] = {
+                    'type': opcode,
+                    'params': params,
+                    'data': []
+                }
+        elif opcode == 'blob':
+            if len(params) >= 1:
+                stream_index = params[0]
+                if stream_index in self.active_streams:
+                    if len(params) >= 2:
+                        self.active_streams[stream_index]['data'].append(params[1])
+        elif opcode == 'end':
+            if len(params) >= 1:
+                stream_index = params[0]
+                if stream_index in self.active_streams:
+                    del self.active_streams[stream_index]
+        elif opcode == 'pong':
+            # 處理pong響應，更新最後活動時間
+            self.last_activity = time.time()
+            logging.debug("收到 pong 響應")
+        elif opcode == 'sync':
+            if params:
+                self._on_server_sync(params[0])
+
+        if self.instruction_poster_func or self.relay_poster_func:
+            self._safe_post_instruction(opcode, params, self._current_raw())
+
+        if opcode == 'disconnect':
+            logging.info("收到 Guacd 的 disconnect 指令。")
+            self.connected = False
+            return False
+        return True
+
 
 class GuacamoleController:
     def __init__(self):
@@ -582,6 +2192,11 @@ class GuacamoleController:
        self.logger = logging.LoggerAdapter(base_logger, {'instance_id': self.instance_id})
     
        self.connection_id = None
+       self.connect_timings = {}
+       self.button_mask = 0  # 當前按下的鼠標按鈕
+       self._pending_move = None
+       self._move_handle = None
+       self.mouse_stats = {'moves_received': 0, 'moves_sent': 0}
        self.logger.info(f"GuacamoleController 初始化成功 [ID: {self.instance_id}]")
 
     
@@ -589,16 +2204,31 @@ class GuacamoleController:
         """連接到指定的連接ID"""
         try:
             self.connection_id = connection_id
+            started = time.perf_counter()
+            timings = {}
             
             # 如果沒有提供token，則進行身份驗證
+            if not token and token_cache:
+                token = await token_cache.get_token()
             if not token:
-                self.automator.authenticate('guacadmin', 'guacadmin')
+                await self.automator.authenticate(GUAC_USERNAME, GUAC_PASSWORD)
                 token = self.automator.token
             else:
                 self.automator.token = token
+            timings['auth_ms'] = round((time.perf_counter() - started) * 1000, 2)
             
             # 獲取連接詳情
-            connection_details = self.automator.get_connection_details(connection_id)
+            details_started = time.perf_counter()
+            try:
+                connection_details = await self.automator.get_connection_details(connection_id)
+            except GuacamoleAPIError:
+                if not token_cache:
+                    raise
+                self.logger.info("Guacamole 令牌已失效，重新登錄後重試")
+                token_cache.invalidate(token=self.automator.token)
+                self.automator.token = await token_cache.get_token()
+                connection_details = await self.automator.get_connection_details(connection_id)
+            timings['details_ms'] = round((time.perf_counter() - details_started) * 1000, 2)
             
             # 確保connection_details包含必要的結構
             if 'protocol' not in connection_details or 'parameters' not in connection_details:
@@ -606,8 +2236,15 @@ class GuacamoleController:
                 return False
             
             # 連接到 guacd
-            if self.automator.connect_guacd(connection_details):
-                self.logger.info(f"成功連接到 {connection_id}")
+            if GUACD_ASYNC_TRANSPORT:
+                connected = await self.automator.connect_guacd_async(connection_details)
+            else:
+                connected = self.automator.connect_guacd(connection_details)
+            if connected:
+                timings.update(self.automator.connect_timings)
+                timings['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+                self.connect_timings = timings
+                self.logger.info(f"成功連接到 {connection_id} (耗時 {timings['total_ms']} ms)")
                 return True
             else:
                 self.logger.error(f"連接失敗: {connection_id}")
@@ -619,6 +2256,10 @@ class GuacamoleController:
     async def disconnect(self):
         """斷開連接"""
         try:
+            if self._move_handle is not None:
+                self._move_handle.cancel()
+                self._move_handle = None
+            self._pending_move = None
             if self.automator:
                 self.automator.close()
                 self.logger.info("已斷開連接")
@@ -628,541 +2269,1897 @@ class GuacamoleController:
             self.logger.error(f"斷開連接時出錯: {str(e)}")
             return False
     
-    async def mouse_event(self, x, y, button, action):
-        """發送鼠標事件"""
+    def _queue_mouse_move(self, x, y):
+        self.mouse_stats['moves_received'] += 1
+        self._pending_move = (x, y)
+        if self._move_handle is None:
+            interval = GUACD_SEND_PACING.get('mouse_move_interval', 0)
+            self._move_handle = asyncio.get_running_loop().call_later(interval, self._flush_mouse_move)
+
+    def _flush_mouse_move(self):
+        if self._move_handle is not None:
+            self._move_handle.cancel()
+            self._move_handle = None
+        if self._pending_move is None:
+            return
+        x, y = self._pending_move
+        self._pending_move = None
         try:
-            button_mask = 0
-            if button == 1:  # 左鍵
-                button_mask |= 1
-            elif button == 2:  # 中鍵
-                button_mask |= 2
-            elif button == 3:  # 右鍵
-                button_mask |= 4
-            
-            if action == "click":
-                self.automator.send_mouse(x, y, button_mask)
-                await asyncio.sleep(0.05)
-                self.automator.send_mouse(x, y, 0)
-            elif action == "down":
-                self.automator.send_mouse(x, y, button_mask)
-            elif action == "up":
-                self.automator.send_mouse(x, y, 0)
-            elif action == "move":
-                self.automator.send_mouse(x, y, 0)
-            
-            self.logger.info(f"鼠標事件: x={x}, y={y}, 按鈕={button}, 動作={action}")
-            return True
-        except Exception as e:
-            self.logger.error(f"發送鼠標事件時出錯: {str(e)}")
-            return False
+            # 移動時保持當前按下的按鈕，拖曳才不會被中斷
+            self.automator.send_mouse(x, y, self.button_mask)
+            self.mouse_stats['moves_sent'] += 1
+        except ConnectionError as e:
+            self.logger.error(f"發送鼠標移動時出錯: {str(e)}")
     
-    async def key_event(self, key, state=None):
-        """發送鍵盤事件"""
+    async def run_line(self, line):
+        """執行一行已編譯的腳本：順序寫出預編碼的指令緩衝並等待"""
+        automator = self.automator
+        if line.move is not None:
+            # 按鈕狀態不變的移動事件合併，每個幀間隔只發送最新位置
+            self._queue_mouse_move(*line.move)
+            return True
+        # 按鍵或按鈕變化前先送出待發送的移動，保證順序
+        self._flush_mouse_move()
         try:
-            key_map = {
-                'return': 0xFF0D, 'enter': 0xFF0D,
-                'tab': 0xFF09,
-                'escape': 0xFF1B, 'esc': 0xFF1B,
-                'ctrl': 0xFFE3,
-                'alt': 0xFFE9,
-                'shift': 0xFFE1,
-                'win': 0xFFEB,
-                'up': 0xFF52,
-                'down': 0xFF54,
-                'left': 0xFF51,
-                'right': 0xFF53,
-                'space': 0x0020,
-                'delete': 0xFFFF, 'del': 0xFFFF,
-                'backspace': 0xFF08,
-                
-                # 字母鍵 - 使用小寫ASCII值
-                'a': 0x0061, 'b': 0x0062, 'c': 0x0063, 'd': 0x0064,
-                'e': 0x0065, 'f': 0x0066, 'g': 0x0067, 'h': 0x0068,
-                'i': 0x0069, 'j': 0x006A, 'k': 0x006B, 'l': 0x006C,
-                'm': 0x006D, 'n': 0x006E, 'o': 0x006F, 'p': 0x0070,
-                'q': 0x0071, 'r': 0x0072, 's': 0x0073, 't': 0x0074,
-                'u': 0x0075, 'v': 0x0076, 'w': 0x0077, 'x': 0x0078,
-                'y': 0x0079, 'z': 0x007A,
-            
-                # 數字鍵
-                '0': 0x0030, '1': 0x0031, '2': 0x0032, '3': 0x0033,
-                '4': 0x0034, '5': 0x0035, '6': 0x0036, '7': 0x0037,
-                '8': 0x0038, '9': 0x0039
-            }
-            
-            # 解析命令字符串
-            parts = key.split()
-            
-            # 檢查是否是複合按鍵命令
-            if len(parts) > 1:
-                keys_to_press = []
-                i = 0
-                while i < len(parts):
-                    if parts[i] == 'key' and i+1 < len(parts):
-                        i += 1
-                        current_key = parts[i]
-                        if current_key.isdigit():
-                            keys_to_press.append(int(current_key))
-                        else:
-                            keys_to_press.append(key_map.get(current_key.lower(), ord(current_key[0]) if current_key else 0))
-                    else:
-                        current_key = parts[i]
-                        if current_key.isdigit():
-                            keys_to_press.append(int(current_key))
-                        else:
-                            keys_to_press.append(key_map.get(current_key.lower(), ord(current_key[0]) if current_key else 0))
-                    i += 1
-                
-                # 按下所有按鍵
-                for k in keys_to_press:
-                    self.automator.send_key(k, True)
-                    await asyncio.sleep(0.05)
-                
-                # 釋放所有按鍵（按相反順序）
-                for k in reversed(keys_to_press):
-                    self.automator.send_key(k, False)
-                    await asyncio.sleep(0.05)
-                
-                self.logger.info(f"複合按鍵: {key}")
-                return True
-            else:
-                # 單個按鍵處理
-                single_key = key
-                if single_key.lower() in key_map:
-                    keysym = key_map[single_key.lower()]
-                elif len(single_key) == 1:
-                    keysym = ord(single_key)
+            for op in line.ops:
+                if op.__class__ is bytes:
+                    automator.send_raw(op)
                 else:
-                    keysym = ord(single_key[0]) if single_key else 0
-                
-                # 確保鍵盤狀態正確傳遞
-                state_bool = True if state in [True, 1, '1', 'true', 'True'] else False
-                self.automator.send_key(keysym, state_bool)
-                self.logger.info(f"按鍵: {single_key} (狀態: {state_bool})")
-                return True
-        except Exception as e:
-            self.logger.error(f"發送鍵盤事件時出錯: {str(e)}")
-            return False
-    
-    async def type_text(self, text):
-        """輸入文本"""
-        try:
-            self.automator.type_text(text)
-            self.logger.info(f"輸入文本: {text}")
-            return True
-        except Exception as e:
-            self.logger.error(f"輸入文本時出錯: {str(e)}")
-            return False
-    
+                    await asyncio.sleep(op)
+        except asyncio.CancelledError:
+            if line.release and automator.connected:
+                automator.send_raw(b''.join(line.release.values()))
+            raise
+        if line.button_mask is not None:
+            self.button_mask = line.button_mask
+        if automator.is_recording:
+            automator.recorded_commands.append(line.text)
+        return True
+
     async def execute_command(self, command):
         """執行單個命令"""
         try:
-            cmd_parts = command.strip().split(' ')
-            if not cmd_parts:
+            # 鼠標座標幾乎不重複，不進入編譯緩存
+            script = get_script_compiler().compile(command, cache=not command.startswith('mouse '))
+            if not script.lines:
                 self.logger.error("空命令")
                 return False
-            
-            cmd_type = cmd_parts[0].lower()
-            
-            # 鼠標操作
-            if cmd_type == 'mouse':
-                if len(cmd_parts) < 4:
-                    self.logger.error("無效的鼠標命令格式")
-                    return False
-                
-                x = int(cmd_parts[1])
-                y = int(cmd_parts[2])
-                button = int(cmd_parts[3])
-                action = cmd_parts[4] if len(cmd_parts) > 4 else "move"
-                
-                return await self.mouse_event(x, y, button, action)
-            
-            # 鍵盤操作
-            elif cmd_type == 'key':
-                if len(cmd_parts) < 2:
-                    self.logger.error("無效的鍵盤命令格式")
-                    return False
-                
-                key = cmd_parts[1]
-                # 修正問題2：檢查是否有狀態參數並正確處理
-                state = True
-                if len(cmd_parts) > 2:
-                    state = cmd_parts[2] == '1'
-                
-                return await self.key_event(key, state)
-            
-            # 輸入文本
-            elif cmd_type == 'type':
-                if len(cmd_parts) < 2:
-                    self.logger.error("無效的輸入命令格式")
-                    return False
-                
-                text = ' '.join(cmd_parts[1:])
-                return await self.type_text(text)
-            
-            # 等待
-            elif cmd_type == 'wait':
-                if len(cmd_parts) < 2:
-                    self.logger.error("無效的等待命令格式")
-                    return False
-                
-                seconds = float(cmd_parts[1])
-                await asyncio.sleep(seconds)
-                self.logger.info(f"等待 {seconds} 秒")
-                return True
-            
-            # 預定義腳本
-            elif cmd_type == 'script':
-                if len(cmd_parts) < 2:
-                    self.logger.error("腳本名稱必須提供")
-                    return False
-                
-                script_name = cmd_parts[1].lower()
-                
-                # 修正問題3：改進預定義腳本處理
-                if script_name == 'open_cmd':
-                    await self.execute_command('key win 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key win 0')
-                    await asyncio.sleep(0.2)
-                    await self.execute_command('key r 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key r 0')
-                    await asyncio.sleep(0.5)
-                    await self.execute_command('type cmd')
-                    await asyncio.sleep(0.2)
-                    await self.execute_command('key return 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key return 0')
-                    return True
-                elif script_name == 'screenshot':
-                    await self.execute_command('key win 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key shift 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key s 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key s 0')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key shift 0')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key win 0')
-                    return True
-                elif script_name == 'browser':
-                    await self.execute_command('key win 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key win 0')
-                    await asyncio.sleep(0.2)
-                    await self.execute_command('key r 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key r 0')
-                    await asyncio.sleep(0.5)
-                    await self.execute_command('type chrome')
-                    await asyncio.sleep(0.2)
-                    await self.execute_command('key return 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key return 0')
-                    return True
-                elif script_name == 'notepad':
-                    await self.execute_command('key win 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key win 0')
-                    await asyncio.sleep(0.2)
-                    await self.execute_command('key r 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key r 0')
-                    await asyncio.sleep(0.5)
-                    await self.execute_command('type notepad')
-                    await asyncio.sleep(0.2)
-                    await self.execute_command('key return 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key return 0')
-                    return True
-                elif script_name == 'explorer':
-                    await self.execute_command('key win 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key e 1')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key e 0')
-                    await asyncio.sleep(0.1)
-                    await self.execute_command('key win 0')
-                    return True
-                else:
-                    # 如果不是預定義腳本，嘗試執行自定義腳本
-                    return self.automator.execute_script(f"""
-# 執行 {script_name} 腳本
-script {script_name}
-""")
-            
-            else:
-                self.logger.error(f"未知的命令類型: {cmd_type}")
-                return False
-            
+            for line in script.lines:
+                await self.run_line(line)
+            self.logger.debug(f"命令已執行: {command}")
+            return True
+        except ScriptError as e:
+            self.logger.error(f"無效的命令: {e}")
+            return False
         except Exception as e:
             self.logger.error(f"執行命令時出錯: {str(e)}")
             return False
-    
-  #  async def execute_script(self, script):
-   #     """執行多行腳本"""
-   #     try:
-    #        script_lines = [line.strip() for line in script.split('\n') if line.strip()]
-     #       results = []
-            
-    #        for line in script_lines:
-     #           result = await self.execute_command(line)
-      #          results.append({
-       #             'command': line,
-        #            'success': result
-         #       })
-            
-     #       self.logger.info(f"腳本執行完成，共 {len(script_lines)} 條命令")
-      #      return results
-      #  except Exception as e:
-       #     self.logger.error(f"執行腳本時出錯: {str(e)}")
-        #    return False
 
-class GuacamoleSessionManager:
-    def __init__(self):
-        self.active_sessions = {}
-        self.last_activity = {}
-        self.lock = asyncio.Lock()
-        self.script_registry = {
-            'open_cmd': [
-                ('key', 'win'), ('key', 'r'), ('wait', 0.5),
-                ('type', 'cmd'), ('key', 'return')
-            ],
-            'screenshot': [
-                ('key', 'win'), ('key', 'shift'), ('key', 's')
-            ],
-            'browser': [
-                ('key', 'win'), ('key', 'r'), ('wait', 0.5),
-                ('type', 'chrome'), ('key', 'return')
-            ],
-            'notepad': [
-                ('key', 'win'), ('key', 'r'), ('wait', 0.5),
-                ('type', 'notepad'), ('key', 'return')
-            ],
-            'explorer': [
-                ('key', 'win'), ('key', 'e')
-            ]
+class AdmissionRejected(Exception):
+    """會話准入被拒絕：等待隊列已滿或排隊超時"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ConnectionBusy(AdmissionRejected):
+    """連接上已有命令或腳本在執行，同步請求不排隊等待"""
+
+
+class SessionAdmission:
+    """全局與按目標主機的會話並發限制，超出時按優先級(數值小者優先)、同級先到先得排隊"""
+
+    def __init__(self, settings=None):
+        self.settings = {**SESSION_ADMISSION, **(settings or {})}
+        self.active = 0
+        self.active_per_host = Counter()
+        self.waiters = []  # (priority, seq, future, host)
+        self.seq = 0
+        self.wait_time = LatencyStats()
+        self.counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0}
+
+    def _has_capacity(self, host):
+        return (self.active < self.settings['max_sessions'] and
+                self.active_per_host[host] < self.settings['max_per_host'])
+
+    def _grant(self, host):
+        self.active += 1
+        self.active_per_host[host] += 1
+        self.counters['admitted'] += 1
+
+    async def acquire(self, host, priority=0):
+        """佔用一個會話名額，需在會話關閉或連接失敗時調用 release"""
+        priority = int(priority or 0)
+        # 同一主機已有排隊者時不插隊
+        if self._has_capacity(host) and not any(waiter[3] == host for waiter in self.waiters):
+            self._grant(host)
+            self.wait_time.record(0)
+            return
+        if len(self.waiters) >= self.settings['max_queue']:
+            self.counters['rejected'] += 1
+            raise AdmissionRejected(f"會話等待隊列已滿 ({len(self.waiters)})")
+
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        entry = (priority, self.seq, future, host)
+        heapq.heappush(self.waiters, entry)
+        self.counters['queued'] += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.settings['queue_timeout'])
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # 超時的同時已獲准，歸還名額
+                self.release(host)
+            self._remove(entry)
+            self.counters['timeouts'] += 1
+            raise AdmissionRejected(f"等待會話名額超時 ({self.settings['queue_timeout']} 秒)")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(host)
+            self._remove(entry)
+            raise
+        finally:
+            self.wait_time.record((time.perf_counter() - started) * 1000)
+
+    def try_acquire(self, host):
+        """不排隊地佔用名額，僅在沒有任何等待者時成功，供預熱池使用"""
+        if self.waiters or not self._has_capacity(host):
+            return False
+        self._grant(host)
+        return True
+
+    def release(self, host):
+        self.active = max(self.active - 1, 0)
+        self.active_per_host[host] -= 1
+        if self.active_per_host[host] <= 0:
+            del self.active_per_host[host]
+        self._dispatch()
+
+    def _remove(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+        if not entry[2].done():
+            entry[2].cancel()
+
+    def _dispatch(self):
+        """按優先級喚醒可獲准的等待者，目標主機已滿的等待者不阻塞其他主機"""
+        if not self.waiters:
+            return
+        granted = False
+        for entry in sorted(self.waiters):
+            if self.active >= self.settings['max_sessions']:
+                break
+            _, _, future, host = entry
+            if future.done():
+                continue
+            if self._has_capacity(host):
+                self._grant(host)
+                future.set_result(True)
+                granted = True
+        if granted:
+            self.waiters = [entry for entry in self.waiters if not entry[2].done()]
+            heapq.heapify(self.waiters)
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'active_per_host': dict(self.active_per_host),
+            'queue_depth': len(self.waiters),
+            'wait_ms': self.wait_time.snapshot(),
+            **self.counters,
         }
-        self.ws_connections = {}
-        self.cleanup_task = None
-        self.connection_semaphores = {}  # 為每個連接ID創建一個信號量
-        
-        self.start_cleanup_task()
-        
-    def start_cleanup_task(self):
-        async def cleanup_inactive_sessions():
-            while True:
-                await asyncio.sleep(60)  # 每分鐘檢查一次
-                await self.cleanup_inactive_sessions(timeout=300)  # 5分鐘無活動則清理
-        
-        if not self.cleanup_task:
-            self.cleanup_task = asyncio.create_task(cleanup_inactive_sessions())
-    
-    async def cleanup_inactive_sessions(self, timeout=300):
-        """清理不活躍的會話"""
-        current_time = time.time()
-        to_close = []
-        
-        async with self.lock:
-            for conn_id, last_time in list(self.last_activity.items()):
-                if current_time - last_time > timeout:
-                    to_close.append(conn_id)
-        
-        for conn_id in to_close:
-            logging.info(f"清理不活躍會話: {conn_id}")
-            await self.close_session(conn_id)
-    
-    
-    async def get_or_create_session(self, connection_id, token):
-        """獲取或創建與特定連接的會話"""
-        async with self.lock:
-            if connection_id in self.active_sessions:
-                self.last_activity[connection_id] = time.time()
-                return self.active_sessions[connection_id]
-            
-            controller = GuacamoleController()
-            
-            if await controller.connect(connection_id, token):
-                self.active_sessions[connection_id] = controller
-                self.last_activity[connection_id] = time.time()
-                return controller
-            
-            return None
-    
-    async def execute_command(self, connection_id, command, token):
-        """在指定連接上執行命令"""
-        # 獲取或創建此連接的信號量
-        if connection_id not in self.connection_semaphores:
-            self.connection_semaphores[connection_id] = asyncio.Semaphore(1)
-        
-        # 使用信號量限制並發
-        async with self.connection_semaphores[connection_id]:
-            try:
-                client = await self.get_or_create_session(connection_id, token)
-                if client:
-                    result = await client.execute_command(command)
-                    self.last_activity[connection_id] = time.time()  # 更新最後活動時間
-                    return {'status': 'success', 'result': f"Command executed: {command}"}
-                else:
-                    return {'status': 'error', 'message': '無法獲取控制器'}
-            except Exception as e:
-                logging.error(f"Error executing command: {e}")
-                return {'status': 'error', 'message': str(e)}
-    
-    async def execute_script(self, connection_id, script, token, ws=None):
-        """執行多行腳本"""
-        # 獲取或創建此連接的信號量
-        if connection_id not in self.connection_semaphores:
-            self.connection_semaphores[connection_id] = asyncio.Semaphore(1)
-        
-        # 使用信號量限制並發
-        async with self.connection_semaphores[connection_id]:
-            script_lines = [line.strip() for line in script.split('\n') if line.strip()]
-            results = []
-            
-            try:
-                if token is None:
-                    token_response = await get_guacamole_token(None)
-                    toekn_data = json.loads(token_response.text)
-                    token = token_data.get('token')
-                    
-                client = await self.get_or_create_session(connection_id, token)
-                if not client:
-                    error_output = {
-                        'line_number': 0,
-                        'command': 'script',
-                        'status': 'error',
-                        'result': "無法獲取控制器"
-                    }
-                    results.append(error_output)
-                    if ws:
-                        await ws.send_json(error_output)
-                    return results
-                
-                for idx, line in enumerate(script_lines):
-                    try:
-                        result = await client.execute_command(line)
-                        output = {
-                            'line_number': idx + 1,
-                            'command': line,
-                            'status': 'success' if result else 'error',
-                            'result': f"Command executed: {line}" if result else "Command failed"
-                        }
-                        results.append(output)
-                        
-                        if ws:
-                            await ws.send_json(output)
-                        
-                        if line.startswith('wait '):
-                            try:
-                                seconds = float(line.split()[1])
-                                await asyncio.sleep(seconds)
-                            except Exception as e:
-                                logging.error(f"Invalid wait command: {str(e)}")
-                    except Exception as e:
-                        error_output = {
-                            'line_number': idx + 1,
-                            'command': line,
-                            'status': 'error',
-                            'result': str(e)
-                        }
-                        results.append(error_output)
-                        if ws:
-                            await ws.send_json(error_output)
-                
-                self.last_activity[connection_id] = time.time()  # 更新最後活動時間
-            
+
+
+class SessionExpiryScheduler:
+    """基於截止時間最小堆的會話過期調度：touch 為 O(log n)，過期舊條目在出堆時惰性丟棄"""
+
+    def __init__(self, on_expire, default_timeout=None):
+        self.on_expire = on_expire
+        self.default_timeout = default_timeout or SESSION_EXPIRY['idle_timeout']
+        self.heap = []       # (deadline, seq, key)
+        self.deadlines = {}  # key -> (deadline, seq)，只有與此一致的堆條目有效
+        self.timeouts = {}   # 按會話設置的空閒超時
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.expired = 0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def set_timeout(self, key, timeout):
+        if timeout:
+            self.timeouts[key] = float(timeout)
+        else:
+            self.timeouts.pop(key, None)
+        self.touch(key, force=True)
+
+    def touch(self, key, force=False):
+        """記錄活動並順延截止時間"""
+        deadline = time.monotonic() + self.timeouts.get(key, self.default_timeout)
+        current = self.deadlines.get(key)
+        if not force and current and deadline - current[0] < SESSION_EXPIRY['touch_granularity']:
+            return
+        self.seq += 1
+        self.deadlines[key] = (deadline, self.seq)
+        heapq.heappush(self.heap, (deadline, self.seq, key))
+        if self.heap[0][1] == self.seq or force:
+            self.wakeup.set()
+        # 舊條目過多時重建堆，避免頻繁活動的會話撐大堆
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, seq, k) for k, (d, seq) in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, key):
+        self.deadlines.pop(key, None)
+        self.timeouts.pop(key, None)
+
+    def expiring_soon(self, window=None):
+        limit = time.monotonic() + (window or SESSION_EXPIRY['expiring_soon_window'])
+        return sum(1 for deadline, _ in self.deadlines.values() if deadline <= limit)
+
+    def remaining(self, key):
+        entry = self.deadlines.get(key)
+        return round(entry[0] - time.monotonic(), 1) if entry else None
+
+    async def _run(self):
+        while True:
+            # 丟棄已被順延或移除的舊條目
+            while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][:2]:
+                heapq.heappop(self.heap)
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, key = heapq.heappop(self.heap)
+            self.deadlines.pop(key, None)
+            self.timeouts.pop(key, None)
+            self.expired += 1
+            asyncio.create_task(self._expire(key))
+
+    async def _expire(self, key):
+        try:
+            await self.on_expire(key)
+        except Exception as e:
+            logging.error(f"清理會話時出錯: {e}")
+
+
+class WarmSessionPool:
+    """為配置或常用的連接保留已完成握手的控制器，取用後在後台補充"""
+
+    def __init__(self, manager, settings=None):
+        self.manager = manager
+        self.settings = {**WARM_POOL, **(settings or {})}
+        self.standby = {}  # connection_id -> (controller, host)
+        self.usage = {}    # connection_id -> deque(使用時間)
+        self.expiry = SessionExpiryScheduler(self._expire, self.settings['max_idle'])
+        self.refill_task = None
+        self.counters = {'hits': 0, 'misses': 0, 'warmed': 0, 'failures': 0, 'evicted': 0}
+
+    def start(self):
+        if self.settings['size'] > 0:
+            self.expiry.start()
+            if self.settings['connections']:
+                self.schedule_refill(self.settings['refill_delay'])
+
+    def record_use(self, connection_id):
+        uses = self.usage.setdefault(connection_id, deque())
+        now = time.monotonic()
+        uses.append(now)
+        while uses and now - uses[0] > self.settings['hot_window']:
+            uses.popleft()
+        if len(self.standby) < self.settings['size']:
+            self.schedule_refill()
+
+    def candidates(self):
+        """按配置順序，再按近期使用次數降序返回待預熱的連接"""
+        now = time.monotonic()
+        hot = []
+        for connection_id, uses in self.usage.items():
+            count = sum(1 for used in uses if now - used <= self.settings['hot_window'])
+            if count >= self.settings['hot_threshold']:
+                hot.append((-count, connection_id))
+        configured = [str(connection_id) for connection_id in self.settings['connections']]
+        return configured + [connection_id for _, connection_id in sorted(hot) if connection_id not in configured]
+
+    def take(self, connection_id):
+        """取出預熱會話，返回 (controller, host) 或 None"""
+        entry = self.standby.pop(connection_id, None)
+        self.expiry.remove(connection_id)
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        controller, host = entry
+        if not controller.automator.connected:
+            self.manager.admission.release(host)
+            asyncio.create_task(controller.disconnect())
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        self.schedule_refill(self.settings['refill_delay'])
+        return entry
+
+    async def evict_one(self, exclude=None):
+        """為真實請求讓出一個准入名額"""
+        for connection_id in list(self.standby):
+            if connection_id != exclude:
+                await self._close(connection_id)
+                self.counters['evicted'] += 1
+                return True
+        return False
+
+    def schedule_refill(self, delay=0):
+        if self.settings['size'] <= 0:
+            return
+        if self.refill_task is None or self.refill_task.done():
+            self.refill_task = asyncio.create_task(self._refill(delay))
+
+    async def _refill(self, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        for connection_id, (controller, _) in list(self.standby.items()):
+            if not controller.automator.connected:
+                await self._close(connection_id)
+        for connection_id in self.candidates():
+            if len(self.standby) >= self.settings['size']:
+                break
+            # 已有活躍會話或正在創建的連接無需預熱
+            if (connection_id in self.standby or connection_id in self.manager.active_sessions or
+                    connection_id in self.manager.pending_sessions):
+                continue
+            try:
+                await self._warm(connection_id)
             except Exception as e:
+                self.counters['failures'] += 1
+                logging.error(f"預熱連接 {connection_id} 失敗: {e}")
+
+    async def _warm(self, connection_id):
+        token = await token_cache.get_token()
+        controller = GuacamoleController()
+        controller.automator.token = token
+        details = await controller.automator.get_connection_details(connection_id)
+        host = details['parameters'].get('hostname') or f'connection:{connection_id}'
+        if not self.manager.admission.try_acquire(host):
+            return
+        try:
+            connected = await asyncio.wait_for(controller.connect(connection_id, token),
+                                               timeout=self.manager.admission.settings['connect_timeout'])
+        except BaseException:
+            self.manager.admission.release(host)
+            await controller.disconnect()
+            raise
+        # 預熱期間若出現排隊的真實請求，立即讓出名額
+        if not connected or connection_id in self.manager.active_sessions or self.manager.admission.waiters:
+            await controller.disconnect()
+            self.manager.admission.release(host)
+            return
+        controller.origin = 'warm'
+        self.standby[connection_id] = (controller, host)
+        self.expiry.touch(connection_id)
+        self.counters['warmed'] += 1
+        logging.info(f"已預熱連接 {connection_id}")
+
+    async def _expire(self, connection_id):
+        await self._close(connection_id)
+
+    async def _close(self, connection_id):
+        self.expiry.remove(connection_id)
+        entry = self.standby.pop(connection_id, None)
+        if entry:
+            controller, host = entry
+            self.manager.admission.release(host)
+            await controller.disconnect()
+
+    def stats(self):
+        return {'standby': sorted(self.standby), **self.counters}
+
+
+class GuacamoleSessionManager:
+    def __init__(self, admission_settings=None, warm_pool_settings=None):
+        self.active_sessions = {}
+        self.last_activity = {}
+        self.connection_locks = {}  # 按連接ID加鎖，慢連接只阻塞同一連接
+        self.pending_sessions = {}  # 正在創建的會話，同一連接的並發請求共用一次連接
+        self.ws_connections = {}  # connection_id -> 查看者 WebSocket 集合
+        self.connection_semaphores = {}  # 每個連接同時執行的命令/腳本數，上限為 SCRIPT_JOBS['per_connection']
+        self.slot_users = Counter()  # connection_id -> 持有或等待執行名額的調用數，期間會話不會過期
+        self.script_runs = {}  # run_id -> 執行腳本的任務，供其他進程取消
+        self.expiry = SessionExpiryScheduler(self._expire_session)
+        self.expiry.start()
+        self.admission = SessionAdmission(admission_settings)
+        self.session_hosts = {}  # connection_id -> 佔用准入名額的目標主機
+        self.warm_pool = WarmSessionPool(self, warm_pool_settings)
+        self.on_session_closed = None  # 會話關閉回調，共享註冊表用於釋放記錄
+        self.warm_pool.start()
+        self.first_command_latency = {}  # 會話來源(new/warm) -> 建立會話後首條命令的 LatencyStats
+        self.awaiting_first_command = set()  # 已建立但尚未執行過命令的會話
+    
+    def touch(self, connection_id):
+        """記錄會話活動並順延其空閒截止時間"""
+        if connection_id in self.active_sessions:
+            self.last_activity[connection_id] = time.time()
+            self.expiry.touch(connection_id)
+    
+    def set_idle_timeout(self, connection_id, timeout):
+        """為單個會話設置空閒超時(秒)，None 恢復默認值"""
+        if connection_id in self.active_sessions:
+            self.expiry.set_timeout(connection_id, timeout)
+    
+    async def _expire_session(self, connection_id):
+        if self.slot_users.get(connection_id):
+            # 長腳本執行期間不關閉會話
+            self.touch(connection_id)
+            return
+        logging.info(f"清理不活躍會話: {connection_id}")
+        await self.close_session(connection_id)
+    
+    
+    def _connection_lock(self, connection_id):
+        lock = self.connection_locks.get(connection_id)
+        if lock is None:
+            lock = self.connection_locks[connection_id] = asyncio.Lock()
+        return lock
+    
+    async def get_or_create_session(self, connection_id, token, idle_timeout=None, priority=0):
+        """獲取或創建與特定連接的會話，新會話需先通過准入控制"""
+        controller = self.active_sessions.get(connection_id)
+        if controller is not None:
+            self.touch(connection_id)
+            self.warm_pool.record_use(connection_id)
+            return controller
+        
+        pending = self.pending_sessions.get(connection_id)
+        if pending is None:
+            # 連接在獨立任務中進行，發起請求的查看者斷開不會取消其他等待同一會話的調用者
+            self.warm_pool.record_use(connection_id)
+            pending = asyncio.create_task(self._create_session(connection_id, token, idle_timeout, priority))
+            self.pending_sessions[connection_id] = pending
+            pending.add_done_callback(functools.partial(settle_single_flight, self.pending_sessions, connection_id))
+        return await asyncio.shield(pending)
+    
+    async def _create_session(self, connection_id, token, idle_timeout, priority):
+        async with self._connection_lock(connection_id):
+            controller = await self._admit_and_connect(connection_id, token, priority)
+            if controller:
+                self.active_sessions[connection_id] = controller
+                self.awaiting_first_command.add(connection_id)
+                self.last_activity[connection_id] = time.time()
+                self.expiry.set_timeout(connection_id, idle_timeout)
+        return controller
+    
+    async def _admit_and_connect(self, connection_id, token, priority):
+        # 預熱池中的會話已佔用准入名額，直接轉為活躍會話
+        warm = self.warm_pool.take(connection_id)
+        if warm:
+            controller, host = warm
+            self.session_hosts[connection_id] = host
+            return controller
+        
+        controller = GuacamoleController()
+        controller.automator.token = token
+        details = await controller.automator.get_connection_details(connection_id)
+        host = details['parameters'].get('hostname') or f'connection:{connection_id}'
+        
+        if not self.admission._has_capacity(host):
+            await self.warm_pool.evict_one(exclude=connection_id)
+        await self.admission.acquire(host, priority)
+        try:
+            connected = await asyncio.wait_for(controller.connect(connection_id, token),
+                                               timeout=self.admission.settings['connect_timeout'])
+        except asyncio.TimeoutError:
+            logging.error(f"連接 {connection_id} 超時 ({self.admission.settings['connect_timeout']} 秒)")
+            connected = False
+        except BaseException:
+            self.admission.release(host)
+            raise
+        if not connected:
+            await controller.disconnect()
+            self.admission.release(host)
+            return None
+        controller.origin = 'new'
+        self.session_hosts[connection_id] = host
+        return controller
+    
+    def _record_first_command(self, connection_id, source, started):
+        """返回本次調用的耗時；僅當本次調用建立了會話且為其首條命令時計入 first_command_ms"""
+        latency_ms = round((time.perf_counter() - started) * 1000, 2)
+        if connection_id in self.awaiting_first_command:
+            self.awaiting_first_command.discard(connection_id)
+            if source != 'active':
+                self.first_command_latency.setdefault(source, LatencyStats()).record(latency_ms)
+        return latency_ms
+    
+    async def _acquire_slot(self, connection_id, wait):
+        """取得連接的執行名額；wait 為 False 且名額已滿時拋出 ConnectionBusy，不靜默排隊"""
+        semaphore = self.connection_semaphores.get(connection_id)
+        if semaphore is None:
+            semaphore = self.connection_semaphores[connection_id] = asyncio.Semaphore(SCRIPT_JOBS['per_connection'])
+        if not wait and semaphore.locked():
+            raise ConnectionBusy(f"連接 {connection_id} 正在執行其他命令或腳本")
+        self.slot_users[connection_id] += 1
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            self._leave_slot(connection_id)
+            raise
+        return semaphore
+    
+    def _release_slot(self, connection_id, semaphore):
+        semaphore.release()
+        self._leave_slot(connection_id)
+    
+    def _leave_slot(self, connection_id):
+        self.slot_users[connection_id] -= 1
+        if self.slot_users[connection_id] <= 0:
+            del self.slot_users[connection_id]
+            if connection_id not in self.active_sessions:
+                self.connection_semaphores.pop(connection_id, None)
+    
+    def cancel_script(self, run_id):
+        """取消本進程中正在執行的腳本，當前行已按下的按鍵會被釋放"""
+        task = self.script_runs.get(run_id)
+        if task is not None:
+            task.cancel()
+    
+    async def execute_command(self, connection_id, command, token, priority=0, wait=False):
+        """在指定連接上執行命令"""
+        semaphore = await self._acquire_slot(connection_id, wait)
+        try:
+            started = time.perf_counter()
+            source = 'active' if connection_id in self.active_sessions else None
+            client = await self.get_or_create_session(connection_id, token, priority=priority)
+            if client:
+                result = await client.execute_command(command)
+                self.touch(connection_id)  # 更新最後活動時間
+                source = source or getattr(client, 'origin', 'new')
+                return {'status': 'success', 'result': f"Command executed: {command}",
+                        'session': source, 'latency_ms': self._record_first_command(connection_id, source, started)}
+            else:
+                return {'status': 'error', 'message': '無法獲取控制器'}
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            logging.error(f"Error executing command: {e}")
+            return {'status': 'error', 'message': str(e)}
+        finally:
+            self._release_slot(connection_id, semaphore)
+    
+    async def execute_script(self, connection_id, script, token, ws=None, priority=0, wait=False, run_id=None):
+        """執行多行腳本；wait 為 False 時連接正忙直接拒絕，run_id 供 cancel_script 跨進程取消"""
+        # 先編譯，語法錯誤時不必建立會話
+        results = []
+        try:
+            compiled = get_script_compiler().compile(script)
+        except ScriptError as e:
+            error_output = {
+                'line_number': e.line_number,
+                'command': 'script',
+                'status': 'error',
+                'result': str(e)
+            }
+            if ws:
+                await ws.send_json(error_output)
+            return [error_output]
+        
+        semaphore = await self._acquire_slot(connection_id, wait)
+        if run_id is not None:
+            self.script_runs[run_id] = asyncio.current_task()
+        try:
+            started = time.perf_counter()
+            source = 'active' if connection_id in self.active_sessions else None
+            if token is None:
+                token = await token_cache.get_token()
+                
+            client = await self.get_or_create_session(connection_id, token, priority=priority)
+            if not client:
                 error_output = {
                     'line_number': 0,
                     'command': 'script',
                     'status': 'error',
-                    'result': f"Failed to execute script: {str(e)}"
+                    'result': "無法獲取控制器"
                 }
                 results.append(error_output)
                 if ws:
                     await ws.send_json(error_output)
+                return results
+            
+            for idx, line in enumerate(compiled.lines):
+                try:
+                    self.touch(connection_id)  # 逐行順延空閒截止時間
+                    await client.run_line(line)
+                    output = {
+                        'line_number': line.number,
+                        'command': line.text,
+                        'status': 'success',
+                        'result': f"Command executed: {line.text}"
+                    }
+                    if idx == 0:
+                        source = source or getattr(client, 'origin', 'new')
+                        output['session'] = source
+                        output['latency_ms'] = self._record_first_command(connection_id, source, started)
+                    results.append(output)
+                    
+                    if ws:
+                        await ws.send_json(output)
+                except Exception as e:
+                    error_output = {
+                        'line_number': line.number,
+                        'command': line.text,
+                        'status': 'error',
+                        'result': str(e)
+                    }
+                    results.append(error_output)
+                    if ws:
+                        await ws.send_json(error_output)
             
-            return results
+            self.touch(connection_id)  # 更新最後活動時間
+        
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            error_output = {
+                'line_number': 0,
+                'command': 'script',
+                'status': 'error',
+                'result': f"Failed to execute script: {str(e)}"
+            }
+            results.append(error_output)
+            if ws:
+                await ws.send_json(error_output)
+        finally:
+            if run_id is not None:
+                self.script_runs.pop(run_id, None)
+            self._release_slot(connection_id, semaphore)
+        
+        return results
+    
+    async def close_session(self, connection_id):
+        """關閉指定的會話"""
+        async with self._connection_lock(connection_id):
+            controller = self.active_sessions.pop(connection_id, None)
+            if controller is None:
+                return
+            self.awaiting_first_command.discard(connection_id)
+            self.last_activity.pop(connection_id, None)
+            self.expiry.remove(connection_id)
+            host = self.session_hosts.pop(connection_id, None)
+            if host is not None:
+                self.admission.release(host)
+            self.warm_pool.schedule_refill(self.warm_pool.settings['refill_delay'])
+            if self.on_session_closed:
+                self.on_session_closed(connection_id)
+            if connection_id not in self.slot_users:
+                # 仍有調用者持有名額時保留信號量，否則下一個調用者會拿到新信號量而繞過上限
+                self.connection_semaphores.pop(connection_id, None)
+            viewers = self.ws_connections.pop(connection_id, set())
+            try:
+                # 先關閉所有查看者的WebSocket連接
+                for ws in viewers:
+                    if not ws.closed:
+                        await ws.close()
+                
+                # 然後關閉控制器
+                await controller.disconnect()
+            except Exception as e:
+                logging.error(f"Error closing session: {e}")
+    
+    def get_session_stats(self):
+        """返回所有活躍會話的狀態與性能指標"""
+        stats = {}
+        for conn_id, controller in list(self.active_sessions.items()):
+            automator = controller.automator
+            stats[conn_id] = {
+                'instance_id': controller.instance_id,
+                'connected': automator.connected,
+                'last_activity': self.last_activity.get(conn_id),
+                'expires_in': self.expiry.remaining(conn_id),
+                'connect_timings': controller.connect_timings,
+                'mouse': controller.mouse_stats,
+                'frame_latency': automator.frame_latency.snapshot(),
+                'pending_syncs': len(automator.pending_syncs),
+                'viewers': {viewer_id: {**queue.stats(), 'read_only': queue.read_only}
+                            for viewer_id, queue in automator.viewer_queues.items()},
+            }
+        return stats
+
+    async def collect_stats(self):
+        """匯總會話、准入與預熱池狀態，供 /sessions 使用"""
+        return {
+            'sessions': self.get_session_stats(),
+            'expiring_soon': self.expiry.expiring_soon(),
+            'admission': self.admission.stats(),
+            'warm_pool': self.warm_pool.stats(),
+            'first_command_ms': {source: latency.snapshot()
+                                 for source, latency in self.first_command_latency.items()},
+        }
+
+    def register_websocket(self, connection_id, ws):
+        """註冊WebSocket連接到特定連接ID，同一連接可有多個查看者"""
+        self.ws_connections.setdefault(connection_id, set()).add(ws)
+    
+    def unregister_websocket(self, connection_id, ws):
+        """取消註冊WebSocket連接"""
+        viewers = self.ws_connections.get(connection_id)
+        if viewers is not None:
+            viewers.discard(ws)
+            if not viewers:
+                del self.ws_connections[connection_id]
     
+    async def broadcast_to_connection(self, connection_id, message):
+        """向特定連接的所有WebSocket客戶端廣播消息"""
+        for ws in list(self.ws_connections.get(connection_id, ())):
+            if not ws.closed:
+                await ws.send_json(message)
+
+
+
+IPC_HEADER = struct.Struct('!II')  # JSON 頭長度, 二進制載荷長度
+
+
+def ipc_encode(message, payload=b''):
+    """IPC 消息格式：8 字節長度頭 + JSON 頭 + 可選的原始字節載荷（查看者幀不做 base64）"""
+    header = json.dumps(message).encode('utf-8')
+    return IPC_HEADER.pack(len(header), len(payload)) + header + payload
+
+
+async def ipc_read(reader):
+    header_size, payload_size = IPC_HEADER.unpack(await reader.readexactly(IPC_HEADER.size))
+    message = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b''
+    return message, payload
+
+
+def worker_for(connection_id, count):
+    """按連接ID穩定地映射到工作進程，保證預熱連接只在一個進程中預熱"""
+    return int(hashlib.sha1(str(connection_id).encode('utf-8')).hexdigest(), 16) % count
+
+
+class SessionWorkerError(Exception):
+    """工作進程不可用或返回錯誤"""
+
+
+class IPCChannel:
+    """一條 IPC 連接的寫端，請求回覆與查看者幀共用
+
+    寫入不等待 drain：查看者幀按 sink 分配發送額度，對端轉發一幀後確認一次，
+    慢查看者只會耗盡自己的額度，不會阻塞同一連接上的回覆與其他查看者。
+    """
+
+    def __init__(self, writer, counters=None, window=None):
+        self.writer = writer
+        self.counters = counters if counters is not None else {'frames': 0, 'frame_bytes': 0}
+        self.window = window or SESSION_WORKERS['sink_queue']
+        self.credits = {}  # sink -> asyncio.Semaphore
+
+    @property
+    def closed(self):
+        return self.writer.is_closing()
+
+    def send(self, message, payload=b''):
+        if self.closed:
+            raise ConnectionError("IPC 連接已斷開")
+        if payload:
+            self.counters['frames'] += 1
+            self.counters['frame_bytes'] += len(payload)
+        self.writer.write(ipc_encode(message, payload))
+
+    async def send_frame(self, sink, kind, payload):
+        """等待該 sink 的發送額度後發送一幀，只阻塞該 sink 的發送方"""
+        credits = self.credits.get(sink)
+        if credits is None:
+            credits = self.credits[sink] = asyncio.Semaphore(self.window)
+        await credits.acquire()
+        self.send({'event': 'sink', 'sink': sink, 'kind': kind}, payload)
+
+    def ack(self, sink, count=1):
+        credits = self.credits.get(sink)
+        if credits is not None:
+            for _ in range(count):
+                credits.release()
+
+    def close_sink(self, sink):
+        self.credits.pop(sink, None)
+
+    def abort(self):
+        """連接斷開時喚醒等待額度的發送方，使其在 send 中收到 ConnectionError"""
+        for credits in self.credits.values():
+            for _ in range(self.window):
+                credits.release()
+        self.credits.clear()
+
+
+class WorkerSocketProxy:
+    """代替查看者 WebSocket 的對象，輸出經 IPC 交給請求方進程轉發"""
+
+    def __init__(self, channel, sink):
+        self.channel = channel
+        self.sink = sink
+        self.closed = False
+
+    async def send_str(self, data):
+        await self.channel.send_frame(self.sink, 'str', data.encode('utf-8'))
+
+    async def send_bytes(self, data):
+        await self.channel.send_frame(self.sink, 'bytes', data)
+
+    async def send_json(self, data):
+        await self.send_str(json.dumps(data))
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.channel.close_sink(self.sink)
+            if not self.channel.closed:
+                self.channel.send({'event': 'sink_closed', 'sink': self.sink})
+
+
+class SessionEndpoint:
+    """在 IPC 上提供本進程的會話操作，供主進程路由器或其他 Caldera 實例調用"""
+
+    def __init__(self, manager=None):
+        self.manager = manager
+        self.proxies = {}  # sink -> WorkerSocketProxy
+        self.counters = {'requests': 0, 'errors': 0, 'frames': 0, 'frame_bytes': 0}
+
+    async def handle_connection(self, reader, writer):
+        channel = IPCChannel(writer, self.counters)
+        try:
+            while True:
+                message, payload = await ipc_read(reader)
+                asyncio.create_task(self._handle(channel, message))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            channel.abort()
+            # 請求方斷開後清理其訂閱的查看者
+            for sink, proxy in list(self.proxies.items()):
+                if proxy.channel is channel:
+                    await self.op_unsubscribe(channel, proxy.connection_id, sink)
+            writer.close()
+
+    async def _handle(self, channel, message):
+        request_id = message.pop('id', None)
+        op = message.pop('op')
+        self.counters['requests'] += 1
+        try:
+            result = await getattr(self, f'op_{op}')(channel, **message)
+            reply = {'id': request_id, 'result': result}
+        except AdmissionRejected as e:
+            reply = {'id': request_id, 'error': str(e), 'kind': 'admission', 'retry_after': e.retry_after}
+        except Exception as e:
+            self.counters['errors'] += 1
+            logging.error(f"IPC 請求 {op} 處理失敗: {e}")
+            reply = {'id': request_id, 'error': str(e)}
+        if request_id is not None:
+            try:
+                channel.send(reply)
+            except ConnectionError:
+                pass
+
+    async def op_open(self, channel, connection_id, token, idle_timeout=None, priority=0):
+        controller = await self.manager.get_or_create_session(connection_id, token, idle_timeout, priority)
+        return controller is not None
+
+    async def op_execute_command(self, channel, connection_id, command, token, priority=0, wait=False):
+        return await self.manager.execute_command(connection_id, command, token, priority, wait)
+
+    async def op_execute_script(self, channel, connection_id, script, token, sink=None, priority=0,
+                                wait=False, run_id=None):
+        ws = WorkerSocketProxy(channel, sink) if sink else None
+        return await self.manager.execute_script(connection_id, script, token, ws, priority, wait, run_id)
+
+    async def op_cancel_script(self, channel, connection_id, run_id):
+        self.manager.cancel_script(run_id)
+
+    async def op_controller_command(self, channel, connection_id, command):
+        controller = self.manager.active_sessions.get(connection_id)
+        if controller is None:
+            raise SessionWorkerError(f"會話 {connection_id} 不存在")
+        return await controller.execute_command(command)
+
+    async def op_close_session(self, channel, connection_id):
+        await self.manager.close_session(connection_id)
+
+    async def op_touch(self, channel, connection_id):
+        self.manager.touch(connection_id)
+
+    async def op_subscribe(self, channel, connection_id, viewer_id, mode='json', sync_ack=False, read_only=False):
+        proxy = WorkerSocketProxy(channel, viewer_id)
+        proxy.connection_id = connection_id
+        controller = self.manager.active_sessions.get(connection_id)
+        if controller is None:
+            await proxy.close()
+            return
+        self.proxies[viewer_id] = proxy
+        self.manager.register_websocket(connection_id, proxy)
+        bind_viewer(controller.automator, proxy, viewer_id, mode, sync_ack, read_only)
+
+    async def op_unsubscribe(self, channel, connection_id, viewer_id):
+        proxy = self.proxies.pop(viewer_id, None)
+        controller = self.manager.active_sessions.get(connection_id)
+        if controller:
+            unbind_viewer(controller.automator, viewer_id)
+        if proxy:
+            proxy.closed = True
+            self.manager.unregister_websocket(connection_id, proxy)
+
+    async def op_sink_ack(self, channel, sink, count=1):
+        channel.ack(sink, count)
+
+    async def op_viewer_sync(self, channel, connection_id, viewer_id, timestamp=None):
+        controller = self.manager.active_sessions.get(connection_id)
+        if controller:
+            controller.automator.viewer_sync(viewer_id, timestamp)
+
+
+class SessionWorker(SessionEndpoint):
+    """工作進程：持有一部分 GuacamoleController 會話，經 Unix socket 接收主進程的路由請求"""
+
+    def __init__(self, index, path, count):
+        super().__init__()
+        self.index = index
+        self.path = path
+        self.count = count
+        self.loop_lag = LatencyStats()
+        self.done = asyncio.Event()
+
+    async def serve(self):
+        global session_manager, token_cache, rest_client, connection_cache, database
+        rest_client = GuacamoleRestClient()
+        connection_cache = ConnectionDetailsCache()
+        database = await create_database()
+        token_cache = GuacamoleTokenCache()
+        # 准入與預熱名額在工作進程之間平分
+        share = lambda value: -(-value // self.count)
+        configured = [connection_id for connection_id in WARM_POOL['connections']
+                      if worker_for(connection_id, self.count) == self.index]
+        self.manager = session_manager = GuacamoleSessionManager(
+            {'max_sessions': share(SESSION_ADMISSION['max_sessions'])},
+            {'size': share(WARM_POOL['size']), 'connections': configured})
+        monitor = asyncio.create_task(self._monitor_loop())
+        server = await asyncio.start_unix_server(self.handle_connection, path=self.path)
+        async with server:
+            await self.done.wait()
+        monitor.cancel()
+        for connection_id in list(self.manager.active_sessions):
+            await self.manager.close_session(connection_id)
+        await rest_client.close()
+        if database:
+            await database.close()
+
+    async def _monitor_loop(self):
+        # 測量事件循環延遲，反映該進程的 CPU 飽和程度
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(0.5)
+            self.loop_lag.record(max((loop.time() - started - 0.5) * 1000, 0))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            await super().handle_connection(reader, writer)
+        finally:
+            # 主進程斷開後退出，避免留下孤兒進程
+            self.done.set()
+
+    async def op_stats(self, channel):
+        stats = await self.manager.collect_stats()
+        stats['pending_sessions'] = list(self.manager.pending_sessions)
+        stats['load'] = {
+            'pid': os.getpid(),
+            'sessions': len(self.manager.active_sessions),
+            'pending': len(self.manager.pending_sessions),
+            'standby': len(self.manager.warm_pool.standby),
+            'viewers': len(self.proxies),
+            'loop_lag_ms': self.loop_lag.snapshot(),
+            **self.counters,
+        }
+        if resource:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            stats['load']['cpu_seconds'] = round(usage.ru_utime + usage.ru_stime, 2)
+            stats['load']['max_rss_kb'] = usage.ru_maxrss
+        return stats
+
+
+def run_session_worker(index, path, count):
+    """工作進程入口"""
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s worker-{index} %(levelname)s %(message)s')
+    asyncio.run(SessionWorker(index, path, count).serve())
+
+
+class SessionIPCClient:
+    """到另一個進程 SessionEndpoint 的 IPC 客戶端"""
+
+    def __init__(self, router, path, index=None):
+        self.router = router
+        self.path = path
+        self.index = index
+        self.reader = None
+        self.writer = None
+        self.pending = {}  # request_id -> Future
+        self.seq = 0
+        self.load = {}
+        self.read_task = None
+
+    @property
+    def alive(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.read_task = asyncio.create_task(self._read_loop())
+
+    async def call(self, op, timeout=None, **args):
+        if not self.alive:
+            raise SessionWorkerError(f"{self.path} 不可用")
+        self.seq += 1
+        request_id = self.seq
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.writer.write(ipc_encode({'id': request_id, 'op': op, **args}))
+            await self.writer.drain()
+            reply = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+        if 'error' in reply:
+            if reply.get('kind') == 'admission':
+                raise AdmissionRejected(reply['error'], reply.get('retry_after', 1))
+            raise SessionWorkerError(reply['error'])
+        return reply['result']
+
+    def notify(self, op, **args):
+        """不等待回覆的單向消息，用於查看者訂閱與 sync 等同步調用處"""
+        if self.alive:
+            self.writer.write(ipc_encode({'op': op, **args}))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                message, payload = await ipc_read(self.reader)
+                if 'id' in message:
+                    future = self.pending.get(message['id'])
+                    if future and not future.done():
+                        future.set_result(message)
+                elif message.get('event') == 'sink':
+                    self.router.deliver(self, message['sink'], message['kind'], payload)
+                elif message.get('event') == 'sink_closed':
+                    self.router.close_sink(message['sink'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            return
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(SessionWorkerError(f"{self.path} 已斷開"))
+        if not self.router.stopping:
+            await self.router.client_lost(self)
+
+    async def stop(self):
+        if self.read_task:
+            self.read_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class SessionWorkerClient(SessionIPCClient):
+    """主進程到單個工作進程的 IPC 通道，負責啟動該進程"""
+
+    def __init__(self, router, index):
+        super().__init__(router, os.path.join(router.settings['socket_dir'], f'worker-{index}.sock'), index)
+        self.process = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=run_session_worker, name=f'guacaldera-worker-{self.index}',
+                                       args=(self.index, self.path, self.router.settings['count']), daemon=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.process.start)
+        deadline = loop.time() + self.router.settings['start_timeout']
+        while True:
+            try:
+                await self.connect()
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline or not self.process.is_alive():
+                    raise SessionWorkerError(f"工作進程 {self.index} 啟動失敗")
+                await asyncio.sleep(0.1)
+        logging.info(f"會話工作進程 {self.index} 已啟動 (pid {self.process.pid})")
+
+    async def stop(self):
+        await super().stop()
+        if self.process and self.process.is_alive():
+            # 關閉 socket 後工作進程會自行清理會話並退出
+            await asyncio.get_running_loop().run_in_executor(None, self.process.join, 5)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+class RemoteViewerHub:
+    """主進程側的查看者扇出代理：訂閱請求轉交工作進程，幀經 IPC 回到本進程的 WebSocket"""
+
+    def __init__(self, router, connection_id):
+        self.router = router
+        self.connection_id = connection_id
+        self.read_only = {}  # viewer_id -> 是否只讀，控制權在本進程按 VIEWER_SHARING 分配
+
+    def subscribe(self, viewer_id, ws, mode='json', read_only=False, sync_ack=False):
+        self.read_only.pop(viewer_id, None)
+        controllers = sum(1 for flag in self.read_only.values() if not flag)
+        read_only = self.read_only[viewer_id] = bool(read_only) or controllers >= VIEWER_SHARING['max_controllers']
+        self.router.open_sink(viewer_id, ws)
+        self.router.notify(self.connection_id, 'subscribe', viewer_id=viewer_id, mode=mode,
+                           sync_ack=bool(sync_ack), read_only=read_only)
+
+    def unsubscribe(self, viewer_id):
+        self.read_only.pop(viewer_id, None)
+        self.router.notify(self.connection_id, 'unsubscribe', viewer_id=viewer_id)
+        self.router.drop_sink(viewer_id)
+
+    def is_read_only(self, viewer_id):
+        return self.read_only.get(viewer_id, True)
+
+
+class RemoteAutomator:
+    def __init__(self, router, connection_id):
+        self.router = router
+        self.connection_id = connection_id
+        self.connected = True
+        self.viewer_hub = RemoteViewerHub(router, connection_id)
+
+    def viewer_sync(self, viewer_id, timestamp=None):
+        self.router.notify(self.connection_id, 'viewer_sync', viewer_id=viewer_id, timestamp=timestamp)
+
+
+class RemoteSessionController:
+    """代表工作進程中的會話，提供處理器用到的 GuacamoleController 接口"""
+
+    def __init__(self, router, connection_id):
+        self.router = router
+        self.connection_id = connection_id
+        self.automator = RemoteAutomator(router, connection_id)
+        self.origin = 'worker'
+
+    async def execute_command(self, command):
+        return await self.router.call(self.connection_id, 'controller_command', command=command)
+
+
+class SessionWorkerRouter:
+    """啟用工作進程池時代替 GuacamoleSessionManager：按連接ID把會話路由到工作進程"""
+
+    def __init__(self, settings=None):
+        self.settings = {**SESSION_WORKERS, **(settings or {})}
+        self.workers = [SessionWorkerClient(self, index) for index in range(self.settings['count'])]
+        self.owners = {}           # connection_id -> 工作進程編號
+        self.active_sessions = {}  # connection_id -> RemoteSessionController
+        self.ws_connections = {}
+        self.sinks = {}            # sink -> (ws, asyncio.Queue, task)
+        self.sink_drops = 0
+        self.stats_task = None
+        self.stopping = False
+
+    async def start(self):
+        ensure_private_dir(self.settings['socket_dir'])
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+        self.stats_task = asyncio.create_task(self._stats_loop())
+
+    async def stop(self):
+        self.stopping = True
+        if self.stats_task:
+            self.stats_task.cancel()
+        await asyncio.gather(*(worker.stop() for worker in self.workers), return_exceptions=True)
+        for sink in list(self.sinks):
+            self.drop_sink(sink)
+
+    def _assign(self, connection_id):
+        index = self.owners.get(connection_id)
+        if index is None:
+            if str(connection_id) in map(str, WARM_POOL['connections']):
+                index = worker_for(connection_id, len(self.workers))
+            else:
+                # 新會話交給負載最低的工作進程，之後固定路由
+                assigned = Counter(self.owners.values())
+                index = min((worker for worker in self.workers if worker.alive),
+                            key=lambda worker: (assigned[worker.index], worker.load.get('sessions', 0)),
+                            default=self.workers[0]).index
+            self.owners[connection_id] = index
+        return self.workers[index]
+
+    async def call(self, connection_id, op, timeout=-1, **args):
+        if timeout == -1:
+            timeout = self.settings['request_timeout']
+        worker = self._assign(connection_id)
+        return await worker.call(op, timeout, connection_id=connection_id, **args)
+
+    def notify(self, connection_id, op, **args):
+        self._assign(connection_id).notify(op, connection_id=connection_id, **args)
+
+    async def get_or_create_session(self, connection_id, token, idle_timeout=None, priority=0):
+        connected = await self.call(connection_id, 'open', token=token, idle_timeout=idle_timeout, priority=priority)
+        if not connected:
+            return None
+        controller = self.active_sessions.get(connection_id)
+        if controller is None:
+            controller = self.active_sessions[connection_id] = RemoteSessionController(self, connection_id)
+        return controller
+
+    async def execute_command(self, connection_id, command, token, priority=0, wait=False):
+        try:
+            return await self.call(connection_id, 'execute_command', command=command, token=token,
+                                   priority=priority, wait=wait)
+        except SessionWorkerError as e:
+            return {'status': 'error', 'message': str(e)}
+
+    async def execute_script(self, connection_id, script, token=None, ws=None, priority=0, wait=False, run_id=None):
+        if token is None:
+            token = await token_cache.get_token()
+        run_id = run_id or uuid.uuid4().hex[:12]
+        sink = None
+        if ws is not None:
+            sink = f'script-{uuid.uuid4().hex[:8]}'
+            self.open_sink(sink, ws)
+        try:
+            return await self.call(connection_id, 'execute_script', None, script=script, token=token,
+                                   sink=sink, priority=priority, wait=wait, run_id=run_id)
+        except asyncio.CancelledError:
+            # 本地取消只中斷 IPC 調用，腳本需在執行它的進程中取消並釋放按鍵
+            self.notify(connection_id, 'cancel_script', run_id=run_id)
+            raise
+        finally:
+            if sink:
+                self.drop_sink(sink)
+
+    async def close_session(self, connection_id):
+        if connection_id in self.owners:
+            try:
+                await self.call(connection_id, 'close_session')
+            except SessionWorkerError as e:
+                logging.error(f"Error closing session: {e}")
+        self.owners.pop(connection_id, None)
+        self.active_sessions.pop(connection_id, None)
+
+    def touch(self, connection_id):
+        self.notify(connection_id, 'touch')
+
+    def register_websocket(self, connection_id, ws):
+        self.ws_connections.setdefault(connection_id, set()).add(ws)
+
+    def unregister_websocket(self, connection_id, ws):
+        viewers = self.ws_connections.get(connection_id)
+        if viewers is not None:
+            viewers.discard(ws)
+            if not viewers:
+                del self.ws_connections[connection_id]
+
+    def open_sink(self, sink, ws):
+        self.drop_sink(sink)
+        queue = asyncio.Queue()
+        self.sinks[sink] = (ws, queue, asyncio.create_task(self._forward(sink, ws, queue)))
+
+    def drop_sink(self, sink):
+        entry = self.sinks.pop(sink, None)
+        if entry:
+            entry[2].cancel()
+
+    def deliver(self, client, sink, kind, payload):
+        """由共享的 IPC 讀循環調用，不得等待：幀放入該查看者的隊列，轉發後再向發送方確認"""
+        entry = self.sinks.get(sink)
+        if entry is None or entry[1].qsize() >= self.settings['sink_queue']:
+            # 查看者已離開，或對端未遵守發送額度：丟棄並立即歸還額度
+            if entry is not None:
+                self.sink_drops += 1
+            client.notify('sink_ack', sink=sink)
+            return
+        entry[1].put_nowait((kind, payload, client))
+
+    def close_sink(self, sink):
+        entry = self.sinks.get(sink)
+        if entry:
+            entry[1].put_nowait(('close', b'', None))
+
+    async def _forward(self, sink, ws, queue):
+        try:
+            while True:
+                kind, payload, client = await queue.get()
+                try:
+                    if ws.closed:
+                        continue
+                    if kind == 'bytes':
+                        await ws.send_bytes(payload)
+                    elif kind == 'str':
+                        await ws.send_str(payload.decode('utf-8'))
+                    else:
+                        await ws.close()
+                finally:
+                    if client is not None:
+                        client.notify('sink_ack', sink=sink)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.warning(f"轉發工作進程輸出失敗: {e}")
+
+    async def client_lost(self, worker):
+        logging.error(f"會話工作進程 {worker.index} 已退出，重新啟動")
+        for connection_id, index in list(self.owners.items()):
+            if index == worker.index:
+                self.owners.pop(connection_id, None)
+                self.active_sessions.pop(connection_id, None)
+                for ws in self.ws_connections.pop(connection_id, ()):
+                    if not ws.closed:
+                        await ws.close()
+        try:
+            await worker.start()
+        except SessionWorkerError as e:
+            logging.error(str(e))
+
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(self.settings['stats_interval'])
+            await self.collect_stats()
+
+    async def collect_stats(self):
+        """匯總各工作進程的會話狀態與負載，並清理已在工作進程中過期的路由"""
+        replies = await asyncio.gather(*(worker.call('stats', self.settings['request_timeout'])
+                                         for worker in self.workers), return_exceptions=True)
+        merged = {'sessions': {}, 'expiring_soon': 0, 'admission': {}, 'warm_pool': {},
+                  'first_command_ms': {}, 'workers': {}, 'sink_drops': self.sink_drops}
+        for worker, reply in zip(self.workers, replies):
+            if isinstance(reply, Exception):
+                merged['workers'][worker.index] = {'alive': False, 'error': str(reply)}
+                continue
+            worker.load = reply['load']
+            merged['workers'][worker.index] = {'alive': True, **reply['load']}
+            merged['sessions'].update({connection_id: {**stats, 'worker': worker.index}
+                                       for connection_id, stats in reply['sessions'].items()})
+            merged['expiring_soon'] += reply['expiring_soon']
+            for key in ('admission', 'warm_pool', 'first_command_ms'):
+                merged[key][worker.index] = reply[key]
+            owned = set(reply['sessions']) | set(reply['warm_pool']['standby']) | set(reply['pending_sessions'])
+            for connection_id, index in list(self.owners.items()):
+                if index == worker.index and connection_id not in owned and connection_id not in self.active_sessions:
+                    self.owners.pop(connection_id, None)
+            for connection_id in list(self.active_sessions):
+                if self.owners.get(connection_id) == worker.index and connection_id not in reply['sessions']:
+                    self.active_sessions.pop(connection_id, None)
+                    self.owners.pop(connection_id, None)
+        return merged
+
+
+
+class PeerSessionRouter(SessionWorkerRouter):
+    """把會話請求轉發到擁有該會話的其他 Caldera 實例"""
+
+    def __init__(self, socket_dir):
+        super().__init__({'count': 0})
+        self.socket_dir = os.path.abspath(socket_dir)
+        self.peers = {}  # 地址 -> SessionIPCClient
+
+    async def route(self, connection_id, address):
+        if os.path.dirname(os.path.abspath(address)) != self.socket_dir:
+            raise SessionWorkerError(f"會話擁有者地址不在 {self.socket_dir} 中: {address}")
+        client = self.peers.get(address)
+        if client is None or not client.alive:
+            client = SessionIPCClient(self, address)
+            try:
+                await client.connect()
+            except OSError as e:
+                raise SessionWorkerError(f"無法連接會話擁有者 {address}: {e}")
+            self.peers[address] = client
+        self.owners[connection_id] = address
+
+    def _assign(self, connection_id):
+        address = self.owners.get(connection_id)
+        if address not in self.peers:
+            raise SessionWorkerError(f"會話 {connection_id} 沒有可用的擁有者")
+        return self.peers[address]
+
+    async def client_lost(self, client):
+        logging.warning(f"會話擁有者 {client.path} 已斷開")
+        self.peers.pop(client.path, None)
+        for connection_id, address in list(self.owners.items()):
+            if address == client.path:
+                self.owners.pop(connection_id, None)
+                self.active_sessions.pop(connection_id, None)
+                for ws in self.ws_connections.pop(connection_id, ()):
+                    if not ws.closed:
+                        await ws.close()
+
+    async def stop(self):
+        self.stopping = True
+        await asyncio.gather(*(client.stop() for client in self.peers.values()), return_exceptions=True)
+        for sink in list(self.sinks):
+            self.drop_sink(sink)
+
+
+class SessionRegistry(ABC):
+    """會話註冊表接口：記錄每個會話由哪個進程持有，供多個 Caldera 實例路由請求"""
+
+    def __init__(self, settings=None):
+        self.settings = {**SESSION_REGISTRY, **(settings or {})}
+        self.instance_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.address = None
+        self.counters = {'claimed': 0, 'taken_over': 0, 'routed': 0, 'released': 0}
+        self.heartbeat_task = None
+
+    async def start(self, address):
+        self.address = address
+        await self.heartbeat()
+        self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.settings['heartbeat'])
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logging.error(f"會話註冊表心跳失敗: {e}")
+
+    @abstractmethod
+    async def claim(self, connection_id):
+        """返回會話擁有者 {'instance_id', 'address'}；無人持有或擁有者已失聯時由本進程佔用"""
+
+    @abstractmethod
+    async def release(self, connection_id):
+        """移除本進程對該會話的記錄"""
+
+    @abstractmethod
+    async def heartbeat(self):
+        """刷新本進程的存活時間"""
+
+    async def close(self):
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+
+    async def stats(self):
+        return {'backend': self.settings['backend'], 'instance_id': self.instance_id, **self.counters}
+
+
+class SqliteSessionRegistry(SessionRegistry):
+    """基於 SQLite 的註冊表，適用於同一主機上的多個進程；數據庫操作在線程池中執行"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS instances ("
+        " instance_id TEXT PRIMARY KEY, address TEXT NOT NULL, heartbeat_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " connection_id TEXT PRIMARY KEY, instance_id TEXT NOT NULL, claimed_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sessions_instance ON sessions (instance_id)",
+    )
+
+    def __init__(self, settings=None):
+        super().__init__(settings)
+        self.lock = threading.Lock()
+        # 所有實例都信任註冊表中的 socket 地址，數據庫必須放在私有目錄中
+        ensure_private_dir(os.path.dirname(os.path.abspath(self.settings['path'])))
+        self.conn = sqlite3.connect(self.settings['path'], timeout=10, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+    def _transaction(self, func, *args):
+        # BEGIN IMMEDIATE 在讀取前取得寫鎖，多個進程同時佔用同一會話時只有一個成功
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+                self.conn.execute('COMMIT')
+                return result
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def _claim(self, connection_id):
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT s.instance_id, i.address, i.heartbeat_at FROM sessions s"
+            " LEFT JOIN instances i ON i.instance_id = s.instance_id WHERE s.connection_id = ?",
+            (connection_id,)).fetchone()
+        if row and row[2] is not None and now - row[2] <= self.settings['stale_after']:
+            return {'instance_id': row[0], 'address': row[1]}
+        self.conn.execute("INSERT OR REPLACE INTO sessions (connection_id, instance_id, claimed_at) VALUES (?, ?, ?)",
+                          (connection_id, self.instance_id, now))
+        self.counters['taken_over' if row else 'claimed'] += 1
+        return {'instance_id': self.instance_id, 'address': self.address}
+
+    async def claim(self, connection_id):
+        owner = await self._run(self._transaction, self._claim, str(connection_id))
+        if owner['instance_id'] != self.instance_id:
+            self.counters['routed'] += 1
+        return owner
+
+    def _release(self, connection_id):
+        self.conn.execute("DELETE FROM sessions WHERE connection_id = ? AND instance_id = ?",
+                          (connection_id, self.instance_id))
+
+    async def release(self, connection_id):
+        await self._run(self._transaction, self._release, str(connection_id))
+        self.counters['released'] += 1
+
+    def _heartbeat(self):
+        self.conn.execute("INSERT OR REPLACE INTO instances (instance_id, address, heartbeat_at) VALUES (?, ?, ?)",
+                          (self.instance_id, self.address, time.time()))
+        # 順帶清理已失聯實例的記錄
+        stale = time.time() - self.settings['stale_after']
+        self.conn.execute("DELETE FROM sessions WHERE instance_id IN"
+                          " (SELECT instance_id FROM instances WHERE heartbeat_at < ?)", (stale,))
+        self.conn.execute("DELETE FROM instances WHERE heartbeat_at < ?", (stale,))
+
+    async def heartbeat(self):
+        await self._run(self._transaction, self._heartbeat)
+
+    def _unregister(self):
+        self.conn.execute("DELETE FROM sessions WHERE instance_id = ?", (self.instance_id,))
+        self.conn.execute("DELETE FROM instances WHERE instance_id = ?", (self.instance_id,))
+
+    async def close(self):
+        await super().close()
+        await self._run(self._transaction, self._unregister)
+        self.conn.close()
+
+    def _stats(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT i.instance_id, i.address, i.heartbeat_at, COUNT(s.connection_id) FROM instances i"
+                " LEFT JOIN sessions s ON s.instance_id = i.instance_id GROUP BY i.instance_id").fetchall()
+        now = time.time()
+        return {instance_id: {'address': address, 'sessions': sessions,
+                              'heartbeat_age': round(now - heartbeat_at, 1)}
+                for instance_id, address, heartbeat_at, sessions in rows}
+
+    async def stats(self):
+        return {**await super().stats(), 'instances': await self._run(self._stats)}
+
+
+SESSION_REGISTRY_BACKENDS = {
+    'sqlite': SqliteSessionRegistry,
+}
+
+
+def create_session_registry():
+    """按配置創建共享會話註冊表，local 或未知後端時返回 None（會話只在本進程中管理）"""
+    backend = SESSION_REGISTRY['backend']
+    if backend == 'local':
+        return None
+    registry_class = SESSION_REGISTRY_BACKENDS.get(backend)
+    if registry_class is None:
+        logging.error(f"未知的會話註冊表後端: {backend}")
+        return None
+    return registry_class()
+
+
+class RegisteredSessionManager:
+    """在共享註冊表上包裝本地會話管理器：會話只在擁有者進程中建立，其他實例的請求經 IPC 轉發"""
+
+    def __init__(self, local, registry):
+        self.local = local
+        self.registry = registry
+        self.peers = PeerSessionRouter(registry.settings['socket_dir'])
+        self.server = None
+        # 本地管理器的每次關閉(含空閒過期)都經回調釋放記錄；工作進程路由器沒有該回調，由 close_session 釋放
+        self.releases_on_close = isinstance(local, GuacamoleSessionManager)
+        if self.releases_on_close:
+            local.on_session_closed = lambda connection_id: asyncio.create_task(self.registry.release(connection_id))
+
+    async def start(self):
+        socket_dir = ensure_private_dir(self.registry.settings['socket_dir'])
+        address = os.path.join(socket_dir, f'instance-{os.getpid()}.sock')
+        if os.path.exists(address):
+            os.unlink(address)
+        endpoint = SessionEndpoint(self.local)
+        self.server = await asyncio.start_unix_server(endpoint.handle_connection, path=address)
+        await self.registry.start(address)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        await self.peers.stop()
+        await self.registry.close()
+
+    def __getattr__(self, name):
+        return getattr(self.local, name)
+
+    @property
+    def active_sessions(self):
+        return self.local.active_sessions
+
+    def _is_remote(self, connection_id):
+        return connection_id in self.peers.owners
+
+    async def _route(self, connection_id):
+        """返回處理該會話的管理器：本地會話直接處理，否則轉發到擁有者"""
+        if connection_id in self.local.active_sessions:
+            return self.local
+        owner = await self.registry.claim(connection_id)
+        if owner['instance_id'] == self.registry.instance_id:
+            self.peers.owners.pop(connection_id, None)
+            return self.local
+        await self.peers.route(connection_id, owner['address'])
+        return self.peers
+
+    async def _release_failed_claim(self, manager, connection_id, created=False):
+        """本進程佔用記錄後未能建立會話時釋放，避免其他實例路由到沒有會話的擁有者"""
+        if manager is not self.local or created:
+            return
+        if connection_id in getattr(self.local, 'pending_sessions', ()):
+            return
+        await self.registry.release(connection_id)
+
+    async def get_or_create_session(self, connection_id, token, idle_timeout=None, priority=0):
+        manager = await self._route(connection_id)
+        try:
+            controller = await manager.get_or_create_session(connection_id, token, idle_timeout, priority)
+        except Exception:
+            await self._release_failed_claim(manager, connection_id)
+            raise
+        await self._release_failed_claim(manager, connection_id, controller is not None)
+        return controller
+
+    async def _execute(self, connection_id, method, *args):
+        manager = await self._route(connection_id)
+        try:
+            return await getattr(manager, method)(connection_id, *args)
+        finally:
+            # 只有本地管理器的 active_sessions 能反映執行時是否建立了會話
+            if self.releases_on_close:
+                await self._release_failed_claim(manager, connection_id,
+                                                 connection_id in self.local.active_sessions)
+
+    async def execute_command(self, connection_id, command, token, priority=0, wait=False):
+        return await self._execute(connection_id, 'execute_command', command, token, priority, wait)
+
+    async def execute_script(self, connection_id, script, token=None, ws=None, priority=0, wait=False, run_id=None):
+        return await self._execute(connection_id, 'execute_script', script, token, ws, priority, wait, run_id)
+
     async def close_session(self, connection_id):
-        """關閉指定的會話"""
-        async with self.lock:
-            if connection_id in self.active_sessions:
-                try:
-                    # 先關閉WebSocket連接
-                    if connection_id in self.ws_connections:
-                        ws = self.ws_connections[connection_id]
-                        if not ws.closed:
-                            await ws.close()
-                        del self.ws_connections[connection_id]
-                    
-                    # 然後關閉控制器
-                    await self.active_sessions[connection_id].disconnect()
-                except Exception as e:
-                    logging.error(f"Error closing session: {e}")
-                finally:
-                    del self.active_sessions[connection_id]
-                    if connection_id in self.last_activity:
-                        del self.last_activity[connection_id]
-                    if connection_id in self.connection_semaphores:
-                        del self.connection_semaphores[connection_id]
-    
+        if self._is_remote(connection_id):
+            await self.peers.close_session(connection_id)
+            return
+        await self.local.close_session(connection_id)
+        if not self.releases_on_close:
+            await self.registry.release(connection_id)
+
+    def touch(self, connection_id):
+        (self.peers if self._is_remote(connection_id) else self.local).touch(connection_id)
+
     def register_websocket(self, connection_id, ws):
-        """註冊WebSocket連接到特定連接ID"""
-        self.ws_connections[connection_id] = ws
-    
-    def unregister_websocket(self, connection_id):
-        """取消註冊WebSocket連接"""
-        if connection_id in self.ws_connections:
-            del self.ws_connections[connection_id]
-    
-    async def broadcast_to_connection(self, connection_id, message):
-        """向特定連接的所有WebSocket客戶端廣播消息"""
-        if connection_id in self.ws_connections:
-            ws = self.ws_connections[connection_id]
-            if not ws.closed:
-                await ws.send_json(message)
-    
-    async def _get_connection_details(self, connection_id, token):
-        """從Guacamole API獲取連接詳情"""
-        url = f"http://localhost:8080/guacamole/api/session/data/mysql/connections/{connection_id}?token={token}"
+        (self.peers if self._is_remote(connection_id) else self.local).register_websocket(connection_id, ws)
+
+    def unregister_websocket(self, connection_id, ws):
+        (self.peers if self._is_remote(connection_id) else self.local).unregister_websocket(connection_id, ws)
+
+    async def collect_stats(self):
+        stats = await self.local.collect_stats()
+        stats['registry'] = {**await self.registry.stats(), 'remote_sessions': dict(self.peers.owners)}
+        return stats
+
+
+
+class ScriptJob:
+    """一個異步執行的腳本任務"""
+
+    def __init__(self, connection_id, script, priority, total_lines, seq):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.connection_id = connection_id
+        self.script = script
+        self.priority = int(priority or 0)
+        self.total_lines = total_lines
+        self.seq = seq
+        self.status = 'queued'
+        self.results = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+        self.subscribers = set()  # 進度流的 asyncio.Queue
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed', 'cancelled')
+
+    async def send_json(self, data):
+        # 作為 execute_script 的逐行輸出目標
+        self.results.append(data)
+        self.publish({'type': 'line', **data})
+
+    async def send_str(self, data):
+        await self.send_json(json.loads(data))
+
+    @property
+    def closed(self):
+        return self.finished
+
+    def publish(self, event):
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    def to_dict(self, results=False, position=None):
+        job = {
+            'job_id': self.job_id,
+            'connection_id': self.connection_id,
+            'status': self.status,
+            'priority': self.priority,
+            'lines_done': len(self.results),
+            'total_lines': self.total_lines,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if position is not None:
+            job['position'] = position
+        if self.error:
+            job['error'] = self.error
+        if results:
+            job['results'] = list(self.results)
+        return job
+
+
+class ScriptJobManager:
+    """腳本任務隊列：固定數量的工作協程執行任務，每個連接同時運行的任務數受限，其餘任務可見地排隊"""
+
+    def __init__(self, settings=None):
+        self.settings = {**SCRIPT_JOBS, **(settings or {})}
+        self.jobs = OrderedDict()  # job_id -> ScriptJob，按提交順序
+        self.pending = []          # 排隊中的任務
+        self.running = Counter()   # connection_id -> 運行中的任務數
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.workers = []
+        self.counters = {'submitted': 0, 'succeeded': 0, 'failed': 0, 'cancelled': 0}
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.settings['workers'])]
+
+    async def stop(self):
+        for job in list(self.jobs.values()):
+            self.cancel(job.job_id)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, connection_id, script, priority=0):
+        """校驗並登記任務，立即返回；隊列已滿時拋出 AdmissionRejected"""
+        compiled = get_script_compiler().compile(script)
+        if not compiled.lines:
+            raise ValueError("腳本不能為空")
+        if len(self.pending) >= self.settings['max_queue']:
+            raise AdmissionRejected(f"腳本任務隊列已滿 ({len(self.pending)})")
+        self.start()
+        self._prune()
+        self.seq += 1
+        job = ScriptJob(str(connection_id), script, priority, len(compiled.lines), self.seq)
+        self.jobs[job.job_id] = job
+        self.pending.append(job)
+        self.counters['submitted'] += 1
+        self.wakeup.set()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def position(self, job):
+        if job.status != 'queued':
+            return None
+        return sorted(self.pending, key=lambda item: (item.priority, item.seq)).index(job)
+
+    def cancel(self, job_id):
+        """取消排隊中的任務，或中斷運行中的任務；腳本在工作進程或其他實例中運行時取消會轉發過去，當前行已按下的按鍵會被釋放"""
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return job
+        if job.status == 'queued':
+            self.pending.remove(job)
+            self._finish(job, 'cancelled')
+        elif job.task:
+            job.task.cancel()
+        return job
+
+    def _prune(self):
+        # 清理超過保留時間或超出數量上限的已完成任務
+        cutoff = time.time() - self.settings['retention']
+        for job_id, job in list(self.jobs.items()):
+            if len(self.jobs) <= self.settings['max_jobs'] and (job.finished_at or time.time()) >= cutoff:
+                break
+            if job.finished:
+                del self.jobs[job_id]
+
+    def _next_runnable(self):
+        runnable = [job for job in self.pending
+                    if self.running[job.connection_id] < self.settings['per_connection']]
+        if not runnable:
+            return None
+        job = min(runnable, key=lambda item: (item.priority, item.seq))
+        self.pending.remove(job)
+        return job
+
+    async def _worker(self):
+        while True:
+            job = self._next_runnable()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            self.running[job.connection_id] += 1
+            job.status = 'running'
+            job.started_at = time.time()
+            job.publish({'type': 'status', 'status': 'running'})
+            job.task = asyncio.create_task(self._execute(job))
+            try:
+                # asyncio.wait 不會因任務被取消而拋出，工作協程繼續處理下一個任務
+                await asyncio.wait([job.task])
+            finally:
+                self.running[job.connection_id] -= 1
+                if self.running[job.connection_id] <= 0:
+                    del self.running[job.connection_id]
+                self.wakeup.set()
+
+    async def _execute(self, job):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        raise Exception(f"Failed to get connection details: {response.status}")
-                    
-                    data = await response.json()
-                    parameters = data.get('parameters', {}) or {}  # 確保不是None
-                    parameters.setdefault('hostname', '')
-                    parameters.setdefault('port', '3389')
-                    parameters.setdefault('username', '')
-                    parameters.setdefault('password', '')
-                    
-                    return {
-                        'protocol': data.get('protocol', 'rdp').lower(),
-                        'parameters': parameters
-                    }
+            token = await token_cache.get_token()
+            # 任務已在本管理器中排隊，等待連接名額而不是像同步請求那樣被拒絕
+            results = await session_manager.execute_script(job.connection_id, job.script, token, job, job.priority,
+                                                           wait=True, run_id=job.job_id)
+            failed = [output for output in results if output.get('status') != 'success']
+            if failed:
+                job.error = failed[0].get('result')
+            self._finish(job, 'failed' if failed else 'succeeded')
+        except asyncio.CancelledError:
+            self._finish(job, 'cancelled')
         except Exception as e:
-            logging.error(f"Connection detail error: {e}")
-            return {
-                'protocol': 'rdp',
-                'parameters': {
-                    'hostname': '',
-                    'port': '3389',
-                    'username': '',
-                    'password': ''
-                }
-            }
+            job.error = str(e)
+            self._finish(job, 'failed')
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished_at = time.time()
+        self.counters[status] += 1
+        job.publish({'type': 'done', **job.to_dict()})
+        logging.info(f"腳本任務 {job.job_id} ({job.connection_id}) 結束: {status}")
+
+    def stats(self):
+        return {
+            'queued': len(self.pending),
+            'running': sum(self.running.values()),
+            'running_per_connection': dict(self.running),
+            'workers': len(self.workers),
+            **self.counters,
+        }
 
 
+def get_script_jobs():
+    """返回插件共用的腳本任務管理器，未啟用插件時按需創建"""
+    global script_jobs
+    if script_jobs is None:
+        script_jobs = ScriptJobManager()
+    return script_jobs
+
 
 async def enable(services):
-    global docker_client, plugin_root, session_manager
+    global docker_client, plugin_root, session_manager, token_cache, rest_client, connection_cache, connection_index, database, analytics, script_jobs
     app = services.get('app_svc').application
     plugin_root = os.path.dirname(os.path.realpath(__file__))
     
@@ -1174,30 +4171,67 @@ async def enable(services):
     app.router.add_route('POST', '/plugin/guacamole/stop', stop_containers)
     app.router.add_route('GET', '/plugin/guacamole/status', get_status)
     app.router.add_route('POST', '/plugin/guacamole/create_connection', create_connection)
+    app.router.add_route('POST', '/plugin/guacamole/create_connections', create_connections_bulk)
     app.router.add_route('GET', '/plugin/guacamole/list_connections', list_connections)
     app.router.add_route('POST', '/plugin/guacamole/execute_command', execute_command)
     app.router.add_route('POST', '/plugin/guacamole/execute_script', execute_script)
+    app.router.add_route('POST', '/plugin/guacamole/execute_script_batch', execute_script_batch)
+    app.router.add_route('POST', '/plugin/guacamole/script_jobs', submit_script_job)
+    app.router.add_route('GET', '/plugin/guacamole/script_jobs', list_script_jobs)
+    app.router.add_route('GET', '/plugin/guacamole/script_jobs/{job_id}', get_script_job)
+    app.router.add_route('GET', '/plugin/guacamole/script_jobs/{job_id}/stream', stream_script_job)
+    app.router.add_route('DELETE', '/plugin/guacamole/script_jobs/{job_id}', cancel_script_job)
     app.router.add_route('GET', '/plugin/guacamole/get_token', get_guacamole_token)
     app.router.add_route('GET', '/plugin/guacamole/scripts', get_scripts)
+    app.router.add_route('GET', '/plugin/guacamole/sessions', get_sessions)
+    app.router.add_route('GET', '/plugin/guacamole/analytics', get_analytics)
     app.router.add_route('GET', '/plugin/guacamole/ws', websocket_handler)
     app.router.add_route('GET', '/plugin/guacamole/display', display_handler)
     
-    session_manager = GuacamoleSessionManager()
-    asyncio.create_task(periodic_cleanup())
+    if SESSION_WORKERS['enabled']:
+        session_manager = SessionWorkerRouter()
+        await session_manager.start()
+        app.on_shutdown.append(stop_session_workers)
+    else:
+        session_manager = GuacamoleSessionManager()
+    registry = create_session_registry()
+    if registry:
+        session_manager = RegisteredSessionManager(session_manager, registry)
+        await session_manager.start()
+        app.on_shutdown.append(close_session_registry)
+    rest_client = GuacamoleRestClient()
+    connection_cache = ConnectionDetailsCache()
+    connection_index = ConnectionIndex()
+    database = await create_database()
+    analytics = ConnectionAnalytics(database) if database else None
+    token_cache = GuacamoleTokenCache()
+    script_jobs = ScriptJobManager()
+    app.on_shutdown.append(close_rest_client)
+    app.on_shutdown.append(stop_script_jobs)
     try:
         docker_client = docker.from_env()
         logging.info("Docker client initialized successfully")
     except Exception as e:
         logging.error(f"Failed to initialize Docker client: {e}")
 
-async def periodic_cleanup():
-    """定期清理不活躍的會話"""
-    while True:
-        await asyncio.sleep(60)  # 每分鐘檢查一次
-        try:
-            await session_manager.cleanup_inactive_sessions()
-        except Exception as e:
-            logging.error(f"清理會話時出錯: {e}")
+async def close_rest_client(app):
+    """應用關閉時釋放 REST 客戶端與數據庫連接池"""
+    if rest_client:
+        await rest_client.close()
+    if database:
+        await database.close()
+
+async def stop_session_workers(app):
+    """應用關閉時停止會話工作進程"""
+    await session_manager.stop()
+
+async def stop_script_jobs(app):
+    """應用關閉時取消未完成的腳本任務"""
+    await script_jobs.stop()
+
+async def close_session_registry(app):
+    """應用關閉時註銷本實例並釋放其會話記錄"""
+    await session_manager.close()
 
 @template('guacamole.html')
 async def gui(request):
@@ -1207,7 +4241,8 @@ async def get_container_status():
     status = {'guacd': 'stopped', 'guacamole': 'stopped', 'mysql': 'stopped'}
     if docker_client:
         try:
-            containers = docker_client.containers.list(all=True)
+            loop = asyncio.get_running_loop()
+            containers = await loop.run_in_executor(None, functools.partial(docker_client.containers.list, all=True))
             for container in containers:
                 if 'guacd' in container.name:
                     status['guacd'] = container.status
@@ -1225,14 +4260,16 @@ async def start_containers(request):
         return web.json_response({'status': 'error', 'message': 'Docker client not initialized'})
     
     try:
+        # Docker SDK 與初始化腳本下載均為阻塞調用，放到線程池中執行
+        loop = asyncio.get_running_loop()
         network_name = 'guacamole_network'
-        networks = docker_client.networks.list(names=[network_name])
-        network = networks[0] if networks else docker_client.networks.create(network_name)
+        networks = await loop.run_in_executor(None, functools.partial(docker_client.networks.list, names=[network_name]))
+        network = networks[0] if networks else await loop.run_in_executor(None, docker_client.networks.create, network_name)
         
-        mysql_container = start_mysql_container(network)
+        mysql_container = await loop.run_in_executor(None, start_mysql_container, network)
         await asyncio.sleep(15)
-        guacd_container = start_guacd_container(network)
-        guacamole_container = start_guacamole_container(network)
+        guacd_container = await loop.run_in_executor(None, start_guacd_container, network)
+        guacamole_container = await loop.run_in_executor(None, start_guacamole_container, network)
         
         return web.json_response({'status': 'success', 'message': 'Containers started successfully'})
     except PermissionError as e:
@@ -1269,7 +4306,9 @@ def start_mysql_container(network):
                 'MYSQL_USER': 'guacamole_user',
                 'MYSQL_PASSWORD': 'guacamole_pass'
             },
-            volumes={init_db_path: {'bind': '/docker-entrypoint-initdb.d', 'mode': 'ro'}}
+            volumes={init_db_path: {'bind': '/docker-entrypoint-initdb.d', 'mode': 'ro'}},
+            # 啟用數據庫後端時僅在本機暴露 MySQL 端口
+            ports={'3306/tcp': ('127.0.0.1', GUAC_DATABASE['port'])} if GUAC_DATABASE['enabled'] else None
         )
         network.connect(container)
         return container
@@ -1330,9 +4369,12 @@ async def stop_containers(request):
         if not docker_client:
             return web.json_response({'status': 'error', 'message': 'Docker client not initialized'})
         
-        containers = docker_client.containers.list(all=True, filters={'name': ['guacamole', 'guacd', 'guacamole-mysql']})
-        for container in containers:
-            container.stop()
+        def stop_all():
+            containers = docker_client.containers.list(all=True, filters={'name': ['guacamole', 'guacd', 'guacamole-mysql']})
+            for container in containers:
+                container.stop()
+        
+        await asyncio.get_running_loop().run_in_executor(None, stop_all)
         
         return web.json_response({'status': 'success', 'message': 'Containers stopped successfully'})
     except Exception as e:
@@ -1343,122 +4385,311 @@ async def get_status(request):
     status = await get_container_status()
     return web.json_response(status)
 
+def build_connection_payload(data):
+    """根據連接規格生成 Guacamole 連接定義，使用 RDP/SSH/VNC 參數模板"""
+    protocol = (data.get('protocol') or 'RDP').lower()
+    host = data.get('host') or ''
+    port = data.get('port') or (3389 if protocol == 'rdp' else (22 if protocol == 'ssh' else 5900))
+    username = data.get('username') or ''
+    password = data.get('password') or ''
+    name = data.get('name') or f'{protocol.upper()} - {host}'
+    
+    # 驗證主機名不為空
+    if not host or host.strip() == '':
+        raise ValueError('主機名不能為空')
+    
+    connection_data = {
+        'parentIdentifier': data.get('parent') or 'ROOT',
+        'name': name,
+        'protocol': protocol,
+        'parameters': {},
+        'attributes': {
+            'max-connections': '1',
+            'max-connections-per-user': '1',
+            'guacd-hostname': 'guacd',
+            'guacd-port': '4822'
+        }
+    }
+    
+    if protocol == 'rdp':
+        connection_data['parameters'] = {
+            'hostname': host,
+            'port': str(port),
+            'username': username,
+            'password': password,
+            'security': 'nla',
+            'ignore-cert': 'true',
+            'enable-drive': 'true',
+            'create-drive-path': 'true'
+        }
+    elif protocol == 'ssh':
+        connection_data['parameters'] = {
+            'hostname': host,
+            'port': str(port),
+            'username': username,
+            'password': password,
+            'font-size': '12',
+            'color-scheme': 'gray-black',
+            'enable-sftp': 'true'
+        }
+    elif protocol == 'vnc':
+        connection_data['parameters'] = {
+            'hostname': host,
+            'port': str(port),
+            'password': password,
+            'autoretry': 'true'
+        }
+    return connection_data
+
+async def submit_connection(connection_data):
+    """提交連接定義到 Guacamole，返回創建結果"""
+    if database:
+        connection_ids = await database.create_connections([connection_data])
+        get_connection_cache().invalidate(connection_ids[0])
+        return {**connection_data, 'identifier': connection_ids[0]}
+    
+    headers = {'Content-Type': 'application/json'}
+    status, created = await guacamole_request('POST', f'api/session/data/{DATA_SOURCE}/connections',
+                                              json=connection_data, headers=headers)
+    if status != 200:
+        raise GuacamoleAPIError(status, '無法創建連接')
+    
+    # 新連接可能複用已刪除連接的ID，清除可能殘留的舊緩存
+    if isinstance(created, dict) and created.get('identifier'):
+        get_connection_cache().invalidate(created['identifier'])
+    return created
+
 async def create_connection(request):
     if not docker_client:
         return web.json_response({'status': 'error', 'message': 'Docker client not initialized'})
     
     try:
         data = await request.json()
-        protocol = data.get('protocol', 'RDP').lower()
-        host = data.get('host', '')
-        port = data.get('port', 3389 if protocol == 'rdp' else (22 if protocol == 'ssh' else 5900))
-        username = data.get('username', '')
-        password = data.get('password', '')
-        name = data.get('name', f'{protocol.upper()} - {host}')
-        
-        # 驗證主機名不為空
-        if not host or host.strip() == '':
-            return web.json_response({'status': 'error', 'message': '主機名不能為空'})
-        
-        auth_data = {'username': 'guacadmin', 'password': 'guacadmin'}
-        response = requests.post('http://localhost:8080/guacamole/api/tokens', data=auth_data)
-        if response.status_code != 200:
-            return web.json_response({'status': 'error', 'message': f'無法獲取 Guacamole API 令牌，狀態碼: {response.status_code}'})
-        
-        token_data = response.json()
-        auth_token = token_data.get('authToken')
-        
-        connection_data = {
-            'parentIdentifier': 'ROOT',
-            'name': name,
-            'protocol': protocol,
-            'parameters': {},
-            'attributes': {
-                'max-connections': '1',
-                'max-connections-per-user': '1',
-                'guacd-hostname': 'guacd',
-                'guacd-port': '4822'
-            }
-        }
-        
-        if protocol == 'rdp':
-            connection_data['parameters'] = {
-                'hostname': host,
-                'port': str(port),
-                'username': username,
-                'password': password,
-                'security': 'nla',
-                'ignore-cert': 'true',
-                'enable-drive': 'true',
-                'create-drive-path': 'true'
-            }
-        elif protocol == 'ssh':
-            connection_data['parameters'] = {
-                'hostname': host,
-                'port': str(port),
-                'username': username,
-                'password': password,
-                'font-size': '12',
-                'color-scheme': 'gray-black',
-                'enable-sftp': 'true'
-            }
-        elif protocol == 'vnc':
-            connection_data['parameters'] = {
-                'hostname': host,
-                'port': str(port),
-                'password': password,
-                'autoretry': 'true'
-            }
+        try:
+            connection_data = build_connection_payload(data)
+        except ValueError as e:
+            return web.json_response({'status': 'error', 'message': str(e)})
         
-        headers = {'Content-Type': 'application/json'}
-        create_url = f'http://localhost:8080/guacamole/api/session/data/mysql/connections?token={auth_token}'
-        create_response = requests.post(create_url, json=connection_data, headers=headers)
-        if create_response.status_code != 200:
-            return web.json_response({'status': 'error', 'message': f'無法創建連接，狀態碼: {create_response.status_code}'})
+        created = await submit_connection(connection_data)
+        get_connection_index().invalidate()
         
         return web.json_response({
             'status': 'success', 
-            'message': f'成功創建連接 {name}',
-            'connection_id': create_response.json()
+            'message': f'成功創建連接 {connection_data["name"]}',
+            'connection_id': created
         })
     except Exception as e:
         logging.error(f"Error creating connection: {e}")
         return web.json_response({'status': 'error', 'message': str(e)})
 
+async def iter_connection_specs(request):
+    """按請求類型逐行產出 (行號, 連接規格)：JSON 數組、NDJSON 或帶表頭的 CSV；無法解析的行產出異常"""
+    content_type = request.content_type
+    if content_type == 'application/json':
+        specs = await request.json()
+        if not isinstance(specs, list):
+            raise ValueError('請求體必須是連接規格數組')
+        for row, spec in enumerate(specs, 1):
+            yield row, spec if isinstance(spec, dict) else ValueError('連接規格必須是對象')
+        return
+    
+    if content_type in ('text/csv', 'application/csv'):
+        # 整體解析請求體，引號內的字段可以跨行
+        body = await request.text()
+        header = None
+        row = 0
+        for values in csv.reader(io.StringIO(body)):
+            if not any(value.strip() for value in values):
+                continue
+            if header is None:
+                header = [column.strip().lower() for column in values]
+                continue
+            row += 1
+            yield row, dict(zip(header, (value.strip() for value in values)))
+        return
+    
+    row = 0
+    async for raw_line in request.content:
+        line = raw_line.decode('utf-8').strip()
+        if not line:
+            continue
+        row += 1
+        try:
+            spec = json.loads(line)
+            yield row, spec if isinstance(spec, dict) else ValueError('連接規格必須是對象')
+        except json.JSONDecodeError as e:
+            yield row, ValueError(f'無效的 JSON: {e}')
+
+async def create_connections_bulk(request):
+    """批量創建連接，以有限並發共用同一令牌提交，並以 NDJSON 逐行流式返回每行結果"""
+    if not docker_client:
+        return web.json_response({'status': 'error', 'message': 'Docker client not initialized'})
+    
+    started = time.perf_counter()
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    
+    semaphore = asyncio.Semaphore(BULK_CREATE_CONCURRENCY)
+    results = asyncio.Queue()
+    summary = {'total': 0, 'succeeded': 0, 'failed': 0}
+    
+    async def submit(row, spec):
+        try:
+            if isinstance(spec, Exception):
+                raise spec
+            connection_data = build_connection_payload(spec)
+            created = await submit_connection(connection_data)
+            result = {'row': row, 'status': 'success', 'name': connection_data['name'],
+                      'connection_id': created.get('identifier') if isinstance(created, dict) else created}
+        except Exception as e:
+            result = {'row': row, 'status': 'error', 'message': str(e)}
+        finally:
+            semaphore.release()
+        await results.put(result)
+    
+    async def submit_batch(entries):
+        # 數據庫後端：一個事務寫入整批連接，失敗(如名稱重複)時逐行重試以定位出錯的行
+        try:
+            prepared = []
+            for row, spec in entries:
+                try:
+                    if isinstance(spec, Exception):
+                        raise spec
+                    prepared.append((row, build_connection_payload(spec)))
+                except Exception as e:
+                    await results.put({'row': row, 'status': 'error', 'message': str(e)})
+            groups = [prepared] if prepared else []
+            while groups:
+                group = groups.pop(0)
+                try:
+                    connection_ids = await database.create_connections([payload for _, payload in group])
+                except Exception as e:
+                    if len(group) > 1:
+                        groups.extend([item] for item in group)
+                    else:
+                        await results.put({'row': group[0][0], 'status': 'error', 'message': str(e)})
+                    continue
+                for (row, payload), connection_id in zip(group, connection_ids):
+                    get_connection_cache().invalidate(connection_id)
+                    await results.put({'row': row, 'status': 'success', 'name': payload['name'],
+                                       'connection_id': connection_id})
+        finally:
+            semaphore.release()
+    
+    async def write_results():
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            summary['succeeded' if result['status'] == 'success' else 'failed'] += 1
+            await response.write((json.dumps(result, ensure_ascii=False) + '\n').encode('utf-8'))
+    
+    writer = asyncio.create_task(write_results())
+    tasks = set()
+    error = None
+    batch = []
+    
+    def spawn(coro):
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    try:
+        if not database:
+            # 先取得令牌，所有行共用同一令牌提交
+            await token_cache.get_token()
+        async for row, spec in iter_connection_specs(request):
+            summary['total'] += 1
+            if database:
+                batch.append((row, spec))
+                if len(batch) >= database.settings['batch_size']:
+                    await semaphore.acquire()
+                    spawn(submit_batch(batch))
+                    batch = []
+            else:
+                await semaphore.acquire()
+                spawn(submit(row, spec))
+        if batch:
+            await semaphore.acquire()
+            spawn(submit_batch(batch))
+    except Exception as e:
+        logging.error(f"Error in bulk connection creation: {e}")
+        error = str(e)
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await results.put(None)
+        await writer
+        if summary['succeeded']:
+            get_connection_index().invalidate()
+    
+    summary['status'] = 'error' if error else 'done'
+    if error:
+        summary['message'] = error
+    summary['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    await response.write((json.dumps(summary, ensure_ascii=False) + '\n').encode('utf-8'))
+    await response.write_eof()
+    return response
+
 async def list_connections(request):
+    """列出連接，支持 protocol、name_prefix、parent 過濾，offset/limit 分頁與 fields 字段投影"""
+    query = request.query
+    try:
+        offset = int(query.get('offset', 0))
+        limit = int(query['limit']) if query.get('limit') else None
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError('offset 與 limit 不能為負數')
+    except ValueError as e:
+        return web.json_response({'status': 'error', 'message': f'無效的分頁參數: {e}'}, status=400)
+    
     try:
-        auth_data = {'username': 'guacadmin', 'password': 'guacadmin'}
-        response = requests.post('http://localhost:8080/guacamole/api/tokens', data=auth_data)
-        if response.status_code != 200:
-            return web.json_response({'status': 'error', 'message': f'無法獲取 Guacamole API 令牌，狀態碼: {response.status_code}'})
+        fields = [f for f in query.get('fields', '').split(',') if f]
         
-        token_data = response.json()
-        auth_token = token_data.get('authToken')
+        index = await get_connection_index().snapshot()
+        etag = '"' + hashlib.sha1(f"{index.etag}|{request.query_string}".encode()).hexdigest() + '"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers=headers)
         
-        list_url = f'http://localhost:8080/guacamole/api/session/data/mysql/connections?token={auth_token}'
-
-        list_response = requests.get(list_url)
-        if list_response.status_code != 200:
-            return web.json_response({'status': 'error', 'message': f'無法獲取連接列表，狀態碼: {list_response.status_code}'})
+        ids = index.query(protocol=query.get('protocol'),
+                          name_prefix=query.get('name_prefix'),
+                          parent=query.get('parent'))
+        page = ids[offset:offset + limit] if limit is not None else ids[offset:]
+        connections = {}
+        for conn_id in page:
+            conn = index.connections[conn_id]
+            if fields:
+                conn = {key: conn[key] for key in ['identifier', *fields] if key in conn}
+            connections[conn_id] = conn
         
-        connections = list_response.json()
-        return web.json_response({'status': 'success', 'connections': connections})
+        return web.json_response({
+            'status': 'success',
+            'connections': connections,
+            'total': len(ids),
+            'offset': offset,
+            'limit': limit
+        }, headers=headers)
     except Exception as e:
         logging.error(f"Error listing connections: {e}")
         return web.json_response({'status': 'error', 'message': str(e)})
 
+def admission_rejected_response(error):
+    """准入被拒絕時返回 429，客戶端可按 Retry-After 重試"""
+    return web.json_response({'status': 'error', 'message': str(error)}, status=429,
+                             headers={'Retry-After': str(error.retry_after)})
+
 async def execute_command(request):
     try:
         data = await request.json()
         connection_id = data.get('connection_id')
         command = data.get('command')
         
-        token_response = await get_guacamole_token(None)
-        token_data = json.loads(token_response.text)
-        token = token_data.get('token')
+        token = await token_cache.get_token()
         
-        result = await session_manager.execute_command(connection_id, command, token)
+        result = await session_manager.execute_command(connection_id, command, token, data.get('priority', 0))
         return web.json_response(result)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except Exception as e:
         logging.error(f"Error in execute_command: {e}")
         return web.json_response({'status': 'error', 'message': str(e)})
@@ -1469,29 +4700,286 @@ async def execute_script(request):
         connection_id = data.get('connection_id')
         script = data.get('script')
         
-        token_response = await get_guacamole_token(None)
-        token_data = json.loads(token_response.text)
-        token = token_data.get('token')
+        token = await token_cache.get_token()
         
-        results = await session_manager.execute_script(connection_id, script, token)
-        return web.json_response({'status': 'success', 'results': results})
+        results = await session_manager.execute_script(connection_id, script, token, priority=data.get('priority', 0))
+        first = results[0] if results else {}
+        return web.json_response({'status': 'success', 'results': results,
+                                  'session': first.get('session'), 'first_command_ms': first.get('latency_ms')})
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except Exception as e:
         logging.error(f"Error in execute_script: {e}")
         return web.json_response({'status': 'error', 'message': str(e)})
 
+class BatchLineSink:
+    """批量執行時代替 WebSocket 接收某個連接的逐行輸出，標記連接ID後交給統一的輸出"""
+
+    def __init__(self, connection_id, emit):
+        self.connection_id = connection_id
+        self.emit = emit
+        self.closed = False
+
+    async def send_json(self, data):
+        await self.emit({'type': 'line', 'connection_id': self.connection_id, **data})
+
+    async def send_str(self, data):
+        # 經工作進程或其他實例轉發時輸出以 JSON 文本到達
+        await self.send_json(json.loads(data))
+
+    async def close(self):
+        self.closed = True
+
+
+async def resolve_batch_targets(data):
+    """按 connection_ids 列表或 filter(protocol/name_prefix/parent) 解析批量執行的目標連接"""
+    connection_ids = data.get('connection_ids')
+    if connection_ids is None:
+        filters = data.get('filter')
+        if not isinstance(filters, dict):
+            raise ValueError("需要提供 connection_ids 或 filter")
+        index = await get_connection_index().snapshot()
+        connection_ids = index.query(protocol=filters.get('protocol'),
+                                     name_prefix=filters.get('name_prefix'),
+                                     parent=filters.get('parent'))
+    if not isinstance(connection_ids, list):
+        raise ValueError("connection_ids 必須是列表")
+    # 去重並保持順序
+    connection_ids = list(dict.fromkeys(str(connection_id) for connection_id in connection_ids))
+    if len(connection_ids) > BATCH_SCRIPT['max_hosts']:
+        raise ValueError(f"連接數超過上限 {BATCH_SCRIPT['max_hosts']}")
+    return connection_ids
+
+
+async def run_script_batch(script, connection_ids, emit, concurrency=None, priority=0):
+    """以有限並發在多個連接上執行同一腳本，逐行與逐連接結果交給 emit，返回匯總；
+    emit 失敗(客戶端已斷開)時不再啟動新連接並取消仍在執行的連接，匯總 status 為 disconnected"""
+    started = time.perf_counter()
+    concurrency = max(1, min(int(concurrency or BATCH_SCRIPT['concurrency']), BATCH_SCRIPT['max_concurrency']))
+    # 腳本只編譯一次，語法錯誤時不觸碰任何連接
+    get_script_compiler().compile(script)
+    token = await token_cache.get_token()
+    semaphore = asyncio.Semaphore(concurrency)
+    summary = {'type': 'summary', 'hosts': len(connection_ids), 'succeeded': 0, 'failed': 0,
+               'rejected': 0, 'lines_failed': 0, 'failed_hosts': []}
+    host_latency = LatencyStats(max_samples=max(len(connection_ids), 1))
+    tasks = []
+    disconnected = False
+    
+    async def deliver(record):
+        nonlocal disconnected
+        if disconnected:
+            return
+        try:
+            await emit(record)
+        except Exception as e:
+            logging.warning(f"批量腳本輸出失敗，客戶端可能已斷開: {e}")
+            disconnected = True
+            current = asyncio.current_task()
+            for task in tasks:
+                if task is not current:
+                    task.cancel()
+    
+    async def run_host(connection_id):
+        host_started = time.perf_counter()
+        record = {'type': 'host', 'connection_id': connection_id}
+        try:
+            results = await session_manager.execute_script(connection_id, script, token,
+                                                            BatchLineSink(connection_id, deliver), priority)
+            failed = sum(1 for output in results if output.get('status') != 'success')
+            record.update(status='success' if results and not failed else 'error',
+                          lines=len(results), lines_failed=failed)
+            summary['lines_failed'] += failed
+        except AdmissionRejected as e:
+            record.update(status='rejected', message=str(e), retry_after=e.retry_after)
+        except Exception as e:
+            record.update(status='error', message=str(e))
+        finally:
+            semaphore.release()
+        record['elapsed_ms'] = round((time.perf_counter() - host_started) * 1000, 2)
+        host_latency.record(record['elapsed_ms'])
+        summary[{'success': 'succeeded', 'rejected': 'rejected'}.get(record['status'], 'failed')] += 1
+        if record['status'] != 'success':
+            summary['failed_hosts'].append(connection_id)
+        await deliver(record)
+    
+    try:
+        for connection_id in connection_ids:
+            await semaphore.acquire()
+            if disconnected:
+                break
+            tasks.append(asyncio.create_task(run_host(connection_id)))
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        # 調用方被取消時不留下無人等待的連接任務
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    summary['status'] = 'disconnected' if disconnected else 'done'
+    summary['concurrency'] = concurrency
+    summary['host_ms'] = host_latency.snapshot()
+    summary['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return summary
+
+async def execute_script_batch(request):
+    """在多個連接上並發執行同一腳本，以 NDJSON 流式返回逐行、逐連接結果與最終匯總"""
+    try:
+        data = await request.json()
+        script = data.get('script')
+        if not script:
+            raise ValueError("腳本不能為空")
+        get_script_compiler().compile(script)
+        connection_ids = await resolve_batch_targets(data)
+    except Exception as e:
+        return web.json_response({'status': 'error', 'message': str(e)})
+    
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    
+    async def emit(record):
+        await response.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+    
+    try:
+        summary = await run_script_batch(script, connection_ids, emit,
+                                         data.get('concurrency'), data.get('priority', 0))
+    except Exception as e:
+        logging.error(f"Error in execute_script_batch: {e}")
+        summary = {'type': 'summary', 'status': 'error', 'message': str(e)}
+    if summary['status'] == 'disconnected':
+        return response
+    try:
+        await emit(summary)
+        await response.write_eof()
+    except ConnectionResetError:
+        logging.warning("批量腳本匯總未能送達，客戶端已斷開")
+    return response
+
+async def submit_script_job(request):
+    """提交腳本任務，立即返回任務ID"""
+    try:
+        data = await request.json()
+        if not data.get('connection_id'):
+            raise ValueError("connection_id 不能為空")
+        job = get_script_jobs().submit(data['connection_id'], data.get('script') or '', data.get('priority', 0))
+        return web.json_response({'status': 'success', 'job_id': job.job_id,
+                                  'job': job.to_dict(position=get_script_jobs().position(job))}, status=202)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except Exception as e:
+        return web.json_response({'status': 'error', 'message': str(e)})
+
+async def list_script_jobs(request):
+    jobs = get_script_jobs()
+    status = request.query.get('status')
+    return web.json_response({
+        'status': 'success',
+        'jobs': [job.to_dict(position=jobs.position(job)) for job in jobs.jobs.values()
+                 if status is None or job.status == status],
+        'stats': jobs.stats(),
+    })
+
+async def get_script_job(request):
+    jobs = get_script_jobs()
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return web.json_response({'status': 'error', 'message': 'Job not found'}, status=404)
+    return web.json_response({'status': 'success', 'job': job.to_dict(results=True, position=jobs.position(job))})
+
+async def cancel_script_job(request):
+    job = get_script_jobs().cancel(request.match_info['job_id'])
+    if job is None:
+        return web.json_response({'status': 'error', 'message': 'Job not found'}, status=404)
+    return web.json_response({'status': 'success', 'job': job.to_dict()})
+
+async def stream_script_job(request):
+    """以 NDJSON 流式返回任務進度：先重放已完成的行，再推送後續事件直到任務結束"""
+    job = get_script_jobs().get(request.match_info['job_id'])
+    if job is None:
+        return web.json_response({'status': 'error', 'message': 'Job not found'}, status=404)
+    
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    
+    async def emit(event):
+        await response.write((json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8'))
+    
+    # 訂閱與取快照之間沒有 await，之後的事件都只經隊列送達
+    queue = asyncio.Queue()
+    job.subscribers.add(queue)
+    replay = list(job.results)
+    status = job.status
+    try:
+        await emit({'type': 'status', 'status': status})
+        for output in replay:
+            await emit({'type': 'line', **output})
+        if status in ('succeeded', 'failed', 'cancelled'):
+            await emit({'type': 'done', **job.to_dict()})
+        else:
+            while True:
+                event = await queue.get()
+                await emit(event)
+                if event['type'] == 'done':
+                    break
+    finally:
+        job.subscribers.discard(queue)
+    await response.write_eof()
+    return response
+
 async def get_guacamole_token(request):
     try:
-        auth_data = {'username': 'guacadmin', 'password': 'guacadmin'}
-        response = requests.post('http://localhost:8080/guacamole/api/tokens', data=auth_data)
-        if response.status_code != 200:
-            return web.json_response({'status': 'error', 'message': '無法獲取Guacamole API令牌'})
-        
-        token_data = response.json()
-        return web.json_response({'status': 'success', 'token': token_data['authToken']})
+        token = await token_cache.get_token()
+        return web.json_response({'status': 'success', 'token': token})
     except Exception as e:
         logging.error(f"Error getting Guacamole token: {e}")
         return web.json_response({'status': 'error', 'message': str(e)})
 
+CONNECTION_PATH = re.compile(r'/connections/(\d+)')
+
+async def guacamole_request(method, path, **kwargs):
+    """以緩存的令牌調用 Guacamole REST API，令牌被拒絕(403)時刷新後重試一次，返回 (狀態碼, 內容)"""
+    params = kwargs.pop('params', {})
+    for attempt in range(2):
+        token = await token_cache.get_token()
+        status, data = await get_rest_client().request(method, path, params={**params, 'token': token}, **kwargs)
+        if status == 403 and attempt == 0:
+            logging.info("Guacamole 令牌已失效，重新登錄後重試")
+            token_cache.invalidate(token=token)
+            continue
+        if method in ('PUT', 'PATCH', 'DELETE'):
+            match = CONNECTION_PATH.search(path)
+            if match:
+                get_connection_cache().invalidate(match.group(1))
+                get_connection_index().invalidate()
+        return status, data
+
+async def get_analytics(request):
+    """連接使用統計：每連接會話數、並發峰值、時長百分位與最繁忙時段"""
+    if not analytics:
+        return web.json_response({'status': 'error', 'message': '使用統計需要啟用數據庫後端 (GUAC_DATABASE)'})
+    try:
+        hours = int(request.query.get('hours', 24 * 7))
+        if not 0 < hours <= analytics.settings['retention_hours']:
+            raise ValueError(f"hours 必須在 1 到 {analytics.settings['retention_hours']} 之間")
+        result = await analytics.summary(hours)
+        return web.json_response({'status': 'success', **result})
+    except ValueError as e:
+        return web.json_response({'status': 'error', 'message': str(e)})
+    except Exception as e:
+        logging.error(f"Error computing analytics: {e}")
+        return web.json_response({'status': 'error', 'message': str(e)})
+
+async def get_sessions(request):
+    return web.json_response({
+        'status': 'success',
+        **await session_manager.collect_stats(),
+        'rest': get_rest_client().stats(),
+        'token_cache': token_cache.stats if token_cache else {},
+        'connection_cache': get_connection_cache().stats(),
+        'script_cache': get_script_compiler().info(),
+        'script_jobs': get_script_jobs().stats(),
+    })
+
 async def get_scripts(request):
     scripts = [
         {"id": "open_cmd", "name": "打開命令提示符", "description": "打開Windows命令提示符", "icon": "icon-terminal", "platform": "windows"},
@@ -1502,6 +4990,21 @@ async def get_scripts(request):
     ]
     return web.json_response({'status': 'success', 'scripts': scripts})
 
+def bind_viewer(automator, ws, viewer_id, mode='json', sync_ack=False, read_only=False):
+    """將 WebSocket 作為查看者訂閱會話的扇出中心，多個查看者共享同一 guacd 連接"""
+    # json: 每條指令包裝為 guac-instruction 消息
+    # relay: 原樣轉發 guacd 指令字節，隊列中的指令合併為一個二進制幀
+    # 返回服務端決定的只讀狀態，客戶端請求的 read_only 只能降低權限
+    if automator.viewer_hub is None:
+        automator.viewer_hub = ViewerHub(automator)
+    automator.viewer_hub.subscribe(viewer_id, ws, mode, read_only, sync_ack)
+    return automator.viewer_hub.is_read_only(viewer_id)
+
+def unbind_viewer(automator, viewer_id):
+    """取消查看者訂閱並停止其出站隊列"""
+    if automator.viewer_hub is not None:
+        automator.viewer_hub.unsubscribe(viewer_id)
+
 async def websocket_handler(request):
     # 增加ping_interval和ping_timeout參數，延長超時時間
     ws = web.WebSocketResponse(heartbeat=45, autoping=True, timeout=60)
@@ -1519,6 +5022,8 @@ async def websocket_handler(request):
     
     connection_id = None
     controller = None
+    viewer_id = str(uuid.uuid4())[:8]
+    read_only = False
     
     try:
         async for msg in ws:
@@ -1534,7 +5039,13 @@ async def websocket_handler(request):
                         # 處理客戶端的ping請求
                         await ws.send_json({'type': 'pong', 'timestamp': int(time.time() * 1000)})
                     elif cmd == 'connect':
+                        if controller:
+                            # 同一 WebSocket 切換連接時先退出原會話
+                            unbind_viewer(controller.automator, viewer_id)
+                            session_manager.unregister_websocket(connection_id, ws)
+                            controller = None
                         connection_id = data.get('connection_id')
+                        read_only = bool(data.get('read_only'))
                         
                         # 檢查是否已經有相同連接ID的活躍會話
                         if connection_id in session_manager.active_sessions:
@@ -1548,69 +5059,51 @@ async def websocket_handler(request):
                                 session_manager.register_websocket(connection_id, ws)
                                 
                                 # 設置指令發送函數
-                                loop = asyncio.get_event_loop()
-                                def instruction_poster(opcode, args):
-                                    async def _send():
-                                        if not ws.closed:
-                                            await ws.send_json({
-                                                'type': 'guac-instruction',
-                                                'opcode': opcode,
-                                                'args': list(args)
-                                            })
-                                    asyncio.run_coroutine_threadsafe(_send(), loop)
-                                
-                                controller.automator.instruction_poster_func = instruction_poster
-                                await ws.send_json({'status': 'success', 'message': 'Reusing existing connection'})
+                                read_only = bind_viewer(controller.automator, ws, viewer_id,
+                                                        data.get('mode', 'json'), data.get('sync_ack'), read_only)
+                                await ws.send_json({'status': 'success', 'message': 'Reusing existing connection',
+                                                    'read_only': read_only})
                                 continue
                         
                         # 如果沒有有效的現有會話，則創建新會話
-                        token_response = await get_guacamole_token(None)
-                        token_data = json.loads(token_response.text)
-                        token = token_data.get('token')
+                        token = await token_cache.get_token()
                         
                         try:
-                            controller = await session_manager.get_or_create_session(connection_id, token)
+                            controller = await session_manager.get_or_create_session(
+                                connection_id, token, data.get('idle_timeout'), data.get('priority', 0))
                             if controller:
                                 session_manager.register_websocket(connection_id, ws)
-                                loop = asyncio.get_event_loop()
-                                def instruction_poster(opcode, args):
-                                    async def _send():
-                                        if not ws.closed:
-                                            await ws.send_json({
-                                                'type': 'guac-instruction',
-                                                'opcode': opcode,
-                                                'args': list(args)
-                                            })
-                                    asyncio.run_coroutine_threadsafe(_send(), loop)
-                                controller.automator.instruction_poster_func = instruction_poster
-                                await ws.send_json({'status': 'success', 'message': 'Connection established'})
+                                read_only = bind_viewer(controller.automator, ws, viewer_id,
+                                                        data.get('mode', 'json'), data.get('sync_ack'), read_only)
+                                await ws.send_json({'status': 'success', 'message': 'Connection established',
+                                                    'read_only': read_only})
                             else:
                                 await ws.send_json({'status': 'error', 'message': 'Failed to establish connection'})
+                        except AdmissionRejected as e:
+                            await ws.send_json({'status': 'error', 'code': 429, 'message': str(e)})
                         except Exception as e:
                             await ws.send_json({'status': 'error', 'message': f'Failed to establish connection: {str(e)}'})
                     
+                    elif cmd == 'sync':
+                        # 查看者已完成該幀的渲染
+                        if controller:
+                            controller.automator.viewer_sync(viewer_id, data.get('timestamp'))
+
                     elif cmd == 'execute':
                         if not connection_id or not controller:
                             await ws.send_json({'status': 'error', 'message': 'No active connection'})
                             continue
+                        if read_only:
+                            await ws.send_json({'status': 'error', 'message': 'Read-only viewer'})
+                            continue
                         
                         command = data.get('command', '')
                         if not command:  # 檢查命令是否為空
                             await ws.send_json({'status': 'error', 'message': 'Empty command'})
                             continue
+                        session_manager.touch(connection_id)
                         
-                        # 修正問題2：確保鍵盤狀態正確傳遞
-                        if command.startswith('key '):
-                            parts = command.split(' ')
-                            # 確保狀態參數是1或0
-                            if len(parts) > 2:
-                                keysym = parts[1]
-                                state = parts[2]
-                                # 確保狀態是1或0
-                                if state not in ['0', '1']:
-                                    state = '1' if state.lower() in ['true', 'down'] else '0'
-                                command = f"key {keysym} {state}"
-                            
+                        if command.split(' ', 1)[0] in ('key', 'keydown', 'keyup'):
                             asyncio.create_task(controller.execute_command(command))
                             await ws.send_json({'status': 'success', 'result': f"Command executed: {command}"})
                         else:
@@ -1628,6 +5121,9 @@ async def websocket_handler(request):
                         if not connection_id or not controller:
                             await ws.send_json({'status': 'error', 'message': 'No active connection'})
                             continue
+                        if read_only:
+                            await ws.send_json({'status': 'error', 'message': 'Read-only viewer'})
+                            continue
                         
                         script = data.get('script', '')
                         if not script:
@@ -1636,95 +5132,37 @@ async def websocket_handler(request):
                         
                         try:
                         
-                            token_response = await get_guacamole_token(None)
-                            token_data = json.loads(token_response.text)
-                            token = token_data.get('token')
-                            # 修正問題3：改進預定義腳本處理
-                            if script.startswith('script '):
-                                script_name = script.split(' ')[1]
-                                if script_name == 'open_cmd':
-                                    script = """
-key win 1
-wait 0.1
-key win 0
-wait 0.2
-key r 1
-wait 0.1
-key r 0
-wait 0.5
-type cmd
-wait 0.2
-key return 1
-wait 0.1
-key return 0
-"""
-                                elif script_name == 'screenshot':
-                                    script = """
-key win 1
-wait 0.1
-key shift 1
-wait 0.1
-key s 1
-wait 0.1
-key s 0
-wait 0.1
-key shift 0
-wait 0.1
-key win 0
-"""
-                                elif script_name == 'browser':
-                                    script = """
-key win 1
-wait 0.1
-key win 0
-wait 0.2
-key r 1
-wait 0.1
-key r 0
-wait 0.5
-type chrome
-wait 0.2
-key return 1
-wait 0.1
-key return 0
-"""
-                                elif script_name == 'notepad':
-                                    script = """
-key win 1
-wait 0.1
-key win 0
-wait 0.2
-key r 1
-wait 0.1
-key r 0
-wait 0.5
-type notepad
-wait 0.2
-key return 1
-wait 0.1
-key return 0
-"""
-                                elif script_name == 'explorer':
-                                    script = """
-key win 1
-wait 0.1
-key e 1
-wait 0.1
-key e 0
-wait 0.1
-key win 0
-"""
-                            
+                            # 預定義腳本 (script <名稱>) 由腳本編譯器展開
+                            token = await token_cache.get_token()
                             results = await session_manager.execute_script(connection_id, script, token, ws)
                             await ws.send_json({'status': 'success', 'message': 'Script execution completed'})
                         except Exception as e:
                             logging.error(f"腳本執行失敗: {str(e)}")
                             await ws.send_json({'status': 'error', 'message': f'Script execution failed: {str(e)}'})
                     
+                    elif cmd == 'execute_script_batch':
+                        if read_only:
+                            await ws.send_json({'status': 'error', 'message': 'Read-only viewer'})
+                            continue
+                        try:
+                            script = data.get('script', '')
+                            if not script:
+                                raise ValueError("腳本不能為空")
+                            connection_ids = await resolve_batch_targets(data)
+                            summary = await run_script_batch(script, connection_ids, ws.send_json,
+                                                             data.get('concurrency'), data.get('priority', 0))
+                            if summary['status'] != 'disconnected':
+                                await ws.send_json({'status': 'success', **summary})
+                        except Exception as e:
+                            logging.error(f"批量腳本執行失敗: {str(e)}")
+                            await ws.send_json({'status': 'error', 'message': f'Batch script execution failed: {str(e)}'})
+                    
                     elif cmd == 'disconnect':
                         if connection_id:
                             # 不要關閉會話，只是取消註冊WebSocket
-                            session_manager.unregister_websocket(connection_id)
+                            if controller:
+                                unbind_viewer(controller.automator, viewer_id)
+                            session_manager.unregister_websocket(connection_id, ws)
                             connection_id = None
                             controller = None
                             await ws.send_json({'status': 'success', 'message': 'Connection closed'})
@@ -1742,8 +5180,10 @@ key win 0
             await ws.send_json({'status': 'error', 'message': f'Server error: {str(e)}'})
     finally:
         ping_task.cancel()  # 確保取消ping任務
+        if controller:
+            unbind_viewer(controller.automator, viewer_id)
         if connection_id:
-            session_manager.unregister_websocket(connection_id)
+            session_manager.unregister_websocket(connection_id, ws)
         if not ws.closed:
             await ws.close()
     
@@ -1753,6 +5193,8 @@ async def display_handler(request):
     """處理遠程顯示請求，整合自test.py"""
     connection_id = request.query.get('id')
     embedded = request.query.get('embedded', 'false') == 'true'
+    relay = request.query.get('relay', 'false') == 'true'  # 轉發模式需客戶端顯式啟用
+    read_only = request.query.get('readonly', 'false') == 'true'
     
     if not connection_id:
         return web.Response(text="Missing connection ID", status=400)
@@ -1901,6 +5343,13 @@ async def display_handler(request):
 
             // 連接到指定的連接ID
             const connectionId = '{connection_id}';
+
+            // 轉發模式: 伺服器原樣轉發 guacd 指令，由瀏覽器解析
+            const RELAY_MODE = {'true' if relay else 'false'};
+            // 只讀查看: 只接收畫面，不發送鍵盤、鼠標與腳本命令
+            let READ_ONLY = {'true' if read_only else 'false'};  // 連接後以服務端分配的結果為準
+            const textDecoder = new TextDecoder('utf-8');
+            const SURROGATE_PATTERN = /[\\uD800-\\uDBFF]/;
             
             // 初始化WebSocket連接
             function initWebSocket() {{
@@ -1919,6 +5368,7 @@ async def display_handler(request):
                 
                 try {{
                     ws = new WebSocket(wsUrl);
+                    ws.binaryType = 'arraybuffer';
                     
                     // 設置較長的超時時間
                     ws.timeout = 60000; // 60秒
@@ -1950,95 +5400,143 @@ async def display_handler(request):
                 // 發送連接命令
                 sendWebSocketMessage({{
                     cmd: 'connect',
-                    connection_id: connectionId
+                    connection_id: connectionId,
+                    mode: RELAY_MODE ? 'relay' : 'json',
+                    sync_ack: true,
+                    read_only: READ_ONLY
                 }});
             }}
             
             // 處理WebSocket消息
             function handleWebSocketMessage(event) {{
+                if (typeof event.data !== 'string') {{
+                    // 轉發模式: guacd 原生指令格式的二進制幀
+                    try {{
+                        parseGuacInstructions(textDecoder.decode(event.data), handleGuacInstruction);
+                    }} catch (e) {{
+                        console.error('解析指令幀失敗:', e);
+                    }}
+                    return;
+                }}
                 try {{
                     const data = JSON.parse(event.data);
                     
                     if (data.status === 'success') {{
+                        if (typeof data.read_only === 'boolean') {{
+                            READ_ONLY = data.read_only;
+                        }}
                         console.log('成功:', data.message || data.result);
                     }} else if (data.status === 'error') {{
                         console.error('錯誤:', data.message);
                         statusElement.textContent = '錯誤: ' + data.message;
                         statusElement.style.backgroundColor = 'rgba(255,0,0,0.5)';
                     }} else if (data.type === 'guac-instruction') {{
-                        // 處理 Guacamole 指令
-                        const opcode = data.opcode;
-                        const args = data.args;
-                        
-                        // 處理特殊的 img 和 blob 指令
-                        if (opcode === 'img') {{
-                            const streamIndex = args[0];
-                            const layerIndex = parseInt(args[1]);
-                            const mimetype = args[3] || 'image/png';
-                            const x = parseInt(args[4] || 0);
-                            const y = parseInt(args[5] || 0);
-                            
-                            // 初始化流
-                            activeStreams[streamIndex] = {{ 
-                                mimetype: mimetype, 
-                                x: x, 
-                                y: y, 
-                                layerIndex: layerIndex,
-                                dataParts: [] 
-                            }};
-                            return;
-                        }}
-                        
-                        if (opcode === 'blob') {{
-                            const streamIndex = args[0];
-                            const blobData = args[1];
-                            
-                            if (activeStreams[streamIndex]) {{
-                                activeStreams[streamIndex].dataParts.push(blobData);
-                            }}
-                            return;
-                        }}
-                        
-                        if (opcode === 'end') {{
-                            const streamIndex = args[0];
-                            if (activeStreams[streamIndex]) {{
-                                const stream = activeStreams[streamIndex];
-                                const fullBase64Data = stream.dataParts.join('');
-                                
-                                // 處理圖像數據
-                                if (BATCH_UPDATES && PERFORMANCE_MODE) {{
-                                    pendingDrawOperations.push(() => {{
-                                        processStreamEnd(stream, fullBase64Data);
-                                    }});
-                                    requestRender();
-                                }} else {{
-                                    processStreamEnd(stream, fullBase64Data);
-                                }}
-                                
-                                // 清理流
-                                delete activeStreams[streamIndex];
-                            }}
-                            return;
+                        handleGuacInstruction(data.opcode, data.args);
+                    }} else if (data.type === 'pong') {{
+                        console.log("Received WebSocket pong:", data.timestamp);
+                    }}
+                }} catch (e) {{
+                    console.error('解析消息失敗:', e, event.data);
+                }}
+            }}
+
+            // 解析 Guacamole 原生指令格式，元素長度以 Unicode 字元計算
+            function parseGuacInstructions(text, handler) {{
+                let pos = 0;
+                let elements = [];
+                while (pos < text.length) {{
+                    const dot = text.indexOf('.', pos);
+                    if (dot === -1) throw new Error('缺少長度前綴');
+                    const length = parseInt(text.substring(pos, dot), 10);
+                    const start = dot + 1;
+                    let end = start + length;
+                    let value = text.substring(start, end);
+                    if (SURROGATE_PATTERN.test(value)) {{
+                        // 含有代理對時按碼點重新計算結束位置
+                        end = start;
+                        for (let count = 0; count < length; count++) {{
+                            const code = text.charCodeAt(end);
+                            end += (code >= 0xD800 && code <= 0xDBFF) ? 2 : 1;
                         }}
+                        value = text.substring(start, end);
+                    }}
+                    elements.push(value);
+                    const terminator = text.charAt(end);
+                    pos = end + 1;
+                    if (terminator === ';') {{
+                        handler(elements[0], elements.slice(1));
+                        elements = [];
+                    }} else if (terminator !== ',') {{
+                        throw new Error('無效的指令分隔符: ' + terminator);
+                    }}
+                }}
+            }}
 
-                        // 處理其他指令
-                        if (BATCH_UPDATES && PERFORMANCE_MODE &&
-                            (opcode === 'png' || opcode === 'jpeg' || opcode === 'cfill' || 
-                            opcode === 'copy' || opcode === 'transfer')) {{
-                            // 批量處理繪圖操作
+            // 處理單條 Guacamole 指令
+            function handleGuacInstruction(opcode, args) {{
+                // 處理特殊的 img 和 blob 指令
+                if (opcode === 'img') {{
+                    const streamIndex = args[0];
+                    const layerIndex = parseInt(args[1]);
+                    const mimetype = args[3] || 'image/png';
+                    const x = parseInt(args[4] || 0);
+                    const y = parseInt(args[5] || 0);
+                    
+                    // 初始化流
+                    activeStreams[streamIndex] = {{ 
+                        mimetype: mimetype, 
+                        x: x, 
+                        y: y, 
+                        layerIndex: layerIndex,
+                        dataParts: [] 
+                    }};
+                    return;
+                }}
+                
+                if (opcode === 'blob') {{
+                    const streamIndex = args[0];
+                    const blobData = args[1];
+                    
+                    if (activeStreams[streamIndex]) {{
+                        activeStreams[streamIndex].dataParts.push(blobData);
+                    }}
+                    return;
+                }}
+                
+                if (opcode === 'end') {{
+                    const streamIndex = args[0];
+                    if (activeStreams[streamIndex]) {{
+                        const stream = activeStreams[streamIndex];
+                        const fullBase64Data = stream.dataParts.join('');
+                        
+                        // 處理圖像數據
+                        if (BATCH_UPDATES && PERFORMANCE_MODE) {{
                             pendingDrawOperations.push(() => {{
-                                processInstruction(opcode, args);
+                                processStreamEnd(stream, fullBase64Data);
                             }});
                             requestRender();
                         }} else {{
-                            // 直接處理其他指令
-                            processInstruction(opcode, args);
+                            processStreamEnd(stream, fullBase64Data);
                         }}
-                    }} else if (data.type === 'pong') {{
-                        console.log("Received WebSocket pong:", data.timestamp);
+                        
+                        // 清理流
+                        delete activeStreams[streamIndex];
                     }}
-                }} catch (e) {{
-                    console.error('解析消息失敗:', e, event.data);
+                    return;
+                }}
+
+                // 處理其他指令
+                if (BATCH_UPDATES && PERFORMANCE_MODE &&
+                    (opcode === 'png' || opcode === 'jpeg' || opcode === 'cfill' || 
+                    opcode === 'copy' || opcode === 'transfer')) {{
+                    // 批量處理繪圖操作
+                    pendingDrawOperations.push(() => {{
+                        processInstruction(opcode, args);
+                    }});
+                    requestRender();
+                }} else {{
+                    // 直接處理其他指令
+                    processInstruction(opcode, args);
                 }}
             }}
             
@@ -2111,6 +5609,9 @@ async def display_handler(request):
             
             // 發送WebSocket消息
             function sendWebSocketMessage(data) {{
+                if (READ_ONLY && (data.cmd === 'execute' || data.cmd === 'execute_script')) {{
+                    return;
+                }}
                 if (ws && ws.readyState === WebSocket.OPEN) {{
                     try {{
                         ws.send(JSON.stringify(data));
@@ -2277,7 +5778,13 @@ async def display_handler(request):
                         }}
                         break;
                     case 'sync':
-                        // 同步指令，不需要特別處理
+                        // 在此前的繪圖操作完成後向伺服器確認該幀
+                        if (BATCH_UPDATES && PERFORMANCE_MODE) {{
+                            pendingDrawOperations.push(() => acknowledgeSync(args[0]));
+                            requestRender();
+                        }} else {{
+                            acknowledgeSync(args[0]);
+                        }}
                         break;
                     case 'nop': 
                         break;
@@ -2298,6 +5805,10 @@ async def display_handler(request):
                 }}
             }}
 
+            function acknowledgeSync(timestamp) {{
+                sendWebSocketMessage({{ cmd: 'sync', timestamp: timestamp }});
+            }}
+
             function getCompositeOperation(mask) {{
                 // Simplified mapping, see Guacamole protocol for full Porter-Duff operations
                 const operations = [
@@ -2441,7 +5952,7 @@ async def display_handler(request):
                     pressedKeys[keyCode] = true;
                     sendWebSocketMessage({{
                         cmd: 'execute',
-                        command: `key ${{keysym}} 1`
+                        command: `keydown ${{keysym}}`
                     }});
                     
                     // 阻止瀏覽器默認行為，但允許複製/粘貼
@@ -2467,7 +5978,7 @@ async def display_handler(request):
                     delete pressedKeys[keyCode];
                     sendWebSocketMessage({{
                         cmd: 'execute',
-                        command: `key ${{keysym}} 0`
+                        command: `keyup ${{keysym}}`
                     }});
                 }}
             }});
@@ -2492,7 +6003,7 @@ async def display_handler(request):
                     pressedKeys[keyCode] = true;
                     sendWebSocketMessage({{
                         cmd: 'execute',
-                        command: `key ${{keysym}} 1`
+                        command: `keydown ${{keysym}}`
                     }});
                     
                     // 阻止瀏覽器默認行為，但允許複製/粘貼
@@ -2518,7 +6029,7 @@ async def display_handler(request):
                     delete pressedKeys[keyCode];
                     sendWebSocketMessage({{
                         cmd: 'execute',
-                        command: `key ${{keysym}} 0`
+                        command: `keyup ${{keysym}}`
                     }});
                 }}
             }});
@@ -2532,7 +6043,7 @@ async def display_handler(request):
                         if (keysym !== undefined) {{
                             sendWebSocketMessage({{
                                 cmd: 'execute',
-                                command: `key ${{keysym}} 0`
+                                command: `keyup ${{keysym}}`
                             }});
                         }}
                     }}
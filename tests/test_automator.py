@@ -0,0 +1,21 @@
+"""GuacamoleAutomator 的連接狀態：心跳發現傳輸中斷時標記為未連接並關閉"""
+import asyncio
+
+import hook
+
+
+def test_heartbeat_connection_error_marks_automator_disconnected(monkeypatch):
+    automator = hook.GuacamoleAutomator()
+    automator.connected = True
+    automator.heartbeat_active = True
+    closed = []
+
+    def send(*args):
+        raise ConnectionError('連接已中斷')
+
+    monkeypatch.setattr(automator, '_send', send)
+    monkeypatch.setattr(automator, 'close', lambda: closed.append(True))
+    asyncio.run(asyncio.wait_for(automator._heartbeat_async(), 1))
+
+    assert automator.connected is False
+    assert closed == [True]
@@ -0,0 +1,27 @@
+"""連接列表端點的參數校驗"""
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import hook
+
+
+async def get_statuses(queries):
+    app = web.Application()
+    app.router.add_get('/connections', hook.list_connections)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        statuses = []
+        for query in queries:
+            response = await client.get('/connections', params=query)
+            statuses.append(response.status)
+        return statuses
+    finally:
+        await client.close()
+
+
+def test_invalid_pagination_is_rejected():
+    queries = [{'limit': '-1'}, {'offset': '-5'}, {'limit': 'ten'}, {'offset': '1.5'}]
+    assert asyncio.run(get_statuses(queries)) == [400] * len(queries)
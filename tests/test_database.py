@@ -0,0 +1,243 @@
+"""GuacamoleDatabase 批量創建路徑，以 SQLite 模擬 aiomysql 連接池與 Guacamole 表"""
+import asyncio
+import json
+import sqlite3
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import hook
+
+SCHEMA = """
+CREATE TABLE guacamole_connection (
+    connection_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    connection_name TEXT NOT NULL,
+    parent_id INTEGER,
+    protocol TEXT NOT NULL,
+    max_connections INTEGER,
+    max_connections_per_user INTEGER,
+    proxy_hostname TEXT,
+    proxy_port INTEGER,
+    connection_weight INTEGER,
+    UNIQUE (connection_name, parent_id)
+);
+CREATE TABLE guacamole_connection_parameter (
+    connection_id INTEGER NOT NULL,
+    parameter_name TEXT NOT NULL,
+    parameter_value TEXT NOT NULL,
+    PRIMARY KEY (connection_id, parameter_name)
+);
+CREATE TABLE guacamole_entity (
+    entity_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE TABLE guacamole_connection_permission (
+    entity_id INTEGER NOT NULL,
+    connection_id INTEGER NOT NULL,
+    permission TEXT NOT NULL,
+    PRIMARY KEY (entity_id, connection_id, permission)
+);
+INSERT INTO guacamole_entity (name, type) VALUES ('guacadmin', 'USER');
+"""
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.cursor = db.connection.cursor()
+        self.lastrowid = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.cursor.close()
+
+    async def execute(self, sql, args=None):
+        self.db.statements.append(sql)
+        self.cursor.execute(sql.replace('%s', '?'), tuple(args or ()))
+        self.lastrowid = self.cursor.lastrowid
+
+    async def executemany(self, sql, rows):
+        self.db.statements.append(sql)
+        self.db.fail_on(sql)
+        self.cursor.executemany(sql.replace('%s', '?'), [tuple(row) for row in rows])
+
+    async def fetchone(self):
+        return self.cursor.fetchone()
+
+    async def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, *args):
+        return FakeCursor(self.db)
+
+    async def commit(self):
+        self.db.connection.commit()
+
+    async def rollback(self):
+        self.db.connection.rollback()
+
+
+class FakeAcquire:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return FakeConnection(self.db)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakePool:
+    """只提供 GuacamoleDatabase 使用到的 acquire/cursor 接口，SQL 中的 %s 換成 ? 執行"""
+
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:', isolation_level='DEFERRED')
+        self.connection.executescript(SCHEMA)
+        self.statements = []
+        self.fail_table = None
+
+    def acquire(self):
+        return FakeAcquire(self)
+
+    def fail_on(self, sql):
+        if self.fail_table and self.fail_table in sql:
+            raise sqlite3.OperationalError(f'模擬寫入 {self.fail_table} 失敗')
+
+    def rows(self, sql, args=()):
+        return self.connection.execute(sql, args).fetchall()
+
+
+def make_database():
+    database = hook.GuacamoleDatabase()
+    database.pool = FakePool()
+    return database
+
+
+def spec(name, host='10.0.0.1', parent=None):
+    return hook.build_connection_payload({'name': name, 'host': host, 'protocol': 'ssh', 'parent': parent})
+
+
+def test_batch_insert_maps_ids_parameters_and_permissions():
+    database = make_database()
+    ids = asyncio.run(database.create_connections([spec('a', '10.0.0.1'), spec('b', '10.0.0.2')]))
+
+    names = dict(database.pool.rows("SELECT connection_id, connection_name FROM guacamole_connection"))
+    assert [names[int(i)] for i in ids] == ['a', 'b']
+    hosts = dict(database.pool.rows(
+        "SELECT connection_id, parameter_value FROM guacamole_connection_parameter"
+        " WHERE parameter_name = 'hostname'"))
+    assert [hosts[int(i)] for i in ids] == ['10.0.0.1', '10.0.0.2']
+    permissions = database.pool.rows(
+        "SELECT connection_id, COUNT(*) FROM guacamole_connection_permission GROUP BY connection_id")
+    assert sorted(permissions) == [(int(i), len(hook.GuacamoleDatabase.CREATOR_PERMISSIONS)) for i in ids]
+
+
+def test_ids_are_not_resolved_by_name():
+    # 非根目錄下同名連接合法，新行必須拿到自己的ID而不是已有行的ID
+    database = make_database()
+    existing = asyncio.run(database.create_connections([spec('shared', '10.0.0.1', parent='1')]))
+    created = asyncio.run(database.create_connections([spec('shared', '10.0.0.2', parent='2')]))
+
+    assert created != existing
+    hosts = dict(database.pool.rows(
+        "SELECT connection_id, parameter_value FROM guacamole_connection_parameter"
+        " WHERE parameter_name = 'hostname'"))
+    assert hosts[int(existing[0])] == '10.0.0.1'
+    assert hosts[int(created[0])] == '10.0.0.2'
+
+
+def test_duplicate_root_names_are_rejected():
+    database = make_database()
+    asyncio.run(database.create_connections([spec('root')]))
+
+    for payloads in ([spec('root')], [spec('x'), spec('x')]):
+        try:
+            asyncio.run(database.create_connections(payloads))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f'重名未被拒絕: {[p["name"] for p in payloads]}')
+    assert database.pool.rows("SELECT COUNT(*) FROM guacamole_connection") == [(1,)]
+
+
+def test_failed_batch_is_rolled_back():
+    database = make_database()
+    database.pool.fail_table = 'guacamole_connection_permission'
+    try:
+        asyncio.run(database.create_connections([spec('a'), spec('b')]))
+    except sqlite3.OperationalError:
+        pass
+    else:
+        raise AssertionError('寫入權限失敗時應拋出異常')
+
+    assert database.pool.rows("SELECT COUNT(*) FROM guacamole_connection") == [(0,)]
+    assert database.pool.rows("SELECT COUNT(*) FROM guacamole_connection_parameter") == [(0,)]
+
+
+async def post_bulk(lines, content_type='application/x-ndjson'):
+    app = web.Application()
+    app.router.add_post('/bulk', hook.create_connections_bulk)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        body = lines if isinstance(lines, str) else '\n'.join(json.dumps(line) for line in lines)
+        response = await client.post('/bulk', data=body, headers={'Content-Type': content_type})
+        return [json.loads(line) for line in (await response.text()).splitlines()]
+    finally:
+        await client.close()
+
+
+def test_bulk_endpoint_falls_back_to_per_row_inserts(monkeypatch):
+    database = make_database()
+    asyncio.run(database.create_connections([spec('taken', parent='1')]))
+    monkeypatch.setattr(hook, 'database', database)
+    monkeypatch.setattr(hook, 'docker_client', object())
+    monkeypatch.setattr(hook, 'connection_cache', hook.ConnectionDetailsCache())
+    monkeypatch.setattr(hook, 'connection_index', hook.ConnectionIndex())
+
+    lines = [{'name': 'ok-1', 'host': 'h1', 'protocol': 'ssh', 'parent': '1'},
+             {'name': 'taken', 'host': 'h2', 'protocol': 'ssh', 'parent': '1'},
+             {'name': 'ok-2', 'host': 'h3', 'protocol': 'ssh', 'parent': '1'}]
+    *results, summary = asyncio.run(post_bulk(lines))
+
+    assert summary['succeeded'] == 2 and summary['failed'] == 1
+    by_row = {result['row']: result for result in results}
+    assert by_row[2]['status'] == 'error'
+    assert {by_row[1]['status'], by_row[3]['status']} == {'success'}
+    names = dict(database.pool.rows("SELECT connection_id, connection_name FROM guacamole_connection"))
+    assert names[int(by_row[1]['connection_id'])] == 'ok-1'
+    assert names[int(by_row[3]['connection_id'])] == 'ok-2'
+    # 預置數據 1 次；整批事務在第二行失敗(2 次)；隨後逐行重試 3 次
+    inserts = [sql for sql in database.pool.statements if sql.startswith('INSERT INTO guacamole_connection (')]
+    assert len(inserts) == 1 + 2 + 3
+
+
+def test_bulk_csv_keeps_quoted_multiline_fields(monkeypatch):
+    database = make_database()
+    monkeypatch.setattr(hook, 'database', database)
+    monkeypatch.setattr(hook, 'docker_client', object())
+    monkeypatch.setattr(hook, 'connection_cache', hook.ConnectionDetailsCache())
+    monkeypatch.setattr(hook, 'connection_index', hook.ConnectionIndex())
+
+    body = ('Name,Host,Protocol,Password\n'
+            'first,h1,ssh,"line one\nline two"\n'
+            '\n'
+            '"second, with comma",h2,ssh,plain\n')
+    *results, summary = asyncio.run(post_bulk(body, 'text/csv'))
+
+    assert summary['succeeded'] == 2 and summary['failed'] == 0
+    assert sorted(result['row'] for result in results) == [1, 2]
+    names = [name for (name,) in database.pool.rows("SELECT connection_name FROM guacamole_connection")]
+    assert sorted(names) == ['first', 'second, with comma']
+    passwords = database.pool.rows(
+        "SELECT parameter_value FROM guacamole_connection_parameter WHERE parameter_name = 'password'")
+    assert ('line one\nline two',) in passwords
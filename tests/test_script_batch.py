@@ -0,0 +1,52 @@
+"""run_script_batch 在客戶端斷開時停止啟動新連接並取消仍在執行的連接"""
+import asyncio
+
+import hook
+
+
+class FakeTokenCache:
+    async def get_token(self):
+        return 'token'
+
+
+class FakeSessionManager:
+    def __init__(self):
+        self.started = []
+        self.cancelled = []
+
+    async def execute_script(self, connection_id, script, token, ws=None, priority=0):
+        self.started.append(connection_id)
+        try:
+            await asyncio.sleep(0.05 if connection_id == 'c0' else 1)
+            output = {'line_number': 1, 'command': script, 'status': 'success', 'result': 'ok'}
+            await ws.send_json(output)
+            return [output]
+        except asyncio.CancelledError:
+            self.cancelled.append(connection_id)
+            raise
+
+
+def test_client_disconnect_stops_the_batch(monkeypatch):
+    manager = FakeSessionManager()
+    monkeypatch.setattr(hook, 'session_manager', manager)
+    monkeypatch.setattr(hook, 'token_cache', FakeTokenCache())
+    emitted = []
+
+    async def emit(record):
+        emitted.append(record)
+        raise ConnectionResetError('Cannot write to closing transport')
+
+    async def main():
+        started = asyncio.get_running_loop().time()
+        summary = await hook.run_script_batch('key a', [f'c{index}' for index in range(6)], emit, concurrency=2)
+        await asyncio.sleep(0)
+        return summary, asyncio.get_running_loop().time() - started, asyncio.all_tasks()
+
+    summary, elapsed, leftover = asyncio.run(main())
+    assert summary['status'] == 'disconnected'
+    # 第一次輸出失敗後不再輸出、不再啟動新連接，並取消仍在執行的連接
+    assert len(emitted) == 1
+    assert manager.started == ['c0', 'c1']
+    assert manager.cancelled == ['c1']
+    assert elapsed < 1
+    assert len(leftover) == 1
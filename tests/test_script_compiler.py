@@ -0,0 +1,40 @@
+"""ScriptCompiler 的按鍵語法：key 總是組合鍵，keydown/keyup 只按下或釋放"""
+import pytest
+
+import hook
+
+
+def sent(*lines):
+    return b''.join(op for line in lines for op in line.ops if isinstance(op, bytes))
+
+
+def test_key_digit_is_combo():
+    compiler = hook.ScriptCompiler()
+    ctrl = hook.KEYSYMS['ctrl']
+    script = compiler.compile("key ctrl 1", cache=False)
+    encode = compiler.encode
+    assert sent(*script.lines) == (encode('key', ctrl, 1) + encode('key', ord('1'), 1)
+                                  + encode('key', ord('1'), 0) + encode('key', ctrl, 0))
+
+
+def test_legacy_repeated_key_tokens_are_one_combo():
+    compiler = hook.ScriptCompiler()
+    legacy = compiler.compile("key ctrl key alt key delete", cache=False)
+    combo = compiler.compile("key ctrl alt delete", cache=False)
+    assert sent(*legacy.lines) == sent(*combo.lines)
+
+
+def test_keydown_keyup():
+    compiler = hook.ScriptCompiler()
+    ctrl = hook.KEYSYMS['ctrl']
+    script = compiler.compile("keydown ctrl\nkey c\nkeyup ctrl", cache=False)
+    ops = [sent(line) for line in script.lines]
+    assert ops[0] == compiler.encode('key', ctrl, 1)
+    assert ops[2] == compiler.encode('key', ctrl, 0)
+    # keydown 有意保持按下，取消時不應自動釋放
+    assert not script.lines[0].release
+
+
+def test_keydown_requires_single_key():
+    with pytest.raises(hook.ScriptError):
+        hook.ScriptCompiler().compile("keydown ctrl alt", cache=False)
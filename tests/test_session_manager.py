@@ -0,0 +1,206 @@
+"""GuacamoleSessionManager 按連接的並行建立與單次連接(single-flight)語義"""
+import asyncio
+import time
+
+import hook
+
+CONNECT_TIME = 0.2
+
+
+class FakeAutomator:
+    token = None
+
+    async def get_connection_details(self, connection_id):
+        return {'protocol': 'rdp', 'parameters': {'hostname': f'host-{connection_id}'}}
+
+
+class FakeController:
+    """模擬一次耗時 CONNECT_TIME 的 guacd 握手，連接ID以 fail 開頭時握手失敗"""
+    connects = 0
+
+    def __init__(self):
+        self.automator = FakeAutomator()
+
+    async def connect(self, connection_id, token):
+        FakeController.connects += 1
+        await asyncio.sleep(CONNECT_TIME)
+        if connection_id.startswith('fail'):
+            raise ConnectionError(f'無法連接 {connection_id}')
+        return True
+
+    async def disconnect(self):
+        pass
+
+    async def execute_command(self, command):
+        return True
+
+    async def run_line(self, line):
+        await asyncio.sleep(CONNECT_TIME)
+
+
+def run_with_manager(monkeypatch, scenario):
+    monkeypatch.setattr(hook, 'GuacamoleController', FakeController)
+    FakeController.connects = 0
+
+    async def main():
+        manager = hook.GuacamoleSessionManager(warm_pool_settings={'size': 0})
+        try:
+            return await scenario(manager)
+        finally:
+            manager.expiry.stop()
+
+    return asyncio.run(main())
+
+
+def test_connects_to_different_hosts_run_in_parallel(monkeypatch):
+    async def scenario(manager):
+        started = time.perf_counter()
+        controllers = await asyncio.gather(*(manager.get_or_create_session(f'c{index}', 'token')
+                                             for index in range(8)))
+        return controllers, time.perf_counter() - started
+
+    controllers, elapsed = run_with_manager(monkeypatch, scenario)
+    assert all(controllers)
+    assert elapsed < CONNECT_TIME * 2
+
+
+def test_concurrent_callers_share_one_connect(monkeypatch):
+    async def scenario(manager):
+        return await asyncio.gather(*(manager.get_or_create_session('c1', 'token') for _ in range(5)))
+
+    controllers = run_with_manager(monkeypatch, scenario)
+    assert FakeController.connects == 1
+    assert all(controller is controllers[0] for controller in controllers)
+
+
+def test_cancelled_caller_does_not_cancel_other_waiters(monkeypatch):
+    async def scenario(manager):
+        first = asyncio.create_task(manager.get_or_create_session('c1', 'token'))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(manager.get_or_create_session('c1', 'token'))
+        await asyncio.sleep(CONNECT_TIME / 4)
+        first.cancel()
+        controller = await second
+        return first, controller, manager
+
+    first, controller, manager = run_with_manager(monkeypatch, scenario)
+    assert first.cancelled()
+    assert controller is not None
+    assert manager.active_sessions['c1'] is controller
+    assert FakeController.connects == 1
+
+
+def test_failed_connect_does_not_poison_other_connections(monkeypatch):
+    async def scenario(manager):
+        results = await asyncio.gather(manager.get_or_create_session('fail-1', 'token'),
+                                       manager.get_or_create_session('fail-1', 'token'),
+                                       manager.get_or_create_session('c2', 'token'),
+                                       return_exceptions=True)
+        # 失敗後不保留登記，下一次請求重新連接
+        retry = await asyncio.gather(manager.get_or_create_session('fail-1', 'token'), return_exceptions=True)
+        return results, retry, manager
+
+    results, retry, manager = run_with_manager(monkeypatch, scenario)
+    assert isinstance(results[0], ConnectionError) and isinstance(results[1], ConnectionError)
+    assert results[2] is manager.active_sessions['c2']
+    assert isinstance(retry[0], ConnectionError)
+    assert FakeController.connects == 3
+    assert not manager.pending_sessions
+
+
+def test_connection_cache_load_survives_cancelled_caller():
+    async def main():
+        cache = hook.ConnectionDetailsCache()
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(CONNECT_TIME)
+            return {'protocol': 'ssh', 'parameters': {'hostname': 'h'}}
+
+        first = asyncio.create_task(cache.get_or_load('1', loader))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_or_load('1', loader))
+        await asyncio.sleep(CONNECT_TIME / 4)
+        first.cancel()
+        return first, await second, calls
+
+    first, details, calls = asyncio.run(main())
+    assert first.cancelled()
+    assert details['parameters']['hostname'] == 'h'
+    assert len(calls) == 1
+
+
+def test_only_the_first_command_after_connect_is_recorded(monkeypatch):
+    async def scenario(manager):
+        results = [await manager.execute_command('c1', 'key a', 'token') for _ in range(3)]
+        results.append(await manager.execute_script('c1', 'key a', 'token'))
+        await manager.close_session('c1')
+        results.append(await manager.execute_command('c1', 'key a', 'token'))
+        return results, manager.first_command_latency
+
+    results, latency = run_with_manager(monkeypatch, scenario)
+    assert [result['session'] for result in results[:3]] == ['new', 'active', 'active']
+    assert all('latency_ms' in result for result in results[:3])
+    # 每次建立會話只計入一次，之後在活躍會話上的命令不算首條命令
+    assert set(latency) == {'new'}
+    assert latency['new'].count == 2
+
+
+def test_busy_connection_rejects_sync_calls_and_keeps_its_semaphore(monkeypatch):
+    async def scenario(manager):
+        await manager.get_or_create_session('c1', 'token')
+        job = asyncio.create_task(manager.execute_script('c1', 'wait 1', 'token', wait=True, run_id='job-1'))
+        await asyncio.sleep(CONNECT_TIME / 4)
+        semaphore = manager.connection_semaphores['c1']
+        try:
+            await manager.execute_command('c1', 'key a', 'token')
+            rejected = False
+        except hook.ConnectionBusy:
+            rejected = True
+        # 關閉會話時名額仍被持有，信號量不能被替換，否則後續調用者會繞過上限
+        await manager.close_session('c1')
+        kept = manager.connection_semaphores.get('c1') is semaphore
+        await job
+        return rejected, kept, dict(manager.connection_semaphores)
+
+    rejected, kept, semaphores = run_with_manager(monkeypatch, scenario)
+    assert rejected
+    assert kept
+    assert 'c1' not in semaphores
+
+
+def test_running_script_pins_session_and_can_be_cancelled_by_run_id(monkeypatch):
+    async def scenario(manager):
+        await manager.get_or_create_session('c1', 'token')
+        job = asyncio.create_task(manager.execute_script('c1', 'wait 1\nwait 1', 'token', run_id='job-1'))
+        await asyncio.sleep(CONNECT_TIME / 4)
+        await manager._expire_session('c1')
+        pinned = 'c1' in manager.active_sessions
+        manager.cancel_script('job-1')
+        await asyncio.gather(job, return_exceptions=True)
+        return pinned, job, manager
+
+    pinned, job, manager = run_with_manager(monkeypatch, scenario)
+    assert pinned
+    assert job.cancelled()
+    assert not manager.script_runs and not manager.slot_users
+
+
+def test_router_forwards_cancellation_to_the_executing_process():
+    async def main():
+        router = hook.SessionWorkerRouter({'count': 0})
+        notified = []
+
+        async def call(connection_id, op, timeout=-1, **args):
+            await asyncio.Event().wait()
+
+        router.call = call
+        router.notify = lambda connection_id, op, **args: notified.append((connection_id, op, args))
+        task = asyncio.create_task(router.execute_script('c1', 'wait 1', 'token', run_id='job-1'))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return notified
+
+    assert asyncio.run(main()) == [('c1', 'cancel_script', {'run_id': 'job-1'})]
@@ -0,0 +1,71 @@
+"""共享會話註冊表：記錄的佔用與釋放"""
+import asyncio
+import os
+
+import pytest
+
+import hook
+from test_session_manager import FakeController
+
+
+def run_registered(monkeypatch, tmp_path, scenario):
+    monkeypatch.setattr(hook, 'GuacamoleController', FakeController)
+
+    async def main():
+        registry = hook.SqliteSessionRegistry({'path': str(tmp_path / 'sessions.db')})
+        await registry.start(str(tmp_path / 'instance.sock'))
+        local = hook.GuacamoleSessionManager(warm_pool_settings={'size': 0})
+        manager = hook.RegisteredSessionManager(local, registry)
+        try:
+            return await scenario(manager, registry)
+        finally:
+            local.expiry.stop()
+            await registry.close()
+
+    return asyncio.run(main())
+
+
+def owned(registry):
+    return [row[0] for row in registry.conn.execute("SELECT connection_id FROM sessions")]
+
+
+def test_registry_interface_is_abstract():
+    with pytest.raises(TypeError):
+        hook.SessionRegistry()
+
+
+def test_close_releases_the_claim_once(monkeypatch, tmp_path):
+    async def scenario(manager, registry):
+        await manager.get_or_create_session('c1', 'token')
+        claimed = owned(registry)
+        await manager.close_session('c1')
+        await asyncio.sleep(0.05)  # 關閉回調在後台釋放
+        return claimed, owned(registry), registry.counters['released']
+
+    claimed, remaining, released = run_registered(monkeypatch, tmp_path, scenario)
+    assert claimed == ['c1']
+    assert remaining == []
+    assert released == 1
+
+
+def test_failed_connect_releases_the_claim(monkeypatch, tmp_path):
+    async def scenario(manager, registry):
+        with pytest.raises(ConnectionError):
+            await manager.get_or_create_session('fail-1', 'token')
+        return owned(registry)
+
+    assert run_registered(monkeypatch, tmp_path, scenario) == []
+
+
+def test_registry_in_shared_writable_dir_is_refused(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(shared, 0o777)
+    with pytest.raises(PermissionError):
+        hook.SqliteSessionRegistry({'path': str(shared / 'sessions.db')})
+
+
+def test_peer_addresses_outside_socket_dir_are_refused(tmp_path):
+    peers = hook.PeerSessionRouter(str(tmp_path / 'instances'))
+    with pytest.raises(hook.SessionWorkerError):
+        asyncio.run(peers.route('c1', str(tmp_path / 'elsewhere' / 'instance-1.sock')))
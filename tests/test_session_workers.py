@@ -0,0 +1,124 @@
+"""工作進程 IPC 的查看者幀流控：慢查看者不阻塞共享的讀寫端；socket 目錄必須為當前用戶私有"""
+import asyncio
+import os
+import stat
+
+import pytest
+
+import hook
+
+
+class FakeWriter:
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(data)
+
+    def is_closing(self):
+        return False
+
+
+class FakeClient:
+    def __init__(self):
+        self.acks = []
+
+    def notify(self, op, **args):
+        self.acks.append((op, args['sink']))
+
+
+class FakeWebSocket:
+    def __init__(self, blocked=False):
+        self.closed = False
+        self.sent = []
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def send_bytes(self, data):
+        await self.unblocked.wait()
+        self.sent.append(data)
+
+
+def test_slow_viewer_does_not_block_deliveries_to_other_viewers():
+    async def main():
+        router = hook.SessionWorkerRouter({'count': 0, 'sink_queue': 4})
+        client = FakeClient()
+        slow, fast = FakeWebSocket(blocked=True), FakeWebSocket()
+        router.open_sink('slow', slow)
+        router.open_sink('fast', fast)
+        for _ in range(20):
+            router.deliver(client, 'slow', 'bytes', b'frame')
+        router.deliver(client, 'fast', 'bytes', b'frame')
+        await asyncio.sleep(0.01)
+        result = list(fast.sent), router.sink_drops, list(client.acks)
+        for sink in ('slow', 'fast'):
+            router.drop_sink(sink)
+        return result
+
+    fast_sent, drops, acks = asyncio.run(main())
+    assert fast_sent == [b'frame']
+    # 隊列保留四幀，其餘丟棄並立即確認
+    assert drops == 16
+    assert acks.count(('sink_ack', 'slow')) == 16
+    assert acks.count(('sink_ack', 'fast')) == 1
+
+
+def test_frame_credits_are_per_sink():
+    async def main():
+        channel = hook.IPCChannel(FakeWriter(), window=2)
+        for _ in range(2):
+            await channel.send_frame('a', 'bytes', b'x')
+        blocked = asyncio.create_task(channel.send_frame('a', 'bytes', b'x'))
+        await asyncio.sleep(0)
+        # sink a 用盡額度時，sink b 與回覆仍可發送
+        await asyncio.wait_for(channel.send_frame('b', 'bytes', b'y'), 0.1)
+        channel.send({'id': 1, 'result': True})
+        assert not blocked.done()
+        channel.ack('a')
+        await asyncio.wait_for(blocked, 0.1)
+        return len(channel.writer.frames)
+
+    assert asyncio.run(main()) == 5
+
+
+def test_aborted_channel_wakes_waiting_senders():
+    async def main():
+        writer = FakeWriter()
+        channel = hook.IPCChannel(writer, window=1)
+        await channel.send_frame('a', 'bytes', b'x')
+        waiting = asyncio.create_task(channel.send_frame('a', 'bytes', b'x'))
+        await asyncio.sleep(0)
+        writer.is_closing = lambda: True
+        channel.abort()
+        try:
+            await asyncio.wait_for(waiting, 0.1)
+        except ConnectionError:
+            return True
+        return False
+
+    assert asyncio.run(main())
+
+
+def test_socket_dir_is_created_private(tmp_path):
+    path = hook.ensure_private_dir(str(tmp_path / 'workers'))
+    assert stat.S_IMODE(os.stat(path).st_mode) & 0o077 == 0
+
+
+def test_shared_writable_socket_dir_is_refused(tmp_path):
+    shared = tmp_path / 'workers'
+    shared.mkdir()
+    os.chmod(shared, 0o777)
+    with pytest.raises(PermissionError):
+        hook.ensure_private_dir(str(shared))
+    router = hook.SessionWorkerRouter({'socket_dir': str(shared), 'count': 1})
+    with pytest.raises(PermissionError):
+        asyncio.run(router.start())
+    assert not router.workers[0].process
+
+
+def test_default_socket_dir_is_per_user(monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+    assert hook.default_runtime_dir('guacaldera-workers') == '/run/user/1000/guacaldera-workers'
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    assert hook.default_runtime_dir('guacaldera-workers').endswith(f'guacaldera-workers-{os.getuid()}')
@@ -0,0 +1,97 @@
+"""ViewerHub：服務端分配控制權，後加入的查看者先收到當前畫面快照"""
+import asyncio
+import json
+
+import hook
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.closed = False
+        self.sent = []
+
+    async def send_str(self, data):
+        self.sent.append(json.loads(data))
+
+
+class FakeAutomator:
+    def __init__(self, snapshot=None):
+        self.viewer_queues = {}
+        self.instruction_poster_func = None
+        self.relay_poster_func = None
+        self.sync_viewers = set()
+        self.snapshot = snapshot
+        self.snapshot_ready = asyncio.Event()
+
+    def attach_sync_viewer(self, viewer_id):
+        self.sync_viewers.add(viewer_id)
+
+    def detach_sync_viewer(self, viewer_id):
+        self.sync_viewers.discard(viewer_id)
+
+    async def capture_display(self):
+        await self.snapshot_ready.wait()
+        return self.snapshot
+
+
+def test_control_is_assigned_by_the_server():
+    async def main():
+        hub = hook.ViewerHub(FakeAutomator())
+        hub.subscribe('first', FakeWebSocket())
+        hub.subscribe('second', FakeWebSocket(), read_only=False)
+        hub.subscribe('watcher', FakeWebSocket(), read_only=True)
+        flags = [hub.is_read_only(viewer) for viewer in ('first', 'second', 'watcher')]
+        hub.unsubscribe('first')
+        hub.subscribe('third', FakeWebSocket())
+        flags.append(hub.is_read_only('third'))
+        hub.close()
+        return flags
+
+    assert asyncio.run(main()) == [False, True, True, False]
+
+
+def test_late_viewer_gets_snapshot_before_live_instructions():
+    async def main():
+        snapshot = ([('size', ('0', '800', '600')), ('rect', ('0', '0', '0', '800', '600')),
+                     ('sync', ('100',))], '100')
+        automator = FakeAutomator(snapshot)
+        hub = hook.ViewerHub(automator)
+        hub.last_size = ('0', '800', '600')
+        ws = FakeWebSocket()
+        hub.subscribe('late', ws, sync_ack=True)
+        # 快照取得之前的實時指令：sync 100 及之前的內容已包含在快照中
+        hub._deliver('json', 'cfill', ('1',), hub._encode_json('cfill', ('1',)))
+        hub._deliver('json', 'sync', ('100',), hub._encode_json('sync', ('100',)))
+        hub._deliver('json', 'cfill', ('2',), hub._encode_json('cfill', ('2',)))
+        await asyncio.sleep(0)
+        attached_early = 'late' in automator.sync_viewers
+        automator.snapshot_ready.set()
+        await asyncio.sleep(0.01)
+        hub.close()
+        return [(m['opcode'], m['args']) for m in ws.sent], attached_early
+
+    sent, attached_early = asyncio.run(main())
+    assert sent == [('size', ['0', '800', '600']), ('rect', ['0', '0', '0', '800', '600']),
+                    ('sync', ['100']), ('cfill', ['2'])]
+    # 快照送出後才參與 sync 確認
+    assert not attached_early
+
+
+def test_failed_snapshot_falls_back_to_size():
+    async def main():
+        automator = FakeAutomator()
+
+        async def fail():
+            raise ConnectionError('guacd 不可用')
+
+        automator.capture_display = fail
+        hub = hook.ViewerHub(automator)
+        hub.last_size = ('0', '800', '600')
+        ws = FakeWebSocket()
+        hub.subscribe('late', ws)
+        hub._deliver('json', 'cfill', ('1',), hub._encode_json('cfill', ('1',)))
+        await asyncio.sleep(0.01)
+        hub.close()
+        return [(m['opcode'], m['args']) for m in ws.sent]
+
+    assert asyncio.run(main()) == [('size', ['0', '800', '600']), ('cfill', ['1'])]